@@ -0,0 +1,125 @@
+"""Compare the legacy JSON cache scheme with hashed keys and compressed values.
+
+Measures key-build time, key size, stored value size and cache round-trip
+latency for a range of conversation sizes. Round trips run against the
+in-process MemoryCache and, when reachable, against Redis at REDIS_URL.
+
+Usage:
+    python benchmarks/bench_cache_keys.py [--iterations 200] [--json results.json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+CONVERSATION_SHAPES = [
+    ("short", 2, 200),
+    ("medium", 10, 2000),
+    ("long", 50, 10000),
+]
+
+def legacy_cache_key(prefix: str, **kwargs) -> str:
+    """The original scheme: full JSON of every argument concatenated into the key"""
+    key_parts = [prefix]
+    for k, v in sorted(kwargs.items()):
+        if isinstance(v, (list, dict)):
+            v = json.dumps(v, sort_keys=True)
+        key_parts.append(f"{k}:{v}")
+    return ":".join(key_parts)
+
+def legacy_encode(value: dict) -> bytes:
+    return json.dumps(value).encode()
+
+def legacy_decode(value: bytes) -> dict:
+    return json.loads(value)
+
+def make_conversation(messages: int, chars: int) -> list:
+    words = "the quick brown fox jumps over the lazy dog while the model thinks ".split()
+    text = " ".join(words[i % len(words)] for i in range(chars // 5))[:chars]
+    roles = ["user", "assistant"]
+    return [{"role": roles[i % 2], "content": f"{i} {text}"} for i in range(messages)]
+
+def time_per_call(fn, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+async def round_trip_us(backend, key: str, value: bytes, iterations: int) -> float:
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        await backend.set(key, value, 60)
+        await backend.get(key)
+        samples.append((time.perf_counter() - start) * 1e6)
+    await backend.delete(key)
+    return statistics.median(samples)
+
+async def run(iterations: int) -> list:
+    backends = [main.MemoryCache()]
+    redis_backend = main.RedisCache(main.REDIS_URL)
+    try:
+        await redis_backend.ping()
+        backends.append(redis_backend)
+    except Exception:
+        print("Redis not reachable, measuring the in-memory backend only")
+
+    results = []
+    for shape, message_count, chars in CONVERSATION_SHAPES:
+        messages = make_conversation(message_count, chars)
+        params = dict(model="gemini-2-5-pro-free", messages=messages, temperature=0.7, behavior="")
+        response = {"content": messages[-1]["content"], "model": "Gemini Pro", "provider": "openrouter", "category": "free"}
+
+        schemes = {
+            "legacy": (legacy_cache_key, legacy_encode, legacy_decode),
+            "hashed": (main.get_cache_key, main.encode_cache_value, main.decode_cache_value),
+        }
+        for scheme, (build_key, encode, decode) in schemes.items():
+            key = build_key("chat", **params)
+            value = encode(response)
+            assert decode(value) == response
+            row = {
+                "shape": shape,
+                "scheme": scheme,
+                "key_bytes": len(key.encode()),
+                "value_bytes": len(value),
+                "key_build_us": time_per_call(lambda: build_key("chat", **params), iterations),
+                "encode_decode_us": time_per_call(lambda: decode(encode(response)), iterations),
+            }
+            for backend in backends:
+                row[f"{backend.name}_round_trip_us"] = await round_trip_us(
+                    backend, key, value, max(iterations // 4, 10)
+                )
+            results.append(row)
+
+    if len(backends) > 1:
+        await redis_backend.close()
+    return results
+
+def print_table(results: list):
+    columns = list(results[0].keys())
+    print("  ".join(f"{c:>22}" for c in columns))
+    for row in results:
+        print("  ".join(
+            f"{row[c]:>22.1f}" if isinstance(row[c], float) else f"{row[c]:>22}"
+            for c in columns
+        ))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--json", help="Write results to this file")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args.iterations))
+    print_table(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
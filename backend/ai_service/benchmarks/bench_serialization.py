@@ -0,0 +1,152 @@
+"""Compare the old and new /chat serialization paths per request.
+
+For a range of conversation sizes, measures:
+
+    messages      turning request messages into dicts (cache key, payload)
+    cache_hit     turning a cached value into the response body
+    response      building the response body for a fresh upstream result
+
+The legacy path dumps every message with ``.dict()`` (``model_dump`` under
+pydantic 2) for the key and again for the payload, stores values with
+stdlib json and returns an ``APIResponse`` model that FastAPI validates and
+re-encodes. The current path builds message dicts once, keeps cached values as
+JSON bytes and splices them into the envelope with orjson.
+
+Usage:
+    python benchmarks/bench_serialization.py [--iterations 2000] [--json results.json]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from fastapi.responses import JSONResponse  # noqa: E402
+
+import main  # noqa: E402
+
+CONVERSATION_SHAPES = [
+    ("short", 2, 200),
+    ("medium", 10, 2000),
+    ("long", 50, 8000),
+]
+
+def make_request(messages: int, chars: int) -> main.ChatRequest:
+    words = "the quick brown fox jumps over the lazy dog while the model thinks ".split()
+    text = " ".join(words[i % len(words)] for i in range(chars // 5))[:chars]
+    roles = ["user", "assistant"]
+    return main.ChatRequest(
+        messages=[{"role": roles[i % 2], "content": f"{i} {text}"} for i in range(messages - 1)]
+        + [{"role": "user", "content": f"question {text}"}],
+        model="gemini-2-5-pro-free",
+        behavior="Be concise."
+    )
+
+def time_per_call(fn, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+def legacy_messages(chat_request: main.ChatRequest):
+    key_messages = [msg.model_dump() for msg in chat_request.messages]
+    main.get_cache_key("chat", model="gemini-2-5-pro-free", messages=key_messages)
+    payload = [{"role": msg.role, "content": msg.content} for msg in chat_request.messages]
+    payload.insert(0, {"role": "system", "content": chat_request.behavior})
+
+def current_messages(chat_request: main.ChatRequest):
+    # message_dicts and the history digest are kept on the instance, so drop
+    # them to time the first use
+    chat_request.__dict__.pop("message_dicts", None)
+    chat_request.__dict__.pop("prefix_digest", None)
+    main.get_chat_cache_key("gemini-2-5-pro-free", chat_request)
+    main.build_chat_messages(chat_request)
+
+def legacy_response(data: dict) -> bytes:
+    response = main.APIResponse(
+        success=True,
+        data=data,
+        request_id="00000000-0000-0000-0000-000000000000",
+        timestamp=datetime.utcnow().isoformat(),
+        processing_time=0.001,
+        model_used=data["model"],
+        tokens_used=None
+    )
+    return JSONResponse(jsonable_encoder(response)).body
+
+def current_response(data_json: bytes, model_used: str) -> bytes:
+    return main.encode_api_response(
+        data_json,
+        success=True,
+        error=None,
+        request_id="00000000-0000-0000-0000-000000000000",
+        timestamp=datetime.utcnow().isoformat(),
+        processing_time=0.001,
+        model_used=model_used,
+        tokens_used=None
+    ).body
+
+def run(iterations: int) -> list:
+    results = []
+    for shape, message_count, chars in CONVERSATION_SHAPES:
+        chat_request = make_request(message_count, chars)
+        data = {
+            "content": chat_request.messages[-1].content * 2,
+            "model": "Gemini Pro",
+            "provider": "openrouter",
+            "category": "free"
+        }
+        legacy_stored = json.dumps(data).encode()
+        current_stored = main.encode_cache_value(data)
+
+        legacy_body = json.loads(legacy_response(json.loads(legacy_stored)))
+        current_body = json.loads(current_response(main.decode_cache_bytes(current_stored), data["model"]))
+        assert {**legacy_body, "timestamp": None} == {**current_body, "timestamp": None}
+
+        timings = {
+            "legacy": {
+                "messages_us": time_per_call(lambda: legacy_messages(chat_request), iterations),
+                "cache_hit_us": time_per_call(lambda: legacy_response(json.loads(legacy_stored)), iterations),
+                "response_us": time_per_call(lambda: legacy_response(data), iterations),
+            },
+            "current": {
+                "messages_us": time_per_call(lambda: current_messages(chat_request), iterations),
+                "cache_hit_us": time_per_call(
+                    lambda: current_response(main.decode_cache_bytes(current_stored), data["model"]), iterations
+                ),
+                "response_us": time_per_call(lambda: current_response(main.orjson.dumps(data), data["model"]), iterations),
+            },
+        }
+        for path, row in timings.items():
+            results.append({"shape": shape, "path": path, **row})
+        results.append({
+            "shape": shape,
+            "path": "saved",
+            **{k: timings["legacy"][k] - timings["current"][k] for k in timings["legacy"]}
+        })
+    return results
+
+def print_table(results: list):
+    columns = list(results[0].keys())
+    print("  ".join(f"{c:>14}" for c in columns))
+    for row in results:
+        print("  ".join(
+            f"{row[c]:>14.1f}" if isinstance(row[c], float) else f"{row[c]:>14}"
+            for c in columns
+        ))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--json", help="Write results to this file")
+    args = parser.parse_args()
+
+    results = run(args.iterations)
+    print_table(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,330 @@
+"""Load-test the service against simulated upstreams.
+
+Drives /chat, /search and /health with a closed loop of concurrent clients and
+reports throughput, latency percentiles, event-loop lag and memory growth for
+each scenario:
+
+    cache-hot       a small set of prompts that are already cached
+    cache-cold      every prompt is new, so every request goes upstream
+    redis-down      cache-hot traffic while Redis is unreachable (memory fallback)
+    slow-provider   cache-cold traffic with the primary provider 10x slower
+    burst           waves of identical new prompts sent at the same moment
+
+By default the app runs in-process (httpx ASGI transport) with
+PROVIDER_MODE=mock and rate limiting off, so no keys or network are needed.
+With --url the same traffic goes to a running server over a socket; start it
+with PROVIDER_MODE=mock RATE_LIMIT_ENABLED=false. Scenarios that reconfigure
+the service (redis-down, slow-provider) only run in-process, and loop lag and
+memory are then measured for this client process (or --pid for memory).
+
+Usage:
+    python benchmarks/loadtest.py [--scenarios cache-hot,burst] [--duration 10]
+        [--concurrency 32] [--url http://127.0.0.1:8000] [--json results.json]
+        [--baseline previous.json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+
+os.environ.setdefault("PROVIDER_MODE", "mock")
+os.environ.setdefault("RATE_LIMIT_ENABLED", "false")
+os.environ.setdefault("MOCK_TTFB_MS", "150")
+os.environ.setdefault("MOCK_OUTPUT_TOKENS", "60")
+os.environ.setdefault("MOCK_TOKENS_PER_SECOND", "600")
+
+import httpx  # noqa: E402
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SCENARIOS = ["cache-hot", "cache-cold", "redis-down", "slow-provider", "burst"]
+IN_PROCESS_ONLY = {"redis-down", "slow-provider"}
+HOT_PROMPTS = 20
+LAG_INTERVAL = 0.01
+MEMORY_INTERVAL = 1.0
+UNREACHABLE_REDIS_URL = "redis://127.0.0.1:1/0"
+SLOW_PROVIDER = "openrouter"
+SLOW_FACTOR = 10
+
+def percentile(samples: list, p: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * p), len(ordered) - 1)]
+
+def rss_bytes(pid: int) -> int:
+    """Resident set size from /proc (Linux); 0 where unavailable"""
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+class Traffic:
+    """Builds the requests for one scenario"""
+
+    def __init__(self, scenario: str, mix: dict):
+        self.scenario = scenario
+        self.run_id = uuid.uuid4().hex[:8]
+        self.routes = [route for route, weight in mix.items() for _ in range(weight)]
+        self.count = 0
+
+    def prompt(self, n: int, wave: int = 0) -> str:
+        if self.scenario in ("cache-hot", "redis-down"):
+            return f"hot prompt {n % HOT_PROMPTS}"
+        if self.scenario == "burst":
+            return f"burst {self.run_id} {wave}"
+        return f"cold {self.run_id} {n}"
+
+    def warmup(self) -> list:
+        if self.scenario not in ("cache-hot", "redis-down"):
+            return []
+        return [self.build("chat", n) for n in range(HOT_PROMPTS)] + [self.build("search", n) for n in range(HOT_PROMPTS)]
+
+    def next(self, wave: int = 0) -> tuple:
+        n = self.count
+        self.count += 1
+        route = "chat" if self.scenario == "burst" else self.routes[n % len(self.routes)]
+        return self.build(route, n, wave)
+
+    def build(self, route: str, n: int, wave: int = 0) -> tuple:
+        prompt = self.prompt(n, wave)
+        if route == "chat":
+            return "chat", "POST", "/chat", {
+                "messages": [{"role": "user", "content": prompt}],
+                "model": "gemini-2-5-pro-free",
+                "max_tokens": 200
+            }
+        if route == "search":
+            return "search", "POST", "/search", {"query": prompt, "max_results": 5}
+        return "health", "GET", "/health", None
+
+class Recorder:
+    """Collects per-request latencies plus loop lag and memory samples"""
+
+    def __init__(self, pid: int):
+        self.pid = pid
+        self.latencies = {}
+        self.statuses = {}
+        self.lag = []
+        self.memory = []
+        self.start = time.perf_counter()
+
+    def record(self, route: str, status: int, elapsed: float):
+        self.latencies.setdefault(route, []).append(elapsed)
+        self.statuses[str(status)] = self.statuses.get(str(status), 0) + 1
+
+    async def sample_lag(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(LAG_INTERVAL)
+            self.lag.append(max(time.perf_counter() - start - LAG_INTERVAL, 0.0))
+
+    async def sample_memory(self):
+        while True:
+            self.memory.append((round(time.perf_counter() - self.start, 2), rss_bytes(self.pid)))
+            await asyncio.sleep(MEMORY_INTERVAL)
+
+    def summary(self, duration: float) -> dict:
+        all_latencies = [x for samples in self.latencies.values() for x in samples]
+        memory = [rss for _, rss in self.memory if rss]
+
+        def latency_stats(samples: list) -> dict:
+            return {
+                "requests": len(samples),
+                "p50_ms": percentile(samples, 0.50) * 1000,
+                "p95_ms": percentile(samples, 0.95) * 1000,
+                "p99_ms": percentile(samples, 0.99) * 1000,
+                "mean_ms": statistics.fmean(samples) * 1000 if samples else 0.0
+            }
+
+        return {
+            "requests_per_second": len(all_latencies) / duration if duration else 0.0,
+            **latency_stats(all_latencies),
+            "statuses": self.statuses,
+            "routes": {route: latency_stats(samples) for route, samples in self.latencies.items()},
+            "loop_lag_p50_ms": percentile(self.lag, 0.50) * 1000,
+            "loop_lag_p99_ms": percentile(self.lag, 0.99) * 1000,
+            "loop_lag_max_ms": max(self.lag, default=0.0) * 1000,
+            "rss_start_bytes": memory[0] if memory else 0,
+            "rss_end_bytes": memory[-1] if memory else 0,
+            "rss_growth_bytes": memory[-1] - memory[0] if memory else 0,
+            "rss_timeline": self.memory
+        }
+
+async def send(client: httpx.AsyncClient, recorder: Recorder, request: tuple):
+    route, method, path, body = request
+    start = time.perf_counter()
+    try:
+        response = await client.request(method, path, json=body)
+        status = response.status_code
+    except httpx.HTTPError:
+        status = 0
+    recorder.record(route, status, time.perf_counter() - start)
+
+async def drive(client: httpx.AsyncClient, traffic: Traffic, recorder: Recorder, duration: float, concurrency: int):
+    deadline = time.perf_counter() + duration
+
+    if traffic.scenario == "burst":
+        wave = 0
+        while time.perf_counter() < deadline:
+            await asyncio.gather(*(send(client, recorder, traffic.next(wave)) for _ in range(concurrency)))
+            wave += 1
+        return
+
+    async def worker():
+        while time.perf_counter() < deadline:
+            await send(client, recorder, traffic.next())
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+class ServiceConditions:
+    """Applies a scenario's service-side conditions to the in-process app"""
+
+    def __init__(self, main, scenario: str):
+        self.main = main
+        self.scenario = scenario
+        self.saved = None
+
+    async def __aenter__(self):
+        cache = self.main.cache
+        if self.scenario == "redis-down":
+            self.saved = (cache.redis, cache.available)
+            cache.redis = self.main.RedisCache(UNREACHABLE_REDIS_URL)
+            cache.available = False
+        elif self.scenario == "slow-provider":
+            config = self.main.provider_adapters[SLOW_PROVIDER].config
+            self.saved = dict(config)
+            config["ttfb_ms"] *= SLOW_FACTOR
+            config["tokens_per_second"] /= SLOW_FACTOR
+        return self
+
+    async def __aexit__(self, *exc_info):
+        cache = self.main.cache
+        if self.scenario == "redis-down":
+            await cache.redis.close()
+            cache.redis, cache.available = self.saved
+        elif self.scenario == "slow-provider":
+            self.main.provider_adapters[SLOW_PROVIDER].config.update(self.saved)
+
+class NullConditions:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+async def run_scenario(client, main, scenario: str, args, pid: int) -> dict:
+    traffic = Traffic(scenario, args.mix)
+    recorder = Recorder(pid)
+    async with ServiceConditions(main, scenario) if main else NullConditions():
+        for request in traffic.warmup():
+            await client.request(request[1], request[2], json=request[3])
+        samplers = [asyncio.create_task(recorder.sample_lag()), asyncio.create_task(recorder.sample_memory())]
+        start = time.perf_counter()
+        await drive(client, traffic, recorder, args.duration, args.concurrency)
+        elapsed = time.perf_counter() - start
+        for task in samplers:
+            task.cancel()
+    return {"scenario": scenario, "duration": elapsed, **recorder.summary(elapsed)}
+
+async def run(args) -> list:
+    limits = httpx.Limits(max_connections=args.concurrency * 2)
+    timeout = httpx.Timeout(60.0)
+    results = []
+
+    if args.url:
+        async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=timeout) as client:
+            for scenario in args.scenarios:
+                if scenario in IN_PROCESS_ONLY:
+                    print(f"Skipping {scenario}: it reconfigures the service and only runs in-process")
+                    continue
+                print(f"Running {scenario}...")
+                results.append(await run_scenario(client, None, scenario, args, args.pid or os.getpid()))
+        return results
+
+    import main
+    if main.PROVIDER_MODE != "mock":
+        print("Warning: PROVIDER_MODE is not mock, requests will reach real providers")
+    transport = httpx.ASGITransport(app=main.app)
+    async with main.lifespan(main.app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://loadtest", limits=limits, timeout=timeout) as client:
+            for scenario in args.scenarios:
+                print(f"Running {scenario}...")
+                results.append(await run_scenario(client, main, scenario, args, os.getpid()))
+    return results
+
+def print_table(results: list, baseline: dict):
+    columns = ["requests_per_second", "p50_ms", "p95_ms", "p99_ms", "loop_lag_p99_ms", "rss_growth_bytes"]
+    print(f"{'scenario':>14}  " + "  ".join(f"{c:>20}" for c in columns))
+    for row in results:
+        cells = []
+        for c in columns:
+            cell = f"{row[c]:.1f}" if isinstance(row[c], float) else str(row[c])
+            previous = baseline.get(row["scenario"], {}).get(c)
+            if previous:
+                cell += f" ({(row[c] - previous) / previous * 100:+.0f}%)"
+            cells.append(f"{cell:>20}")
+        print(f"{row['scenario']:>14}  " + "  ".join(cells))
+        errors = {status: n for status, n in row["statuses"].items() if not status.startswith("2")}
+        if errors:
+            print(f"{'':>14}  non-2xx responses: {errors}")
+
+def parse_mix(value: str) -> dict:
+    mix = {}
+    for part in value.split(","):
+        route, _, weight = part.partition("=")
+        mix[route.strip()] = int(weight or 1)
+    return mix
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="Comma-separated scenario names")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds per scenario")
+    parser.add_argument("--concurrency", type=int, default=32, help="Concurrent clients (burst: requests per wave)")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("chat=8,search=1,health=1"), help="Route weights")
+    parser.add_argument("--url", help="Target a running server instead of the in-process app")
+    parser.add_argument("--pid", type=int, help="Server pid to sample memory from when using --url")
+    parser.add_argument("--json", help="Write results to this file")
+    parser.add_argument("--baseline", help="Earlier --json output to compare against")
+    args = parser.parse_args()
+    args.scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = {row["scenario"]: row for row in json.load(f)["results"]}
+
+    results = asyncio.run(run(args))
+    print_table(results, baseline)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({
+                "commit": git_commit(),
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "config": {
+                    "duration": args.duration,
+                    "concurrency": args.concurrency,
+                    "mix": args.mix,
+                    "target": args.url or "in-process",
+                    "mock": {k: v for k, v in os.environ.items() if k.startswith("MOCK_")}
+                },
+                "results": results
+            }, f, indent=2)
@@ -2,42 +2,842 @@ import os
 import time
 import uuid
 import asyncio
+import bisect
+import fcntl
+import hashlib
+import heapq
+import hmac
+import io
+import math
+import random
+import re
+import secrets
+import signal
+import sys
+import threading
+import wave
+import zlib
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Any
-from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Any, AsyncIterator, Awaitable, Callable
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from collections import OrderedDict, deque
 
 import httpx
+import orjson
 import uvicorn
-from fastapi import FastAPI, HTTPException, Depends, Request, BackgroundTasks
+from fastapi import FastAPI, HTTPException, Depends, Request, BackgroundTasks, File, Form, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel, Field, validator
-from slowapi import Limiter, _rate_limit_exceeded_handler
-from slowapi.util import get_remote_address
-from slowapi.errors import RateLimitExceeded
-from slowapi.middleware import SlowAPIMiddleware
-import redis
-import json
-from functools import wraps
+from fastapi.responses import ORJSONResponse, PlainTextResponse, Response, StreamingResponse
+from pydantic import BaseModel, ConfigDict, Field, PrivateAttr, ValidationError, field_validator
+import redis.asyncio as aioredis
+from functools import cached_property, wraps
+from importlib.util import find_spec
 import logging
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Rate limiting setup
-limiter = Limiter(key_func=get_remote_address)
+# Startup time is reported from here, so it covers building the module state
+# of each worker as well as connecting and warming up in the lifespan
+MODULE_LOAD_START = time.perf_counter()
 
-# Cache setup (using Redis if available, otherwise in-memory)
-try:
-    cache = redis.Redis(host='localhost', port=6379, db=0, decode_responses=True)
-    cache.ping()
-    CACHE_AVAILABLE = True
-    logger.info("Redis cache connected successfully")
-except:
-    CACHE_AVAILABLE = False
-    cache = {}
-    logger.warning("Redis not available, using in-memory cache")
+# Metrics (Prometheus text format)
+# Children are cached per label tuple, so the hot path is a dict lookup plus an
+# integer/float add on the event loop thread - no locks, no label dicts. With
+# several workers, each one periodically writes a snapshot to METRICS_DIR and
+# /metrics merges them. Counters and histograms are summed; each gauge says how
+# its live workers combine ("sum" for things like in-flight counts, "max" or
+# "min" for per-worker values such as limits and readiness).
+METRICS_DIR = os.getenv("METRICS_DIR")
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0)
+
+class CounterChild:
+    __slots__ = ("value",)
+    
+    def __init__(self):
+        self.value = 0.0
+    
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+    
+    def dec(self, amount: float = 1.0):
+        self.value -= amount
+    
+    def set(self, value: float):
+        self.value = value
+    
+    def snapshot(self):
+        return self.value
+
+class HistogramChild:
+    __slots__ = ("bounds", "counts", "sum", "count")
+    
+    def __init__(self, bounds: tuple):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+    
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+    
+    def snapshot(self):
+        return {"counts": self.counts, "sum": self.sum, "count": self.count}
+
+class Metric:
+    """A metric family; ``labels(...)`` returns a cached child for that label tuple"""
+    
+    def __init__(self, name: str, kind: str, help_text: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS, aggregate: str = "sum"):
+        self.name = name
+        self.kind = kind
+        self.help = help_text
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.aggregate = aggregate
+        self.children: Dict[tuple, Any] = {}
+    
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            child = HistogramChild(self.buckets) if self.kind == "histogram" else CounterChild()
+            self.children[values] = child
+        return child
+    
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "kind": self.kind,
+            "help": self.help,
+            "labelnames": list(self.labelnames),
+            "buckets": list(self.buckets),
+            "aggregate": self.aggregate,
+            "samples": [[list(values), child.snapshot()] for values, child in self.children.items()]
+        }
+
+GAUGE_AGGREGATES = {"sum": lambda a, b: a + b, "max": max, "min": min}
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+        self.collectors: List = []
+        self.derived: List = []
+    
+    def counter(self, name: str, help_text: str, labelnames: tuple = ()) -> Metric:
+        return self._register(Metric(name, "counter", help_text, labelnames))
+    
+    def gauge(self, name: str, help_text: str, labelnames: tuple = (), aggregate: str = "sum") -> Metric:
+        """A gauge; ``aggregate`` (sum, max or min) combines the values of live workers"""
+        if aggregate not in GAUGE_AGGREGATES:
+            raise ValueError(f"Unknown gauge aggregate: {aggregate}")
+        return self._register(Metric(name, "gauge", help_text, labelnames, aggregate=aggregate))
+    
+    def histogram(self, name: str, help_text: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Metric:
+        return self._register(Metric(name, "histogram", help_text, labelnames, buckets))
+    
+    def _register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+    
+    def register_collector(self, collector):
+        """Register a callable that refreshes gauges from live state at scrape time"""
+        self.collectors.append(collector)
+    
+    def register_derived(self, name: str, help_text: str, compute):
+        """Register a gauge computed from the merged samples of all workers at render time.
+        
+        ``compute(merged)`` gets ``{name: {labels: value}}`` and returns a value or None
+        """
+        self.derived.append((name, help_text, compute))
+    
+    def snapshot(self) -> Dict[str, Any]:
+        for collector in self.collectors:
+            collector()
+        return {"pid": os.getpid(), "metrics": {name: m.snapshot() for name, m in self.metrics.items()}}
+    
+    def flush(self):
+        """Write this worker's snapshot to METRICS_DIR (atomic rename)"""
+        if not METRICS_DIR:
+            return
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        path = os.path.join(METRICS_DIR, f"worker-{os.getpid()}.json")
+        with open(f"{path}.tmp", "wb") as f:
+            f.write(orjson.dumps(self.snapshot()))
+        os.replace(f"{path}.tmp", path)
+    
+    def _read_worker_snapshots(self) -> List[Dict[str, Any]]:
+        """Snapshots other live workers wrote to METRICS_DIR; files of exited workers are removed"""
+        snapshots = []
+        if not METRICS_DIR or not os.path.isdir(METRICS_DIR):
+            return snapshots
+        for filename in os.listdir(METRICS_DIR):
+            if not filename.startswith("worker-") or not filename.endswith(".json"):
+                continue
+            try:
+                pid = int(filename[len("worker-"):-len(".json")])
+            except ValueError:
+                continue
+            if pid == os.getpid():
+                continue
+            path = os.path.join(METRICS_DIR, filename)
+            if not pid_alive(pid):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            try:
+                with open(path, "rb") as f:
+                    snapshots.append(orjson.loads(f.read()))
+            except (OSError, ValueError):
+                continue
+        return snapshots
+    
+    async def collect_all(self) -> List[Dict[str, Any]]:
+        """Snapshots for this worker plus, in multi-worker mode, every other live worker"""
+        return [self.snapshot()] + await asyncio.to_thread(self._read_worker_snapshots)
+    
+    async def render(self) -> str:
+        merged: Dict[str, Dict[str, Any]] = {}
+        for snapshot in await self.collect_all():
+            for name, metric in snapshot["metrics"].items():
+                target = merged.setdefault(name, {**metric, "samples": {}})
+                combine = GAUGE_AGGREGATES[metric.get("aggregate", "sum")] if metric["kind"] == "gauge" else GAUGE_AGGREGATES["sum"]
+                for values, value in metric["samples"]:
+                    key = tuple(values)
+                    if metric["kind"] == "histogram":
+                        current = target["samples"].get(key)
+                        if current is None:
+                            target["samples"][key] = {"counts": list(value["counts"]), "sum": value["sum"], "count": value["count"]}
+                        else:
+                            current["counts"] = [a + b for a, b in zip(current["counts"], value["counts"])]
+                            current["sum"] += value["sum"]
+                            current["count"] += value["count"]
+                    else:
+                        current = target["samples"].get(key)
+                        target["samples"][key] = value if current is None else combine(current, value)
+        
+        totals = {name: metric["samples"] for name, metric in merged.items()}
+        for name, help_text, compute in self.derived:
+            value = compute(totals)
+            if value is not None:
+                merged[name] = {"kind": "gauge", "help": help_text, "labelnames": [], "samples": {(): value}}
+        
+        lines = []
+        for name, metric in merged.items():
+            lines.append(f"# HELP {name} {metric['help']}")
+            lines.append(f"# TYPE {name} {metric['kind']}")
+            labelnames = metric["labelnames"]
+            for values, value in metric["samples"].items():
+                labels = ",".join(f'{k}="{escape_label(v)}"' for k, v in zip(labelnames, values))
+                if metric["kind"] != "histogram":
+                    lines.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+                    continue
+                cumulative = 0
+                sep = "," if labels else ""
+                for bound, count in zip(list(metric["buckets"]) + ["+Inf"], value["counts"]):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{{labels}{sep}le="{bound}"}} {cumulative}')
+                suffix = f"{{{labels}}}" if labels else ""
+                lines.append(f"{name}_sum{suffix} {value['sum']}")
+                lines.append(f"{name}_count{suffix} {value['count']}")
+        return "\n".join(lines) + "\n"
+
+def escape_label(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+metrics = MetricsRegistry()
+REQUESTS_TOTAL = metrics.counter("ego_requests_total", "HTTP requests by route, method and status", ("route", "method", "status"))
+REQUEST_DURATION = metrics.histogram("ego_request_duration_seconds", "HTTP request latency by route, model and provider", ("route", "model", "provider"))
+REQUESTS_IN_FLIGHT = metrics.gauge("ego_requests_in_flight", "HTTP requests currently being served")
+HTTP_ERRORS_TOTAL = metrics.counter("ego_http_errors_total", "HTTP error responses by route and status", ("route", "status"))
+UPSTREAM_DURATION = metrics.histogram("ego_upstream_duration_seconds", "Upstream call latency by provider and model", ("provider", "model"))
+UPSTREAM_TTFB = metrics.histogram("ego_upstream_ttfb_seconds", "Upstream time to first byte by provider", ("provider",))
+UPSTREAM_ERRORS_TOTAL = metrics.counter("ego_upstream_errors_total", "Upstream errors by provider and status", ("provider", "status"))
+UPSTREAM_IN_FLIGHT = metrics.gauge("ego_upstream_in_flight", "Upstream calls currently in flight", ("provider",))
+CACHE_LOOKUPS_TOTAL = metrics.counter("ego_cache_lookups_total", "Response cache lookups by namespace and result", ("namespace", "result"))
+TOKENS_TOTAL = metrics.counter("ego_tokens_total", "Tokens used by model", ("model",))
+
+# Request profiling (opt-in via PROFILING_ENABLED)
+# Each request collects phase timings (returned as a Server-Timing header), a
+# background task measures event-loop lag, and a sampler thread records what
+# the event loop thread is executing while any request is past
+# PROFILE_SLOW_THRESHOLD. Finished slow requests, with their phases and stack
+# samples, go to a ring buffer served by /admin/slow-requests.
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() in ("1", "true", "yes")
+PROFILE_SLOW_THRESHOLD = float(os.getenv("PROFILE_SLOW_THRESHOLD", "2.0"))
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", "0.01"))
+PROFILE_STACK_DEPTH = int(os.getenv("PROFILE_STACK_DEPTH", "40"))
+PROFILE_TOP_STACKS = int(os.getenv("PROFILE_TOP_STACKS", "10"))
+SLOW_REQUEST_LOG_SIZE = int(os.getenv("SLOW_REQUEST_LOG_SIZE", "100"))
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.1"))
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+LOOP_LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+EVENT_LOOP_LAG = metrics.histogram("ego_event_loop_lag_seconds", "Event loop scheduling delay", buckets=LOOP_LAG_BUCKETS)
+SLOW_REQUESTS_TOTAL = metrics.counter("ego_slow_requests_total", "Requests slower than PROFILE_SLOW_THRESHOLD by route", ("route",))
+
+class RequestProfile:
+    __slots__ = ("request_id", "start", "phases", "samples")
+    
+    def __init__(self, request_id: str):
+        self.request_id = request_id
+        self.start = time.perf_counter()
+        self.phases: Dict[str, float] = {}
+        self.samples: Dict[str, int] = {}
+    
+    def add(self, phase: str, seconds: float):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+current_profile: ContextVar[Optional[RequestProfile]] = ContextVar("current_profile", default=None)
+
+def record_phase(phase: str, seconds: float):
+    """Add time to a phase of the current request (no-op unless profiling)"""
+    profile = current_profile.get()
+    if profile is not None:
+        profile.add(phase, seconds)
+
+@contextmanager
+def timed_phase(phase: str):
+    profile = current_profile.get()
+    if profile is None:
+        yield
+        return
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add(phase, time.perf_counter() - start_time)
+
+def mark_validated():
+    """Record the time from request start to the endpoint body (body read and validation)"""
+    profile = current_profile.get()
+    if profile is not None and "validate" not in profile.phases:
+        profile.add("validate", time.perf_counter() - profile.start)
+
+def collapse_stack(frame, depth: int = PROFILE_STACK_DEPTH) -> str:
+    """Format a frame's stack outermost-first, flamegraph "collapsed" style"""
+    parts = []
+    while frame is not None and len(parts) < depth:
+        code = frame.f_code
+        parts.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+        frame = frame.f_back
+    return ";".join(reversed(parts))
+
+class Profiler:
+    """Loop lag monitor, slow-request stack sampler and slow-request ring buffer"""
+    
+    def __init__(self):
+        self.active: Dict[str, RequestProfile] = {}
+        self.slow_requests: deque = deque(maxlen=SLOW_REQUEST_LOG_SIZE)
+        self.loop_lag_last = 0.0
+        self.loop_lag_max = 0.0
+        self._samples_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._loop_thread_id: Optional[int] = None
+        self._sampler: Optional[threading.Thread] = None
+        self._lag_task: Optional[asyncio.Task] = None
+    
+    def start(self):
+        self._loop_thread_id = threading.get_ident()
+        self._stop.clear()
+        self._lag_task = asyncio.create_task(self._monitor_loop_lag())
+        self._sampler = threading.Thread(target=self._sample_stacks, name="slow-request-sampler", daemon=True)
+        self._sampler.start()
+    
+    async def stop(self):
+        self._stop.set()
+        if self._lag_task:
+            self._lag_task.cancel()
+            self._lag_task = None
+        if self._sampler:
+            await asyncio.to_thread(self._sampler.join, 1.0)
+            self._sampler = None
+    
+    def begin(self, request_id: str) -> tuple:
+        profile = RequestProfile(request_id)
+        self.active[request_id] = profile
+        return profile, current_profile.set(profile)
+    
+    def finish(self, profile: RequestProfile, token, request: Request, status_code: int) -> str:
+        """Close a request's profile; returns its Server-Timing header value"""
+        current_profile.reset(token)
+        self.active.pop(profile.request_id, None)
+        total = time.perf_counter() - profile.start
+        
+        if total >= PROFILE_SLOW_THRESHOLD:
+            route = request.scope.get("route")
+            route_path = route.path if route is not None else "unmatched"
+            SLOW_REQUESTS_TOTAL.labels(route_path).inc()
+            with self._samples_lock:
+                samples = sorted(profile.samples.items(), key=lambda item: item[1], reverse=True)
+            self.slow_requests.append({
+                "request_id": profile.request_id,
+                "route": route_path,
+                "method": request.method,
+                "status": status_code,
+                "model": getattr(request.state, "model_key", None),
+                "timestamp": datetime.utcnow().isoformat(),
+                "duration_ms": total * 1000,
+                "phases_ms": {phase: seconds * 1000 for phase, seconds in profile.phases.items()},
+                "samples": sum(count for _, count in samples),
+                "top_stacks": [{"stack": stack, "samples": count} for stack, count in samples[:PROFILE_TOP_STACKS]]
+            })
+        
+        timings = [f"{phase};dur={seconds * 1000:.1f}" for phase, seconds in profile.phases.items()]
+        timings.append(f"total;dur={total * 1000:.1f}")
+        return ", ".join(timings)
+    
+    async def _monitor_loop_lag(self):
+        while True:
+            start_time = time.perf_counter()
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            lag = max(time.perf_counter() - start_time - LOOP_LAG_INTERVAL, 0.0)
+            EVENT_LOOP_LAG.labels().observe(lag)
+            self.loop_lag_last = lag
+            self.loop_lag_max = max(self.loop_lag_max, lag)
+    
+    def _sample_stacks(self):
+        """Sampler thread: while a request is over the threshold, record the loop thread's stack
+        
+        The loop serves every request, so samples show where the loop spent its
+        time (CPU work, blocking calls, or idle in select) while that request
+        was slow, not only that request's own code.
+        """
+        while not self._stop.wait(PROFILE_SAMPLE_INTERVAL):
+            now = time.perf_counter()
+            try:
+                slow = [p for p in list(self.active.values()) if now - p.start >= PROFILE_SLOW_THRESHOLD]
+            except RuntimeError:
+                continue  # active changed size mid-copy; try again next tick
+            if not slow:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            stack = collapse_stack(frame)
+            del frame
+            with self._samples_lock:
+                for profile in slow:
+                    profile.samples[stack] = profile.samples.get(stack, 0) + 1
+    
+    def report(self, limit: int) -> Dict[str, Any]:
+        requests = sorted(self.slow_requests, key=lambda r: r["duration_ms"], reverse=True)
+        return {
+            "profiling_enabled": PROFILING_ENABLED,
+            "threshold_ms": PROFILE_SLOW_THRESHOLD * 1000,
+            "loop_lag_ms": {"last": self.loop_lag_last * 1000, "max": self.loop_lag_max * 1000},
+            "in_flight": len(self.active),
+            "recorded": len(self.slow_requests),
+            "requests": requests[:limit]
+        }
+
+profiler = Profiler()
+
+# Cache setup (Redis when reachable, otherwise in-process; connected in lifespan)
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "50"))
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", "0.5"))
+CACHE_RECONNECT_INTERVAL = float(os.getenv("CACHE_RECONNECT_INTERVAL", "5"))
+
+# In-process cache budgets: the fallback tier (used while Redis is down) and the
+# L1 tier in front of Redis. L1 entries live at most L1_CACHE_TTL seconds so
+# workers do not serve each other's overwritten values for long.
+MEMORY_CACHE_MAX_ENTRIES = int(os.getenv("MEMORY_CACHE_MAX_ENTRIES", "10000"))
+MEMORY_CACHE_MAX_BYTES = int(os.getenv("MEMORY_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+L1_CACHE_TTL = int(os.getenv("L1_CACHE_TTL", "30"))
+L1_CACHE_MAX_ENTRIES = int(os.getenv("L1_CACHE_MAX_ENTRIES", "2000"))
+L1_CACHE_MAX_BYTES = int(os.getenv("L1_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+
+class CacheBackend:
+    """Async key/value interface shared by the cache implementations"""
+    name = "base"
+    
+    async def get(self, key: str) -> Optional[bytes]:
+        raise NotImplementedError
+    
+    async def set(self, key: str, value: bytes, ttl: int) -> None:
+        raise NotImplementedError
+    
+    async def delete(self, key: str) -> None:
+        raise NotImplementedError
+    
+    async def compare_and_set(self, key: str, check, value: bytes, ttl: int) -> bool:
+        """Write ``value`` only if ``check(current value or None)`` holds.
+        
+        Atomic for the in-process cache, whose get and set never suspend.
+        """
+        if not check(await self.get(key)):
+            return False
+        await self.set(key, value, ttl)
+        return True
+    
+    async def ping(self) -> bool:
+        return True
+    
+    async def close(self) -> None:
+        pass
+
+class MemoryCache(CacheBackend):
+    """Bounded in-process LRU cache with per-entry expiry and size accounting"""
+    name = "memory"
+    
+    def __init__(self, max_entries: int = MEMORY_CACHE_MAX_ENTRIES, max_bytes: int = MEMORY_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+    
+    @staticmethod
+    def _entry_size(key: str, value: bytes) -> int:
+        return len(key) + len(value)
+    
+    def _remove(self, key: str):
+        expires_at, value = self._data.pop(key)
+        self.bytes -= self._entry_size(key, value)
+    
+    async def get(self, key: str) -> Optional[bytes]:
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+    
+    async def set(self, key: str, value: bytes, ttl: int) -> None:
+        size = self._entry_size(key, value)
+        if key in self._data:
+            self._remove(key)
+        if ttl <= 0 or size > self.max_bytes:
+            return
+        self._data[key] = (time.monotonic() + ttl, value)
+        self.bytes += size
+        while len(self._data) > self.max_entries or self.bytes > self.max_bytes:
+            self._remove(next(iter(self._data)))
+            self.evictions += 1
+    
+    async def delete(self, key: str) -> None:
+        if key in self._data:
+            self._remove(key)
+    
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._data),
+            "bytes": self.bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations
+        }
+
+# Delete a lease only if we still own it (compare-and-delete)
+RELEASE_LEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# Token buckets for rate limiting. Every bucket is refilled from the Redis
+# clock and checked; tokens are taken from all of them only if all have enough,
+# so a request never spends per-route budget when its category budget is empty.
+# KEYS: bucket keys. ARGV: capacity, refill per ms and cost for each key.
+# Returns {allowed, index of the tightest bucket, its remaining tokens,
+# retry-after ms, ms until it is full again}.
+TOKEN_BUCKET_SCRIPT = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) * 1000 + math.floor(tonumber(now[2]) / 1000)
+local levels = {}
+local allowed = 1
+local retry_ms = 0
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[i * 3 - 2])
+    local rate = tonumber(ARGV[i * 3 - 1])
+    local cost = tonumber(ARGV[i * 3])
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    local level = tonumber(state[1]) or capacity
+    local elapsed = math.max(now - (tonumber(state[2]) or now), 0)
+    level = math.min(capacity, level + elapsed * rate)
+    if level < cost then
+        allowed = 0
+        retry_ms = math.max(retry_ms, (cost - level) / rate)
+    end
+    levels[i] = level
+end
+local tightest, remaining, reset_ms = 1, nil, 0
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[i * 3 - 2])
+    local rate = tonumber(ARGV[i * 3 - 1])
+    local level = levels[i]
+    if allowed == 1 then
+        level = level - tonumber(ARGV[i * 3])
+        redis.call('HSET', key, 'tokens', tostring(level), 'ts', now)
+        redis.call('PEXPIRE', key, math.ceil(capacity / rate))
+    end
+    if remaining == nil or level < remaining then
+        tightest, remaining = i, level
+        reset_ms = (capacity - level) / rate
+    end
+end
+return {allowed, tightest, math.floor(remaining), math.ceil(retry_ms), math.ceil(reset_ms)}
+"""
+
+class RedisCache(CacheBackend):
+    """Redis cache using a pooled redis.asyncio client"""
+    name = "redis"
+    
+    def __init__(self, url: str):
+        self.client = aioredis.Redis.from_url(
+            url,
+            max_connections=REDIS_MAX_CONNECTIONS,
+            socket_timeout=REDIS_SOCKET_TIMEOUT,
+            socket_connect_timeout=REDIS_SOCKET_TIMEOUT,
+            health_check_interval=30
+        )
+        # EVALSHA, loading the script only after a NOSCRIPT reply
+        self.token_bucket = self.client.register_script(TOKEN_BUCKET_SCRIPT)
+    
+    async def get(self, key: str) -> Optional[bytes]:
+        return await self.client.get(key)
+    
+    async def set(self, key: str, value: bytes, ttl: int) -> None:
+        await self.client.setex(key, ttl, value)
+    
+    async def delete(self, key: str) -> None:
+        await self.client.delete(key)
+    
+    async def compare_and_set(self, key: str, check, value: bytes, ttl: int) -> bool:
+        # WATCH makes EXEC fail if another client wrote the key after our read
+        async with self.client.pipeline(transaction=True) as pipe:
+            await pipe.watch(key)
+            if not check(await pipe.get(key)):
+                await pipe.unwatch()
+                return False
+            pipe.multi()
+            pipe.setex(key, ttl, value)
+            try:
+                await pipe.execute()
+            except aioredis.WatchError:
+                return False
+            return True
+    
+    async def ping(self) -> bool:
+        return await self.client.ping()
+    
+    async def acquire_lease(self, key: str, token: str, ttl_ms: int) -> bool:
+        return bool(await self.client.set(key, token, nx=True, px=ttl_ms))
+    
+    async def release_lease(self, key: str, token: str) -> None:
+        await self.client.eval(RELEASE_LEASE_SCRIPT, 1, key, token)
+    
+    async def lease_exists(self, key: str) -> bool:
+        return bool(await self.client.exists(key))
+    
+    async def take_tokens(self, keys: List[str], args: List[Any]) -> List[int]:
+        return await self.token_bucket(keys=keys, args=args)
+    
+    async def close(self) -> None:
+        await self.client.aclose()
+
+class CacheStore:
+    """Redis-first cache with an L1 memory tier, memory fallback and background reconnects"""
+    
+    def __init__(self, redis_url: str):
+        self.redis_url = redis_url
+        self.redis: Optional[RedisCache] = None
+        self.fallback = MemoryCache()
+        self.l1 = MemoryCache(L1_CACHE_MAX_ENTRIES, L1_CACHE_MAX_BYTES) if L1_CACHE_TTL > 0 else None
+        self.available = False
+        self.redis_hits = 0
+        self.redis_misses = 0
+        self.redis_errors = 0
+        self._reconnect_task: Optional[asyncio.Task] = None
+    
+    @property
+    def backend(self) -> CacheBackend:
+        return self.redis if self.available else self.fallback
+    
+    async def connect(self):
+        """Try to reach Redis and start the reconnect loop"""
+        if self.redis is None:
+            self.redis = RedisCache(self.redis_url)
+        await self._check_redis()
+        if self.available:
+            logger.info("Redis cache connected successfully")
+        else:
+            logger.warning("Redis not available, using in-memory cache")
+        if self._reconnect_task is None:
+            self._reconnect_task = asyncio.create_task(self._reconnect_loop())
+    
+    async def close(self):
+        if self._reconnect_task:
+            self._reconnect_task.cancel()
+            self._reconnect_task = None
+        if self.redis:
+            await self.redis.close()
+            self.redis = None
+        self.available = False
+    
+    async def _check_redis(self):
+        try:
+            self.available = bool(await self.redis.ping())
+        except Exception:
+            self.available = False
+    
+    async def _reconnect_loop(self):
+        while True:
+            await asyncio.sleep(CACHE_RECONNECT_INTERVAL)
+            if self.available:
+                continue
+            await self._check_redis()
+            if self.available:
+                logger.info("Redis cache reconnected")
+    
+    def _mark_unavailable(self, error: Exception):
+        self.redis_errors += 1
+        if self.available:
+            logger.warning(f"Redis cache unavailable, falling back to in-memory cache: {error}")
+        self.available = False
+    
+    async def get(self, key: str, l1: bool = True) -> Optional[bytes]:
+        """Read a value; pass ``l1=False`` for state other workers may have just rewritten"""
+        if self.available:
+            if self.l1 and l1:
+                value = await self.l1.get(key)
+                if value is not None:
+                    return value
+            try:
+                value = await self.redis.get(key)
+            except Exception as e:
+                self._mark_unavailable(e)
+            else:
+                if value is None:
+                    self.redis_misses += 1
+                else:
+                    self.redis_hits += 1
+                    if self.l1 and l1:
+                        await self.l1.set(key, value, L1_CACHE_TTL)
+                return value
+        return await self.fallback.get(key)
+    
+    async def set(self, key: str, value: bytes, ttl: int, l1: bool = True):
+        if self.available:
+            try:
+                await self.redis.set(key, value, ttl)
+            except Exception as e:
+                self._mark_unavailable(e)
+            else:
+                if self.l1 and l1:
+                    await self.l1.set(key, value, min(ttl, L1_CACHE_TTL))
+                return
+        await self.fallback.set(key, value, ttl)
+    
+    async def compare_and_set(self, key: str, check, value: bytes, ttl: int) -> bool:
+        """Conditional write for shared state; bypasses the L1 tier"""
+        if self.available:
+            try:
+                return await self.redis.compare_and_set(key, check, value, ttl)
+            except Exception as e:
+                self._mark_unavailable(e)
+        return await self.fallback.compare_and_set(key, check, value, ttl)
+    
+    async def evict_l1(self, key: str):
+        if self.l1:
+            await self.l1.delete(key)
+    
+    async def delete(self, key: str):
+        if self.l1:
+            await self.l1.delete(key)
+        if self.available:
+            try:
+                await self.redis.delete(key)
+            except Exception as e:
+                self._mark_unavailable(e)
+        await self.fallback.delete(key)
+    
+    async def acquire_lease(self, key: str, ttl_ms: int) -> Optional[str]:
+        """Take a short cross-worker lease; returns its token, or None if another worker holds it
+        
+        Without Redis there is nothing to coordinate with, so the lease is always granted.
+        """
+        token = uuid.uuid4().hex
+        if not self.available:
+            return token
+        try:
+            return token if await self.redis.acquire_lease(key, token, ttl_ms) else None
+        except Exception as e:
+            self._mark_unavailable(e)
+            return token
+    
+    async def release_lease(self, key: str, token: str):
+        if not self.available:
+            return
+        try:
+            await self.redis.release_lease(key, token)
+        except Exception as e:
+            self._mark_unavailable(e)
+    
+    async def lease_exists(self, key: str) -> bool:
+        if not self.available:
+            return False
+        try:
+            return await self.redis.lease_exists(key)
+        except Exception as e:
+            self._mark_unavailable(e)
+            return False
+    
+    async def take_tokens(self, keys: List[str], args: List[Any]) -> Optional[List[int]]:
+        """Run the token bucket script; returns None when the caller must fall back to local buckets"""
+        if not self.available:
+            return None
+        try:
+            return await self.redis.take_tokens(keys, args)
+        except Exception as e:
+            self._mark_unavailable(e)
+            return None
+    
+    def stats(self) -> Dict[str, Any]:
+        """Report tier state and hit/miss/eviction counters"""
+        return {
+            "backend": self.backend.name,
+            "redis_available": self.available,
+            "redis": {
+                "hits": self.redis_hits,
+                "misses": self.redis_misses,
+                "errors": self.redis_errors
+            },
+            "l1": self.l1.stats() if self.l1 else None,
+            "fallback": self.fallback.stats()
+        }
+
+cache = CacheStore(REDIS_URL)
 
 # AI Model Configuration
 AI_MODELS = {
@@ -49,7 +849,9 @@ AI_MODELS = {
         "type": "thinking",
         "category": "free",
         "max_tokens": 4000,
-        "timeout": 30
+        "context_tokens": 64000,
+        "timeout": 30,
+        "fallbacks": ["qwen-3-235b-free", "llama-4-scout-free"]
     },
     "qwen-3-235b-free": {
         "name": "Qwen 3 235B",
@@ -58,7 +860,10 @@ AI_MODELS = {
         "type": "chat",
         "category": "free",
         "max_tokens": 4000,
-        "timeout": 30
+        "context_tokens": 32768,
+        "timeout": 30,
+        "intents": ["creative"],
+        "fallbacks": ["llama-4-scout-free", "gemini-2-5-pro-free"]
     },
     "llama-4-scout-free": {
         "name": "Llama 3.1 405B",
@@ -67,7 +872,10 @@ AI_MODELS = {
         "type": "chat", 
         "category": "free",
         "max_tokens": 4000,
-        "timeout": 30
+        "context_tokens": 32768,
+        "timeout": 30,
+        "intents": ["code"],
+        "fallbacks": ["qwen-3-235b-free", "gemini-2-5-pro-free"]
     },
     "gemini-2-5-pro-free": {
         "name": "Gemini Pro",
@@ -76,7 +884,10 @@ AI_MODELS = {
         "type": "chat",
         "category": "free",
         "max_tokens": 4000,
-        "timeout": 30
+        "context_tokens": 32760,
+        "timeout": 30,
+        "intents": ["general"],
+        "fallbacks": ["qwen-3-235b-free", "llama-4-scout-free"]
     },
     
     # Premium Models (A4F)
@@ -87,7 +898,11 @@ AI_MODELS = {
         "type": "chat",
         "category": "premium",
         "max_tokens": 4000,
-        "timeout": 45
+        "context_tokens": 128000,
+        "timeout": 45,
+        "intents": ["code", "general"],
+        "cost_per_1k_tokens": 0.03,
+        "fallbacks": ["claude-3-opus-premium", "qwen-3-235b-free"]
     },
     "claude-3-opus-premium": {
         "name": "Claude 3 Opus",
@@ -96,7 +911,11 @@ AI_MODELS = {
         "type": "chat",
         "category": "premium",
         "max_tokens": 4000,
-        "timeout": 45
+        "context_tokens": 200000,
+        "timeout": 45,
+        "intents": ["creative", "general"],
+        "cost_per_1k_tokens": 0.075,
+        "fallbacks": ["gpt-4-1-premium", "qwen-3-235b-free"]
     },
     
     # Specialized Models
@@ -123,47 +942,165 @@ API_CONFIGS = {
     "openrouter": {
         "base_url": "https://openrouter.ai/api/v1",
         "api_key": os.getenv("OPENROUTER_API_KEY"),
+        "adapter": "openai",
+        "capabilities": ["chat", "stream"],
         "headers": {
             "HTTP-Referer": "https://ego-ai.com",
             "X-Title": "EGO AI Assistant"
+        },
+        "pool": {
+            "max_connections": 100,
+            "max_keepalive_connections": 20,
+            "keepalive_expiry": 60.0,
+            "http2": True
         }
     },
     "a4f": {
         "base_url": "https://api.a4f.dev/v1", 
         "api_key": os.getenv("A4F_API_KEY"),
-        "headers": {}
+        "adapter": "openai",
+        "capabilities": ["chat", "stream"],
+        "headers": {},
+        "pool": {
+            "max_connections": 50,
+            "max_keepalive_connections": 10,
+            "keepalive_expiry": 60.0,
+            "http2": True
+        }
     },
     "groq": {
         "base_url": "https://api.groq.com/openai/v1",
         "api_key": os.getenv("GROQ_API_KEY"),
-        "headers": {}
+        "adapter": "openai",
+        "capabilities": ["chat", "stream", "transcribe"],
+        "headers": {},
+        "pool": {
+            "max_connections": 50,
+            "max_keepalive_connections": 10,
+            "keepalive_expiry": 30.0,
+            "http2": True
+        }
     },
     "tavily": {
         "base_url": "https://api.tavily.com",
         "api_key": os.getenv("TAVILY_API_KEY"),
-        "headers": {}
+        "adapter": "tavily",
+        "capabilities": ["search"],
+        "headers": {},
+        "pool": {
+            "max_connections": 50,
+            "max_keepalive_connections": 10,
+            "keepalive_expiry": 30.0,
+            "http2": True
+        }
     }
 }
 
+# Default connection pool settings, overridable per provider via API_CONFIGS[...]["pool"]
+# or environment variables such as OPENROUTER_POOL_MAX_CONNECTIONS.
+DEFAULT_POOL_CONFIG = {
+    "max_connections": 100,
+    "max_keepalive_connections": 20,
+    "keepalive_expiry": 30.0,
+    "http2": True
+}
+
 # Request/Response Models
 class ChatMessage(BaseModel):
-    role: str = Field(..., regex="^(user|assistant|system)$")
+    role: str = Field(..., pattern="^(user|assistant|system)$")
     content: str = Field(..., min_length=1, max_length=10000)
 
-class ChatRequest(BaseModel):
-    messages: List[ChatMessage] = Field(..., min_items=1, max_items=50)
+class ChatOptions(BaseModel):
+    """Generation settings shared by stateless chat requests and conversation turns"""
     model: str = Field(..., min_length=1)
     temperature: Optional[float] = Field(0.7, ge=0.0, le=2.0)
     max_tokens: Optional[int] = Field(4000, ge=1, le=8000)
     behavior: Optional[str] = Field("", max_length=1000)
-    mode: Optional[str] = Field("normal", regex="^(normal|think|search)$")
+    mode: Optional[str] = Field("normal", pattern="^(normal|think|search)$")
+    plan: Optional[str] = Field("free", pattern="^(free|premium)$")
     user_id: Optional[str] = Field(None)
+    context_strategy: Optional[str] = Field(None)
     
-    @validator('model')
+    @field_validator('model')
+    @classmethod
     def validate_model(cls, v):
         if v not in AI_MODELS and v != "auto":
             raise ValueError(f"Invalid model: {v}")
         return v
+    
+    @field_validator('context_strategy')
+    @classmethod
+    def validate_context_strategy(cls, v):
+        if v is not None and v not in CONTEXT_STRATEGIES:
+            raise ValueError(f"Invalid context strategy: {v}")
+        return v
+    
+    @cached_property
+    def route(self) -> Dict:
+        """Routing decision for ``model="auto"``, made once per request"""
+        return model_router.route(self.last_message.content, self.mode, self.plan, self.max_tokens)
+
+class ChatRequest(ChatOptions):
+    messages: List[ChatMessage] = Field(..., min_length=1, max_length=50)
+    
+    @property
+    def last_message(self) -> ChatMessage:
+        return self.messages[-1]
+    
+    @cached_property
+    def message_dicts(self) -> List[Dict]:
+        """Messages as plain dicts, built once per request and shared read-only"""
+        return [{"role": msg.role, "content": msg.content} for msg in self.messages]
+    
+    # Conversation sessions keep the two below incrementally and fill them in
+    # directly (see build_conversation_chat_request)
+    @cached_property
+    def prefix_digest(self) -> bytes:
+        """Chained digest of every message before the last (see chain_message_digest)"""
+        digest = b""
+        for message in self.message_dicts[:-1]:
+            digest = chain_message_digest(digest, message)
+        return digest
+    
+    @cached_property
+    def known_token_counts(self) -> Optional[List[int]]:
+        """Per-message token counts aligned with message_dicts; stateless requests leave counting to fit_context"""
+        return None
+
+class BatchChatRequest(BaseModel):
+    # Items are validated one by one so a malformed item fails alone
+    requests: List[Any] = Field(..., min_length=1, max_length=100)
+    stream: Optional[bool] = Field(False)
+    _parsed: Optional[List[tuple]] = PrivateAttr(None)
+    
+    def parsed_items(self) -> List[tuple]:
+        """``(chat_request, model_key, error)`` per item, validated on first use"""
+        if self._parsed is None:
+            self._parsed = []
+            for item in self.requests:
+                try:
+                    self._parsed.append((*parse_batch_item(item), None))
+                except HTTPException as e:
+                    self._parsed.append((None, None, e))
+        return self._parsed
+
+class ConversationCreateRequest(BaseModel):
+    messages: List[ChatMessage] = Field(default_factory=list, max_length=200)
+
+class ConversationTurnRequest(ChatOptions):
+    message: ChatMessage
+    history_length: Optional[int] = Field(None, ge=0)
+    
+    @field_validator('message')
+    @classmethod
+    def validate_message(cls, v):
+        if v.role != "user":
+            raise ValueError("Conversation turns must be user messages")
+        return v
+    
+    @property
+    def last_message(self) -> ChatMessage:
+        return self.message
 
 class SearchRequest(BaseModel):
     query: str = Field(..., min_length=1, max_length=500)
@@ -172,6 +1109,8 @@ class SearchRequest(BaseModel):
     exclude_domains: Optional[List[str]] = Field(None)
 
 class APIResponse(BaseModel):
+    model_config = ConfigDict(protected_namespaces=())
+    
     success: bool
     data: Optional[Dict[str, Any]] = None
     error: Optional[str] = None
@@ -182,186 +1121,2754 @@ class APIResponse(BaseModel):
     tokens_used: Optional[int] = None
 
 # Cache utilities
+# Bump CACHE_FORMAT_VERSION whenever the key derivation or value encoding
+# changes; older entries then simply stop matching and expire on their own.
+CACHE_FORMAT_VERSION = 4
+CACHE_KEY_DIGEST_SIZE = 16
+CACHE_COMPRESS_THRESHOLD = int(os.getenv("CACHE_COMPRESS_THRESHOLD", "1024"))
+CACHE_COMPRESS_LEVEL = int(os.getenv("CACHE_COMPRESS_LEVEL", "6"))
+
+# Stale-while-revalidate: entries are kept CACHE_STALE_TTL seconds past their
+# TTL. A lookup that knows how to recompute its value serves such an entry
+# straight away and refreshes it in the background (once per key, through the
+# single-flight); plain lookups treat it as a miss.
+CACHE_STALE_TTL = int(os.getenv("CACHE_STALE_TTL", "600"))
+CHAT_CACHE_TTL = int(os.getenv("CHAT_CACHE_TTL", "3600"))
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", "1800"))
+
+# One-byte value headers, followed by a 4-byte big-endian unix time the value
+# is fresh until (0 when it never goes stale)
+CACHE_VALUE_RAW = b"j"
+CACHE_VALUE_ZLIB = b"z"
+CACHE_VALUE_PREFIX_SIZE = 5
+
 def get_cache_key(prefix: str, **kwargs) -> str:
-    """Generate cache key from parameters"""
-    key_parts = [prefix]
-    for k, v in sorted(kwargs.items()):
-        if isinstance(v, (list, dict)):
-            v = json.dumps(v, sort_keys=True)
-        key_parts.append(f"{k}:{v}")
-    return ":".join(key_parts)
-
-def cache_get(key: str) -> Optional[Dict]:
-    """Get value from cache"""
+    """Generate a fixed-size cache key from a digest of the canonical parameters"""
+    canonical = orjson.dumps(kwargs, option=orjson.OPT_SORT_KEYS)
+    digest = hashlib.blake2b(canonical, digest_size=CACHE_KEY_DIGEST_SIZE).hexdigest()
+    return f"{prefix}:v{CACHE_FORMAT_VERSION}:{digest}"
+
+def chain_message_digest(digest: bytes, message: Dict) -> bytes:
+    """Extend a conversation digest by one message
+    
+    Chat keys hash the conversation as a chain, so a session that already
+    holds the digest of its history only hashes the new message per turn,
+    and stateless requests with the same messages land on the same key.
+    """
+    hasher = hashlib.blake2b(digest, digest_size=CACHE_KEY_DIGEST_SIZE)
+    hasher.update(orjson.dumps(message, option=orjson.OPT_SORT_KEYS))
+    return hasher.digest()
+
+def encode_cache_value(value: Dict, fresh_until: int = 0) -> bytes:
+    """Serialize a cache value, compressing it above the size threshold"""
+    raw = orjson.dumps(value)
+    stamp = fresh_until.to_bytes(4, "big")
+    if len(raw) >= CACHE_COMPRESS_THRESHOLD:
+        return CACHE_VALUE_ZLIB + stamp + zlib.compress(raw, CACHE_COMPRESS_LEVEL)
+    return CACHE_VALUE_RAW + stamp + raw
+
+def decode_cache_bytes(value: bytes) -> bytes:
+    """Strip the header (and compression) from a cache value, leaving its JSON bytes"""
+    header, body = value[:1], value[CACHE_VALUE_PREFIX_SIZE:]
+    if header == CACHE_VALUE_ZLIB:
+        return zlib.decompress(body)
+    if header != CACHE_VALUE_RAW:
+        raise ValueError(f"Unknown cache value format: {header!r}")
+    return body
+
+def decode_cache_value(value: bytes) -> Dict:
+    """Inverse of encode_cache_value"""
+    return orjson.loads(decode_cache_bytes(value))
+
+def cache_value_fresh_until(value: bytes) -> int:
+    return int.from_bytes(value[1:CACHE_VALUE_PREFIX_SIZE], "big")
+
+def is_cache_value_stale(value: bytes) -> bool:
+    fresh_until = cache_value_fresh_until(value)
+    return fresh_until != 0 and fresh_until <= time.time()
+
+async def cache_get_raw(
+    key: str,
+    refresh: Optional[Callable[[], Awaitable[Dict]]] = None,
+    ttl: int = 3600
+) -> Optional[bytes]:
+    """Get a cached value as JSON bytes, without parsing it
+    
+    ``refresh`` recomputes the value. With it, a stale entry is returned
+    while a background refresh stores a new one for ``ttl`` seconds, and the
+    key is counted towards the cache warmer's popular set.
+    """
     try:
-        if CACHE_AVAILABLE:
-            value = cache.get(key)
-            return json.loads(value) if value else None
-        else:
-            return cache.get(key)
+        with timed_phase("cache"):
+            value = await cache.get(key)
+            if value and is_cache_value_stale(value):
+                # Another worker may already have refreshed it behind our L1 copy
+                await cache.evict_l1(key)
+                value = await cache.get(key)
+        result = "hit" if value else "miss"
+        if value and is_cache_value_stale(value):
+            if refresh is None:
+                value, result = None, "miss"
+            else:
+                singleflight.revalidate(key, refresh, ttl)
+                result = "stale"
+        if refresh is not None:
+            cache_warmer.record(key, refresh, ttl)
+        CACHE_LOOKUPS_TOTAL.labels(key.partition(":")[0], result).inc()
+        return decode_cache_bytes(value) if value else None
     except Exception as e:
         logger.error(f"Cache get error: {e}")
         return None
 
-def cache_set(key: str, value: Dict, ttl: int = 3600):
-    """Set value in cache with TTL"""
+async def cache_get(
+    key: str,
+    refresh: Optional[Callable[[], Awaitable[Dict]]] = None,
+    ttl: int = 3600
+) -> Optional[Dict]:
+    """Get value from cache"""
+    body = await cache_get_raw(key, refresh, ttl)
     try:
-        if CACHE_AVAILABLE:
-            cache.setex(key, ttl, json.dumps(value))
-        else:
-            cache[key] = value
+        return orjson.loads(body) if body else None
+    except orjson.JSONDecodeError as e:
+        logger.error(f"Cache get error: {e}")
+        return None
+
+def encode_api_response(data_json: Optional[bytes] = None, **fields) -> Response:
+    """Build an APIResponse body directly, splicing in ``data`` that is already JSON
+    
+    Skips model validation and re-encoding of the payload, so cached responses
+    are returned without being parsed.
+    """
+    with timed_phase("serialize"):
+        body = orjson.dumps(fields)
+        if data_json is not None:
+            body = b'{"data":' + data_json + (b"," + body[1:] if len(body) > 2 else b"}")
+        return Response(content=body, media_type="application/json")
+
+async def cache_set(key: str, value: Dict, ttl: int = 3600):
+    """Set value in cache with TTL, keeping it CACHE_STALE_TTL longer for revalidation"""
+    try:
+        fresh_until = int(time.time()) + ttl if CACHE_STALE_TTL > 0 else 0
+        await cache.set(key, encode_cache_value(value, fresh_until), ttl + CACHE_STALE_TTL)
     except Exception as e:
         logger.error(f"Cache set error: {e}")
 
-# API Client utilities
-async def make_api_request(
-    provider: str,
-    endpoint: str,
-    payload: Dict,
-    timeout: int = 30
-) -> Dict:
-    """Make API request to AI provider"""
-    config = API_CONFIGS.get(provider)
-    if not config or not config["api_key"]:
-        raise HTTPException(
-            status_code=500,
-            detail=f"Provider {provider} not configured or missing API key"
-        )
+# Request coalescing (single-flight)
+SINGLEFLIGHT_LEASE_MS = int(os.getenv("SINGLEFLIGHT_LEASE_MS", "60000"))
+SINGLEFLIGHT_POLL_INTERVAL = float(os.getenv("SINGLEFLIGHT_POLL_INTERVAL", "0.1"))
+
+class Flight:
+    """One in-progress upstream call and the requests waiting on it"""
     
-    headers = {
-        "Authorization": f"Bearer {config['api_key']}",
-        "Content-Type": "application/json",
-        **config["headers"]
-    }
+    def __init__(self):
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.task: Optional[asyncio.Task] = None
+        self.waiters = 0
+
+class SingleFlight:
+    """Share one upstream call between concurrent identical requests
+    
+    Requests in the same worker wait on a shared future. Across workers, the
+    first one to take a short Redis lease makes the call and the others poll
+    the cache for its result until the lease goes away.
+    """
+    
+    def __init__(self):
+        self._flights: Dict[str, Flight] = {}
+        self._background: set = set()
+        self.upstream_calls = 0
+        self.coalesced_local = 0
+        self.coalesced_remote = 0
+        self.revalidations = 0
     
-    url = f"{config['base_url']}/{endpoint.lstrip('/')}"
+    def in_flight(self, key: str) -> bool:
+        """Whether a call for ``key`` is running in this worker, so ``do`` would join it"""
+        return key in self._flights
     
-    async with httpx.AsyncClient(timeout=timeout) as client:
+    async def do(self, key: str, fn, ttl: int, on_done: Optional[Callable[[], None]] = None) -> tuple:
+        """Return ``(value, source)`` where source is upstream, coalesced or remote
+        
+        ``on_done`` runs once the call this request starts is over, whether or
+        not ``fn`` ran; it is ignored when the request joins a running call.
+        """
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = Flight()
+            self._flights[key] = flight
+            flight.task = asyncio.create_task(self._run(key, flight, fn, ttl))
+            if on_done is not None:
+                flight.task.add_done_callback(lambda _: on_done())
+            is_leader = True
+        else:
+            self.coalesced_local += 1
+            is_leader = False
+        
+        flight.waiters += 1
         try:
-            response = await client.post(url, json=payload, headers=headers)
-            response.raise_for_status()
-            return response.json()
-        except httpx.TimeoutException:
-            raise HTTPException(status_code=408, detail="Request timeout")
-        except httpx.HTTPStatusError as e:
-            error_detail = f"API error: {e.response.status_code}"
-            try:
-                error_data = e.response.json()
-                error_detail += f" - {error_data.get('error', {}).get('message', 'Unknown error')}"
-            except:
-                pass
-            raise HTTPException(status_code=e.response.status_code, detail=error_detail)
+            value, source = await asyncio.shield(flight.future)
+        except asyncio.CancelledError:
+            flight.waiters -= 1
+            # Nobody is left to read the result, so stop the upstream call too
+            if flight.waiters == 0 and not flight.task.done():
+                flight.task.cancel()
+            raise
+        flight.waiters -= 1
+        return value, source if is_leader else "coalesced"
+    
+    async def _run(self, key: str, flight: Flight, fn, ttl: int):
+        lease_key = f"lease:{key}"
+        token = None
+        try:
+            token = await cache.acquire_lease(lease_key, SINGLEFLIGHT_LEASE_MS)
+            if token is None:
+                value = await self._wait_for_remote(key, lease_key)
+                if value is not None:
+                    self.coalesced_remote += 1
+                    flight.future.set_result((value, "remote"))
+                    return
+            
+            self.upstream_calls += 1
+            value = await fn()
+            flight.future.set_result((value, "upstream"))
+            # Publish for other workers before giving up the lease
+            await cache_set(key, value, ttl)
+        except asyncio.CancelledError:
+            if not flight.future.done():
+                flight.future.cancel()
+            raise
+        except BaseException as e:
+            if not flight.future.done():
+                flight.future.set_exception(e)
+        finally:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            if token:
+                release = asyncio.create_task(cache.release_lease(lease_key, token))
+                self._background.add(release)
+                release.add_done_callback(self._background.discard)
+    
+    def revalidate(self, key: str, fn, ttl: int):
+        """Refresh a stale entry in the background, unless a call for it is already in flight"""
+        if key in self._flights:
+            return
+        self.revalidations += 1
+        task = asyncio.create_task(self._revalidate(key, fn, ttl))
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+    
+    async def _revalidate(self, key: str, fn, ttl: int):
+        # Nobody is waiting on a refresh, whoever's lookup triggered it
+        current_admission.set(BACKGROUND_ADMISSION)
+        try:
+            await self.do(key, fn, ttl)
         except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Request failed: {str(e)}")
-
-# AI Service functions
-async def call_openrouter(model_id: str, messages: List[Dict], **kwargs) -> Dict:
-    """Call OpenRouter API"""
-    payload = {
-        "model": model_id,
-        "messages": messages,
-        "temperature": kwargs.get("temperature", 0.7),
-        "max_tokens": kwargs.get("max_tokens", 4000)
-    }
+            logger.warning(f"Background refresh of {key} failed: {e}")
     
-    response = await make_api_request(
-        "openrouter", 
-        "chat/completions", 
-        payload,
-        timeout=kwargs.get("timeout", 30)
-    )
+    async def _wait_for_remote(self, key: str, lease_key: str) -> Optional[Dict]:
+        """Poll for another worker's result while it holds the lease"""
+        deadline = time.monotonic() + SINGLEFLIGHT_LEASE_MS / 1000
+        while time.monotonic() < deadline:
+            await asyncio.sleep(SINGLEFLIGHT_POLL_INTERVAL)
+            value = await cache_get(key)
+            if value is not None:
+                return value
+            if not await cache.lease_exists(lease_key):
+                return await cache_get(key)
+        return None
     
-    return {
-        "content": response["choices"][0]["message"]["content"],
-        "tokens": response.get("usage", {}).get("total_tokens", 0)
-    }
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": len(self._flights),
+            "upstream_calls": self.upstream_calls,
+            "coalesced_local": self.coalesced_local,
+            "coalesced_remote": self.coalesced_remote,
+            "upstream_calls_saved": self.coalesced_local + self.coalesced_remote,
+            "revalidations": self.revalidations
+        }
 
-async def call_a4f(model_id: str, messages: List[Dict], **kwargs) -> Dict:
-    """Call A4F API"""
-    payload = {
-        "model": model_id,
-        "messages": messages,
-        "temperature": kwargs.get("temperature", 0.7),
-        "max_tokens": kwargs.get("max_tokens", 4000)
-    }
+singleflight = SingleFlight()
+
+# Cache warming
+# Lookups that can recompute their value (web search, chat completions) are
+# counted in a Space-Saving heavy-hitters sketch of CACHE_WARMER_TRACKED_KEYS
+# slots, so only the most popular keys are remembered with their refresh
+# function. Every CACHE_WARMER_INTERVAL seconds counts decay, and tracked keys
+# seen at least CACHE_WARMER_MIN_HITS times that are missing or go stale
+# within CACHE_WARMER_LEAD_TIME are refreshed, most popular first, spending
+# at most CACHE_WARMER_BUDGET upstream calls per minute.
+CACHE_WARMER_ENABLED = os.getenv("CACHE_WARMER_ENABLED", "true").lower() in ("1", "true", "yes")
+CACHE_WARMER_INTERVAL = float(os.getenv("CACHE_WARMER_INTERVAL", "30"))
+CACHE_WARMER_TRACKED_KEYS = int(os.getenv("CACHE_WARMER_TRACKED_KEYS", "256"))
+CACHE_WARMER_MIN_HITS = float(os.getenv("CACHE_WARMER_MIN_HITS", "3"))
+CACHE_WARMER_LEAD_TIME = float(os.getenv("CACHE_WARMER_LEAD_TIME", "120"))
+CACHE_WARMER_BUDGET = float(os.getenv("CACHE_WARMER_BUDGET", "20"))  # upstream calls per minute
+CACHE_WARMER_CONCURRENCY = int(os.getenv("CACHE_WARMER_CONCURRENCY", "4"))
+CACHE_WARMER_DECAY = float(os.getenv("CACHE_WARMER_DECAY", "0.9"))
+
+CACHE_WARMER_REFRESHES_TOTAL = metrics.counter(
+    "ego_cache_warmer_refreshes_total", "Proactive cache refreshes by namespace and result", ("namespace", "result")
+)
+
+class HeavyHitter:
+    """One tracked key: its decayed count, the overestimate it inherited, and how to refresh it"""
+    __slots__ = ("count", "error", "refresh", "ttl")
     
-    response = await make_api_request(
-        "a4f",
-        "chat/completions",
-        payload, 
-        timeout=kwargs.get("timeout", 45)
-    )
+    def __init__(self, count: float, error: float, refresh, ttl: int):
+        self.count = count
+        self.error = error
+        self.refresh = refresh
+        self.ttl = ttl
+
+class CacheWarmer:
+    """Keep the most requested cache entries fresh ahead of their expiry"""
     
-    return {
-        "content": response["choices"][0]["message"]["content"],
-        "tokens": response.get("usage", {}).get("total_tokens", 0)
-    }
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.tracked: Dict[str, HeavyHitter] = {}
+        self.credit = 0.0
+        self.refreshes = 0
+        self.failures = 0
+        self.skipped_budget = 0
+        self._task: Optional[asyncio.Task] = None
+    
+    def record(self, key: str, refresh, ttl: int):
+        """Count one lookup (Space-Saving: a new key takes over the smallest slot and its count)"""
+        entry = self.tracked.get(key)
+        if entry is not None:
+            entry.count += 1
+            entry.refresh = refresh
+            return
+        if len(self.tracked) < self.capacity:
+            self.tracked[key] = HeavyHitter(1, 0, refresh, ttl)
+            return
+        smallest = min(self.tracked, key=lambda k: self.tracked[k].count)
+        floor = self.tracked.pop(smallest).count
+        self.tracked[key] = HeavyHitter(floor + 1, floor, refresh, ttl)
+    
+    def popular(self) -> List[str]:
+        """Tracked keys whose guaranteed count reaches CACHE_WARMER_MIN_HITS, most popular first"""
+        keys = [k for k, e in self.tracked.items() if e.count - e.error >= CACHE_WARMER_MIN_HITS]
+        return sorted(keys, key=lambda k: self.tracked[k].count, reverse=True)
+    
+    async def needs_refresh(self, key: str) -> bool:
+        try:
+            value = await cache.get(key)
+        except Exception as e:
+            logger.error(f"Cache get error: {e}")
+            return False
+        if not value:
+            return True
+        fresh_until = cache_value_fresh_until(value)
+        return fresh_until != 0 and fresh_until - time.time() <= CACHE_WARMER_LEAD_TIME
+    
+    async def refresh(self, key: str, entry: HeavyHitter, semaphore: asyncio.Semaphore):
+        namespace = key.partition(":")[0]
+        current_admission.set(BACKGROUND_ADMISSION)
+        async with semaphore:
+            try:
+                await singleflight.do(key, entry.refresh, entry.ttl)
+            except Exception as e:
+                self.failures += 1
+                CACHE_WARMER_REFRESHES_TOTAL.labels(namespace, "error").inc()
+                logger.warning(f"Cache warmer refresh of {key} failed: {e}")
+                return
+        self.refreshes += 1
+        CACHE_WARMER_REFRESHES_TOTAL.labels(namespace, "ok").inc()
+    
+    async def run_once(self):
+        """Refresh what is about to expire within this interval's budget, then decay counts"""
+        allowance = CACHE_WARMER_BUDGET * CACHE_WARMER_INTERVAL / 60
+        self.credit = min(self.credit + allowance, max(allowance, 1.0))
+        due = []
+        # Entries are taken up front since lookups keep updating the sketch meanwhile
+        for key, entry in [(key, self.tracked[key]) for key in self.popular()]:
+            if not await self.needs_refresh(key):
+                continue
+            if self.credit < 1:
+                self.skipped_budget += 1
+                continue
+            due.append((key, entry))
+            self.credit -= 1
+        if due:
+            semaphore = asyncio.Semaphore(CACHE_WARMER_CONCURRENCY)
+            await asyncio.gather(*(self.refresh(key, entry, semaphore) for key, entry in due))
+        
+        for key in list(self.tracked):
+            entry = self.tracked[key]
+            entry.count *= CACHE_WARMER_DECAY
+            entry.error *= CACHE_WARMER_DECAY
+            if entry.count < 0.5:
+                del self.tracked[key]
+    
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(CACHE_WARMER_INTERVAL)
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"Cache warmer error: {e}")
+    
+    def start(self):
+        if CACHE_WARMER_ENABLED and self._task is None:
+            self._task = asyncio.create_task(self._loop())
+    
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": CACHE_WARMER_ENABLED,
+            "tracked_keys": len(self.tracked),
+            "popular_keys": len(self.popular()),
+            "refreshes": self.refreshes,
+            "failures": self.failures,
+            "skipped_over_budget": self.skipped_budget
+        }
+
+cache_warmer = CacheWarmer(CACHE_WARMER_TRACKED_KEYS)
+
+# Rate limiting
+# Token buckets live in Redis so every worker shares them, and fall back to
+# per-worker buckets while Redis is down. Every request draws from buckets for
+# its client address, and also from buckets for its user_id when the body
+# carries one; user_id is not authenticated, so a client cannot reset its
+# budget by sending a new one. Chat requests also draw from a budget for the
+# model category they resolve to. All of a request's buckets are checked in a
+# single script call.
+CATEGORY_RATE_LIMITS = {
+    "free": os.getenv("RATE_LIMIT_FREE", "60/minute"),
+    "premium": os.getenv("RATE_LIMIT_PREMIUM", "20/minute")
+}
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() in ("1", "true", "yes")
+RATE_LIMIT_LOCAL_MAX_KEYS = int(os.getenv("RATE_LIMIT_LOCAL_MAX_KEYS", "10000"))
+TRUST_FORWARDED_FOR = os.getenv("TRUST_FORWARDED_FOR", "false").lower() == "true"
+RATE_PERIODS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+_RATE_PATTERN = re.compile(r"^\s*(\d+)\s*(?:/|per)\s*(\d*)\s*(second|minute|hour|day)s?\s*$")
+
+RATE_LIMITED_TOTAL = metrics.counter("ego_rate_limited_total", "Requests rejected by the rate limiter by scope", ("scope",))
+
+def parse_rate(rate: str) -> tuple:
+    """Parse ``"30/minute"`` or ``"100 per 2 hours"`` into ``(count, period seconds)``"""
+    match = _RATE_PATTERN.match(rate)
+    if not match:
+        raise ValueError(f"Invalid rate limit: {rate}")
+    count, multiplier, unit = match.groups()
+    return int(count), int(multiplier or 1) * RATE_PERIODS[unit]
+
+def get_client_address(request: Request) -> str:
+    if TRUST_FORWARDED_FOR:
+        forwarded = request.headers.get("x-forwarded-for")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else "127.0.0.1"
+
+def get_model_category(chat_request: ChatOptions) -> Optional[str]:
+    try:
+        return AI_MODELS[resolve_model_key(chat_request)]["category"]
+    except HTTPException:
+        return None
+
+def get_rate_limit_usage(body: Optional[BaseModel]) -> tuple:
+    """Return ``(user_id, cost, {category: cost})`` for a parsed request body"""
+    if isinstance(body, (ChatRequest, ConversationTurnRequest)):
+        category = get_model_category(body)
+        return body.user_id, 1, {category: 1} if category else {}
+    if isinstance(body, BatchChatRequest):
+        categories: Dict[str, int] = {}
+        items = [(item, model_key) for item, model_key, error in body.parsed_items() if error is None]
+        for item, model_key in items:
+            category = AI_MODELS[model_key]["category"]
+            categories[category] = categories.get(category, 0) + 1
+        user_id = next((item.user_id for item, _ in items if item.user_id), None)
+        return user_id, len(body.requests), categories
+    return None, 1, {}
+
+class RateLimiter:
+    """Route and model-category token buckets in the shared cache store"""
+    
+    def __init__(self, category_limits: Dict[str, str]):
+        self.category_limits = {category: parse_rate(rate) for category, rate in category_limits.items()}
+        self.local: OrderedDict = OrderedDict()
+        self.allowed = 0
+        self.limited = 0
+        self.local_checks = 0
+    
+    def limit(self, rate: str, scope: Optional[str] = None):
+        """Decorate an endpoint (which must take ``request``) with a per-route limit"""
+        count, period = parse_rate(rate)
+        
+        def decorator(func):
+            route_scope = scope or func.__name__
+            
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                mark_validated()
+                body = next((v for v in kwargs.values() if isinstance(v, BaseModel)), None)
+                user_id, cost, categories = get_rate_limit_usage(body)
+                with timed_phase("ratelimit"):
+                    await self.check(kwargs["request"], route_scope, count, period, cost, user_id, categories)
+                return await func(*args, **kwargs)
+            return wrapper
+        return decorator
+    
+    async def check(
+        self,
+        request: Request,
+        scope: str,
+        count: int,
+        period: int,
+        cost: int = 1,
+        user_id: Optional[str] = None,
+        categories: Optional[Dict[str, int]] = None
+    ):
+        """Take tokens for a request or raise 429; the outcome is left on ``request.state.rate_limit``"""
+        if not RATE_LIMIT_ENABLED:
+            return
+        identities = [f"ip:{get_client_address(request)}"]
+        if user_id:
+            identities.append(f"user:{user_id}")
+        buckets = []
+        for identity in identities:
+            buckets.append((f"ratelimit:{scope}:{identity}", count, count / (period * 1000), cost))
+            for category, category_cost in (categories or {}).items():
+                if category in self.category_limits:
+                    category_count, category_period = self.category_limits[category]
+                    buckets.append((
+                        f"ratelimit:category:{category}:{identity}",
+                        category_count,
+                        category_count / (category_period * 1000),
+                        category_cost
+                    ))
+        
+        result = await cache.take_tokens(
+            [bucket[0] for bucket in buckets],
+            [value for bucket in buckets for value in bucket[1:]]
+        )
+        if result is None:
+            self.local_checks += 1
+            result = self._take_local(buckets)
+        allowed, tightest, remaining, retry_ms, reset_ms = (int(value) for value in result)
+        
+        request.state.rate_limit = {
+            "limit": buckets[tightest - 1][1],
+            "remaining": max(remaining, 0),
+            "reset": math.ceil(reset_ms / 1000)
+        }
+        if not allowed:
+            self.limited += 1
+            RATE_LIMITED_TOTAL.labels(scope).inc()
+            raise HTTPException(
+                status_code=429,
+                detail=f"Rate limit exceeded for {scope}",
+                headers={"Retry-After": str(max(math.ceil(retry_ms / 1000), 1))}
+            )
+        self.allowed += 1
+    
+    def _take_local(self, buckets: List[tuple]) -> List[float]:
+        """In-process version of TOKEN_BUCKET_SCRIPT"""
+        now = time.time() * 1000
+        levels = []
+        allowed = 1
+        retry_ms = 0.0
+        for key, capacity, rate, cost in buckets:
+            level, updated = self.local.get(key, (capacity, now))
+            level = min(capacity, level + max(now - updated, 0) * rate)
+            if level < cost:
+                allowed = 0
+                retry_ms = max(retry_ms, (cost - level) / rate)
+            levels.append(level)
+        
+        tightest, remaining, reset_ms = 1, None, 0.0
+        for index, ((key, capacity, rate, cost), level) in enumerate(zip(buckets, levels), 1):
+            if allowed:
+                level -= cost
+                self.local[key] = (level, now)
+                self.local.move_to_end(key)
+            if remaining is None or level < remaining:
+                tightest, remaining, reset_ms = index, level, (capacity - level) / rate
+        
+        while len(self.local) > RATE_LIMIT_LOCAL_MAX_KEYS:
+            self.local.popitem(last=False)
+        return [allowed, tightest, math.floor(remaining), math.ceil(retry_ms), math.ceil(reset_ms)]
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": cache.backend.name,
+            "allowed": self.allowed,
+            "limited": self.limited,
+            "local_checks": self.local_checks,
+            "local_buckets": len(self.local),
+            "category_limits": CATEGORY_RATE_LIMITS
+        }
+
+limiter = RateLimiter(CATEGORY_RATE_LIMITS)
+
+# Semantic (embedding-based) response cache
+# Optional tier behind the exact-match cache: the final user turn is embedded
+# locally with a hashed n-gram model (no network, no model download) and
+# compared against recent prompts that share the same model, behavior,
+# temperature and earlier history. Vectors live in memory-mapped files under
+# SEMANTIC_CACHE_PATH, so the index survives restarts; it is a fixed-size ring.
+# Key tokens of the final turn - anything with a digit, and identifier-like
+# tokens such as paths, URLs, snake_case or camelCase names - must match
+# exactly as part of the scope, since they change the answer while barely
+# moving the vector ("port 3000" vs "port 8080").
+#
+# The threshold trades hit rate for wrong answers. The embedding measures word
+# overlap, not meaning: one changed ordinary word in a long prompt still scores
+# around 0.98 ("written in node" vs "written in python"), while short rewordings
+# of the same question score 0.8-0.9. Lowering it below the default mostly adds
+# false positives; keep the tier off where a wrong cached answer is costly.
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+SEMANTIC_CACHE_CAPACITY = int(os.getenv("SEMANTIC_CACHE_CAPACITY", "20000"))
+SEMANTIC_CACHE_DIM = int(os.getenv("SEMANTIC_CACHE_DIM", "512"))
+SEMANTIC_CACHE_PATH = os.getenv("SEMANTIC_CACHE_PATH", "semantic_cache")
+SEMANTIC_EMBED_MAX_CHARS = 2000
+SEMANTIC_KEY_SIZE = 64
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+_WORD_PATTERN = re.compile(r"\w+", re.UNICODE)
+_KEY_TOKEN_PATTERN = re.compile(r"\d|[_./:@#$\\]|[a-z][A-Z]")
+
+def semantic_key_tokens(text: str) -> List[str]:
+    """Tokens that must match exactly for a semantic hit: numbers and identifier-like tokens"""
+    tokens = (token.strip(".,;:!?()[]{}\"'`") for token in text[:SEMANTIC_EMBED_MAX_CHARS].split())
+    return sorted({token for token in tokens if token and _KEY_TOKEN_PATTERN.search(token)})
+
+def embed_text(text: str, dim: int = SEMANTIC_CACHE_DIM):
+    """Signed feature-hashing embedding of words, word bigrams and character trigrams"""
+    words = _WORD_PATTERN.findall(text.lower()[:SEMANTIC_EMBED_MAX_CHARS])
+    features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+    trigrams = [w[i:i + 3] for w in (f"#{w}#" for w in words) for i in range(len(w) - 2)]
+    weights = np.concatenate([
+        np.ones(len(features), dtype=np.float32),
+        np.full(len(trigrams), 0.5, dtype=np.float32)
+    ])
+    features += trigrams
+    if not features:
+        return np.zeros(dim, dtype=np.float32)
+    
+    hashes = np.fromiter((zlib.crc32(f.encode()) for f in features), dtype=np.uint32, count=len(features))
+    signs = np.where(hashes & 0x80000000, 1.0, -1.0).astype(np.float32)
+    vector = np.bincount(hashes % dim, weights=signs * weights, minlength=dim).astype(np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+class SemanticCache:
+    """Bounded nearest-neighbour index from prompt embeddings to exact cache keys"""
+    
+    def __init__(self, path: str, capacity: int, dim: int, threshold: float):
+        self.path = path
+        self.capacity = capacity
+        self.dim = dim
+        self.threshold = threshold
+        self.enabled = False
+        self.lookups = 0
+        self.hits = 0
+        self.lookup_seconds = 0.0
+    
+    def open(self):
+        """Map the index files, creating or resetting them if the shape changed"""
+        if np is None:
+            logger.warning("numpy not installed, semantic cache disabled")
+            return
+        os.makedirs(self.path, exist_ok=True)
+        shapes = {
+            "vectors": (np.float32, (self.capacity, self.dim)),
+            "scopes": (np.int64, (self.capacity,)),
+            "keys": (f"S{SEMANTIC_KEY_SIZE}", (self.capacity,)),
+            "state": (np.int64, (2,))  # [next slot, entries]
+        }
+        arrays = {}
+        for name, (dtype, shape) in shapes.items():
+            filename = os.path.join(self.path, f"{name}.bin")
+            expected = int(np.dtype(dtype).itemsize * np.prod(shape))
+            mode = "r+" if os.path.exists(filename) and os.path.getsize(filename) == expected else "w+"
+            arrays[name] = np.memmap(filename, dtype=dtype, mode=mode, shape=shape)
+        if any(a.mode == "w+" for a in arrays.values()):
+            # A partial or resized index is worthless; start clean
+            for array in arrays.values():
+                array[:] = 0
+        self.vectors = arrays["vectors"]
+        self.scopes = arrays["scopes"]
+        self.keys = arrays["keys"]
+        self.state = arrays["state"]
+        self._lock_path = os.path.join(self.path, "write.lock")
+        self.enabled = True
+        logger.info(f"Semantic cache ready with {int(self.state[1])} entries")
+    
+    def close(self):
+        if self.enabled:
+            for array in (self.vectors, self.scopes, self.keys, self.state):
+                array.flush()
+            self.enabled = False
+    
+    def warm(self):
+        """Fault the used part of the index into memory so first lookups skip disk reads"""
+        if self.enabled:
+            entries = int(self.state[1])
+            float(self.vectors[:entries].sum())
+            int(self.scopes[:entries].sum())
+    
+    def lookup(self, scope: int, vector) -> Optional[tuple]:
+        """Return ``(cache_key, similarity)`` of the closest entry above threshold"""
+        start = time.perf_counter()
+        self.lookups += 1
+        try:
+            entries = int(self.state[1])
+            if not entries:
+                return None
+            candidates = np.flatnonzero(self.scopes[:entries] == scope)
+            if not len(candidates):
+                return None
+            similarities = self.vectors[candidates] @ vector
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                return None
+            self.hits += 1
+            return self.keys[candidates[best]].decode(), float(similarities[best])
+        finally:
+            elapsed = time.perf_counter() - start
+            self.lookup_seconds += elapsed
+            SEMANTIC_LOOKUP_DURATION.labels().observe(elapsed)
+    
+    def add(self, scope: int, vector, cache_key: str):
+        # Workers share the files; serialize writers on a lock file. The scope is
+        # written last so readers never match a half-written slot. This blocks on
+        # other writers, so call it from a thread rather than the event loop.
+        with open(self._lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            slot = int(self.state[0])
+            self.scopes[slot] = 0
+            self.vectors[slot] = vector
+            self.keys[slot] = cache_key.encode()[:SEMANTIC_KEY_SIZE]
+            self.scopes[slot] = scope
+            self.state[0] = (slot + 1) % self.capacity
+            self.state[1] = min(int(self.state[1]) + 1, self.capacity)
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "entries": int(self.state[1]) if self.enabled else 0,
+            "capacity": self.capacity,
+            "threshold": self.threshold,
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_ratio": self.hits / self.lookups if self.lookups else 0.0,
+            "avg_lookup_ms": self.lookup_seconds / self.lookups * 1000 if self.lookups else 0.0
+        }
+
+semantic_cache = SemanticCache(
+    SEMANTIC_CACHE_PATH, SEMANTIC_CACHE_CAPACITY, SEMANTIC_CACHE_DIM, SEMANTIC_CACHE_THRESHOLD
+)
+SEMANTIC_LOOKUP_DURATION = metrics.histogram(
+    "ego_semantic_lookup_seconds", "Semantic cache lookup latency",
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05)
+)
+
+# HTTP client pools (one long-lived client per provider)
+http_clients: Dict[str, httpx.AsyncClient] = {}
+
+def get_provider_options(provider: str, section: str, defaults: Dict[str, Any]) -> Dict[str, Any]:
+    """Resolve a provider settings section (defaults < API_CONFIGS < env ``<PROVIDER>_<SECTION>_<OPTION>``)"""
+    options = {**defaults, **API_CONFIGS.get(provider, {}).get(section, {})}
+    for option, default in list(options.items()):
+        env_value = os.getenv(f"{provider.upper()}_{section.upper()}_{option.upper()}")
+        if env_value is None:
+            continue
+        if isinstance(default, bool):
+            options[option] = env_value.lower() in ("1", "true", "yes")
+        else:
+            options[option] = type(default)(env_value)
+    return options
+
+def get_pool_config(provider: str) -> Dict[str, Any]:
+    """Resolve pool settings for a provider"""
+    return get_provider_options(provider, "pool", DEFAULT_POOL_CONFIG)
+
+def create_http_client(provider: str) -> httpx.AsyncClient:
+    """Create a pooled, keep-alive HTTP client for a provider"""
+    pool_config = get_pool_config(provider)
+    limits = httpx.Limits(
+        max_connections=pool_config["max_connections"],
+        max_keepalive_connections=pool_config["max_keepalive_connections"],
+        keepalive_expiry=pool_config["keepalive_expiry"]
+    )
+    http2 = pool_config["http2"]
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            logger.warning(f"h2 package not installed, using HTTP/1.1 for {provider}")
+            http2 = False
+    
+    return httpx.AsyncClient(
+        base_url=API_CONFIGS[provider]["base_url"],
+        limits=limits,
+        http2=http2,
+        timeout=httpx.Timeout(30.0, connect=10.0)
+    )
+
+def get_http_client(provider: str) -> httpx.AsyncClient:
+    """Get the shared client for a provider, creating it on first use"""
+    client = http_clients.get(provider)
+    if client is None or client.is_closed:
+        client = create_http_client(provider)
+        http_clients[provider] = client
+    return client
+
+async def open_http_clients():
+    """Create client pools for every configured provider"""
+    for provider in API_CONFIGS:
+        get_http_client(provider)
+    logger.info(f"HTTP client pools ready for: {', '.join(http_clients)}")
+
+async def close_http_clients():
+    """Close all provider client pools"""
+    clients = list(http_clients.values())
+    http_clients.clear()
+    await asyncio.gather(*(client.aclose() for client in clients), return_exceptions=True)
+
+def get_pool_stats() -> Dict[str, Dict[str, Any]]:
+    """Report open, idle and waiting connections for each provider pool"""
+    stats = {}
+    for provider in API_CONFIGS:
+        pool_config = get_pool_config(provider)
+        client = http_clients.get(provider)
+        # httpx does not expose pool state publicly; read it from the httpcore pool
+        pool = getattr(getattr(client, "_transport", None), "_pool", None)
+        connections = list(getattr(pool, "connections", []))
+        pending = list(getattr(pool, "_requests", []))
+        stats[provider] = {
+            "active": client is not None and not client.is_closed,
+            "open_connections": len(connections),
+            "idle_connections": len([c for c in connections if c.is_idle()]),
+            "waiting_requests": len([r for r in pending if r.connection is None]),
+            "http2_connections": len([c for c in connections if "HTTP/2" in repr(c)]),
+            "max_connections": pool_config["max_connections"],
+            "max_keepalive_connections": pool_config["max_keepalive_connections"],
+            "keepalive_expiry": pool_config["keepalive_expiry"]
+        }
+    return stats
+
+# Provider protection: circuit breakers and adaptive concurrency limits
+# Defaults apply to every provider; API_CONFIGS[...]["breaker"] and
+# API_CONFIGS[...]["concurrency"] can override individual settings.
+DEFAULT_BREAKER_CONFIG = {
+    "window": 30.0,            # seconds of outcomes considered
+    "min_calls": 10,           # don't judge on fewer calls than this
+    "failure_threshold": 0.5,  # failure ratio that opens the circuit
+    "open_duration": 15.0,     # seconds to stay open before probing
+    "half_open_probes": 2      # probe calls allowed (and needed to close) when half-open
+}
+DEFAULT_CONCURRENCY_CONFIG = {
+    "initial_limit": 20,
+    "min_limit": 2,
+    "max_limit": None,         # defaults to the provider's pool max_connections
+    "backoff": 0.7,            # multiplicative decrease on overload
+    "max_queue": 100,
+    "queue_timeout": 30.0      # longest any call may wait, whatever its admission class
+}
+
+# Admission scheduling
+# Calls that find a provider at its concurrency limit queue for a slot. The
+# queue is weighted fair queuing over flows keyed on user_id (the client
+# address without one): each queued call gets a virtual finish time of
+# max(now, its flow's last finish) + 1/weight and slots go to the smallest, so
+# a user with many calls in flight takes turns with everybody else instead of
+# filling the queue ahead of them. The weight and longest acceptable wait come
+# from the call's admission class: "premium" for premium-plan requests to a
+# premium-category model, "free" for every other interactive request, and
+# "background" only where it is set explicitly (batch items and cache
+# refreshes). The plan field is client-supplied and not verified yet, so
+# anyone can claim it; capping it at the model's category keeps a free model
+# call from jumping the queue on a claimed plan. A call is shed with 503
+# and Retry-After when its expected wait already exceeds its class's
+# max_wait, when it is still queued at that deadline, or when the queue is
+# full of calls that are all ahead of it; a full queue instead evicts its
+# last call when the newcomer would be served first.
+ADMISSION_CLASSES = {
+    "premium": {
+        "weight": float(os.getenv("ADMISSION_WEIGHT_PREMIUM", "4")),
+        "max_wait": float(os.getenv("ADMISSION_MAX_WAIT_PREMIUM", "10"))
+    },
+    "free": {
+        "weight": float(os.getenv("ADMISSION_WEIGHT_FREE", "1")),
+        "max_wait": float(os.getenv("ADMISSION_MAX_WAIT_FREE", "5"))
+    },
+    "background": {
+        "weight": float(os.getenv("ADMISSION_WEIGHT_BACKGROUND", "0.25")),
+        "max_wait": float(os.getenv("ADMISSION_MAX_WAIT_BACKGROUND", "30"))
+    }
+}
+
+ADMISSION_WAIT = metrics.histogram(
+    "ego_admission_wait_seconds", "Time calls waited for a provider slot by provider and class", ("provider", "class")
+)
+ADMISSION_SHED_TOTAL = metrics.counter(
+    "ego_admission_shed_total", "Calls shed before reaching a provider by provider, class and reason",
+    ("provider", "class", "reason")
+)
+
+class Admission:
+    """Who a provider call is made for: its admission class and fair-queuing flow"""
+    __slots__ = ("priority", "flow")
+    
+    def __init__(self, priority: str, flow: str):
+        self.priority = priority
+        self.flow = flow
+
+BACKGROUND_ADMISSION = Admission("background", "background")
+# Calls made outside any admitted request are treated as interactive
+current_admission: ContextVar[Admission] = ContextVar("current_admission", default=Admission("free", "unadmitted"))
+
+def get_admission_class(chat_request: Optional[ChatOptions]) -> str:
+    # plan is untrusted until plan verification exists; it can only lift a
+    # call to premium on a premium-category model
+    if chat_request is not None and chat_request.plan == "premium" and get_model_category(chat_request) == "premium":
+        return "premium"
+    return "free"
+
+def admit_request(request: Request, chat_request: Optional[ChatOptions] = None, priority: Optional[str] = None):
+    """Tag the provider calls made for this request with its admission class and flow"""
+    priority = priority or get_admission_class(chat_request)
+    user_id = chat_request.user_id if chat_request is not None else None
+    current_admission.set(Admission(priority, user_id or get_client_address(request)))
+
+def is_provider_failure(error: HTTPException) -> bool:
+    """Whether an upstream error indicates the provider is struggling"""
+    return error.status_code in (408, 429) or error.status_code >= 500
+
+class CircuitBreaker:
+    """Open on a high failure ratio, then half-open with a few probe calls"""
+    
+    def __init__(self, provider: str, window: float, min_calls: int, failure_threshold: float,
+                 open_duration: float, half_open_probes: int):
+        self.provider = provider
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_threshold = failure_threshold
+        self.open_duration = open_duration
+        self.half_open_probes = half_open_probes
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.outcomes: deque = deque()
+        self.probes_in_flight = 0
+        self.probe_successes = 0
+        self.times_opened = 0
+        self.rejected = 0
+    
+    def _prune(self, now: float):
+        while self.outcomes and self.outcomes[0][0] < now - self.window:
+            self.outcomes.popleft()
+    
+    def _open(self, now: float):
+        if self.state != "open":
+            logger.warning(f"Circuit opened for provider {self.provider}")
+            self.times_opened += 1
+        self.state = "open"
+        self.opened_at = now
+        self.outcomes.clear()
+    
+    def is_open(self) -> bool:
+        """Whether calls are still being rejected outright, without taking a probe slot"""
+        return self.state == "open" and time.monotonic() - self.opened_at < self.open_duration
+    
+    def allow(self) -> bool:
+        """Check whether a call may go out; half-open admits a limited number of probes"""
+        now = time.monotonic()
+        if self.state == "open" and now - self.opened_at >= self.open_duration:
+            self.state = "half_open"
+            self.probes_in_flight = 0
+            self.probe_successes = 0
+        if self.state == "closed":
+            return True
+        if self.state == "half_open" and self.probes_in_flight < self.half_open_probes:
+            self.probes_in_flight += 1
+            return True
+        self.rejected += 1
+        return False
+    
+    def record(self, success: Optional[bool]):
+        """Record a call outcome; None means the call was abandoned (e.g. cancelled)"""
+        now = time.monotonic()
+        if self.state == "half_open":
+            self.probes_in_flight = max(self.probes_in_flight - 1, 0)
+            if success is False:
+                self._open(now)
+            elif success:
+                self.probe_successes += 1
+                if self.probe_successes >= self.half_open_probes:
+                    logger.info(f"Circuit closed for provider {self.provider}")
+                    self.state = "closed"
+            return
+        if success is None or self.state == "open":
+            return
+        
+        self.outcomes.append((now, success))
+        self._prune(now)
+        if len(self.outcomes) >= self.min_calls:
+            failures = sum(1 for _, ok in self.outcomes if not ok)
+            if failures / len(self.outcomes) >= self.failure_threshold:
+                self._open(now)
+    
+    def stats(self) -> Dict[str, Any]:
+        self._prune(time.monotonic())
+        failures = sum(1 for _, ok in self.outcomes if not ok)
+        return {
+            "state": self.state,
+            "recent_calls": len(self.outcomes),
+            "recent_failure_rate": failures / len(self.outcomes) if self.outcomes else 0.0,
+            "times_opened": self.times_opened,
+            "rejected": self.rejected
+        }
+
+class QueuedCall:
+    __slots__ = ("future", "priority", "flow", "finish", "enqueued_at", "queued")
+    
+    def __init__(self, future: asyncio.Future, admission: Admission, finish: float):
+        self.future = future
+        self.priority = admission.priority
+        self.flow = admission.flow
+        self.finish = finish
+        self.enqueued_at = time.monotonic()
+        self.queued = True
+
+class AdaptiveConcurrencyLimiter:
+    """AIMD concurrency limit: grow by ~1 per limit successes, shrink on overload
+    
+    Calls beyond the limit wait in a bounded weighted fair queue (see
+    "Admission scheduling") and are shed with a 503 when they cannot get a
+    slot within their class's deadline.
+    """
+    
+    def __init__(self, provider: str, initial_limit: int, min_limit: int, max_limit: int,
+                 backoff: float, max_queue: int, queue_timeout: float):
+        self.provider = provider
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.heap: List[tuple] = []
+        self.queued = 0
+        self.queued_by_class: Dict[str, int] = {priority: 0 for priority in ADMISSION_CLASSES}
+        # flow -> [virtual finish of its last queued call, calls it has queued]
+        self.flows: Dict[str, list] = {}
+        self.virtual_time = 0.0
+        self.sequence = 0
+        self.service_time: Optional[float] = None
+        self.shed = 0
+    
+    def _has_capacity(self) -> bool:
+        return self.in_flight < int(self.limit)
+    
+    def expected_wait(self, finish: float) -> float:
+        """Seconds until a call with this finish time would get a slot, at the current service rate"""
+        if self.service_time is None:
+            return 0.0
+        ahead = sum(1 for _, _, call in self.heap if call.queued and call.finish <= finish)
+        return (ahead + 1) * self.service_time / max(int(self.limit), 1)
+    
+    def _overloaded(self, priority: str, reason: str, retry_after: float) -> HTTPException:
+        self.shed += 1
+        ADMISSION_SHED_TOTAL.labels(self.provider, priority, reason).inc()
+        return HTTPException(
+            status_code=503,
+            detail=f"Provider {self.provider} is overloaded, try again shortly",
+            headers={"Retry-After": str(max(math.ceil(retry_after), 1))}
+        )
+    
+    def _dequeue(self, call: QueuedCall):
+        call.queued = False
+        self.queued -= 1
+        self.queued_by_class[call.priority] -= 1
+        flow = self.flows.get(call.flow)
+        if flow is not None:
+            flow[1] -= 1
+            if flow[1] <= 0 and flow[0] <= self.virtual_time:
+                del self.flows[call.flow]
+        if not self.queued:
+            # Idle again: nobody is owed anything, so start the virtual clock over
+            self.heap.clear()
+            self.flows.clear()
+            self.virtual_time = 0.0
+    
+    async def acquire(self):
+        admission = current_admission.get()
+        if self._has_capacity() and not self.queued:
+            self.in_flight += 1
+            ADMISSION_WAIT.labels(self.provider, admission.priority).observe(0.0)
+            return
+        
+        config = ADMISSION_CLASSES[admission.priority]
+        max_wait = min(config["max_wait"], self.queue_timeout)
+        flow = self.flows.get(admission.flow)
+        finish = max(self.virtual_time, flow[0] if flow else 0.0) + 1 / config["weight"]
+        expected_wait = self.expected_wait(finish)
+        if expected_wait > max_wait:
+            raise self._overloaded(admission.priority, "deadline", expected_wait)
+        if self.queued >= self.max_queue:
+            # The call served last: latest finish, and among equals the latest to arrive
+            last = max(
+                (entry for entry in self.heap if entry[2].queued and not entry[2].future.done()), default=(None, None, None)
+            )[2]
+            if last is None or last.finish <= finish:
+                raise self._overloaded(admission.priority, "queue_full", expected_wait)
+            self._dequeue(last)
+            last.future.set_exception(self._overloaded(last.priority, "evicted", self.expected_wait(last.finish)))
+        
+        call = QueuedCall(asyncio.get_running_loop().create_future(), admission, finish)
+        self.sequence += 1
+        heapq.heappush(self.heap, (finish, self.sequence, call))
+        self.queued += 1
+        self.queued_by_class[call.priority] += 1
+        self.flows[call.flow] = [finish, flow[1] + 1 if flow else 1]
+        try:
+            await asyncio.wait_for(call.future, max_wait)
+        except asyncio.TimeoutError:
+            raise self._overloaded(call.priority, "deadline", self.expected_wait(call.finish))
+        except asyncio.CancelledError:
+            if call.future.done() and not call.future.cancelled() and call.future.exception() is None:
+                # Capacity was handed to us after all; pass it on
+                self.release(None)
+            raise
+        finally:
+            if call.queued:
+                self._dequeue(call)
+            ADMISSION_WAIT.labels(self.provider, call.priority).observe(time.monotonic() - call.enqueued_at)
+    
+    def release(self, success: Optional[bool], duration: Optional[float] = None):
+        """Free a slot and adapt the limit; success=False signals overload"""
+        self.in_flight -= 1
+        if success is False:
+            self.limit = max(self.min_limit, self.limit * self.backoff)
+        elif success and self.in_flight + 1 >= int(self.limit) * 0.5:
+            # Only grow while the current limit is actually being used
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        if duration is not None:
+            self.service_time = duration if self.service_time is None else self.service_time + 0.2 * (duration - self.service_time)
+        
+        while self.heap and self._has_capacity():
+            finish, _, call = heapq.heappop(self.heap)
+            if not call.queued or call.future.done():
+                continue
+            self.virtual_time = finish
+            self._dequeue(call)
+            self.in_flight += 1
+            call.future.set_result(None)
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "limit": int(self.limit),
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "queued_by_class": dict(self.queued_by_class),
+            "flows": len(self.flows),
+            "service_time": round(self.service_time, 3) if self.service_time is not None else None,
+            "shed": self.shed
+        }
+
+def create_circuit_breaker(provider: str) -> CircuitBreaker:
+    return CircuitBreaker(provider, **{**DEFAULT_BREAKER_CONFIG, **API_CONFIGS[provider].get("breaker", {})})
+
+def create_concurrency_limiter(provider: str) -> AdaptiveConcurrencyLimiter:
+    config = {**DEFAULT_CONCURRENCY_CONFIG, **API_CONFIGS[provider].get("concurrency", {})}
+    if config["max_limit"] is None:
+        config["max_limit"] = get_pool_config(provider)["max_connections"]
+    config["initial_limit"] = min(config["initial_limit"], config["max_limit"])
+    return AdaptiveConcurrencyLimiter(provider, **config)
+
+circuit_breakers: Dict[str, CircuitBreaker] = {p: create_circuit_breaker(p) for p in API_CONFIGS}
+concurrency_limiters: Dict[str, AdaptiveConcurrencyLimiter] = {p: create_concurrency_limiter(p) for p in API_CONFIGS}
+
+@asynccontextmanager
+async def provider_guard(provider: str):
+    """Apply the provider's circuit breaker and concurrency limit around a call"""
+    breaker = circuit_breakers[provider]
+    if not breaker.allow():
+        raise HTTPException(status_code=503, detail=f"Provider {provider} temporarily unavailable (circuit open)")
+    limiter = concurrency_limiters[provider]
+    try:
+        with timed_phase("upstream-queue"):
+            await limiter.acquire()
+    except BaseException:
+        breaker.record(None)
+        raise
+    
+    in_flight = UPSTREAM_IN_FLIGHT.labels(provider)
+    in_flight.inc()
+    start_time = time.perf_counter()
+    try:
+        yield
+    except HTTPException as e:
+        success = not is_provider_failure(e)
+        breaker.record(success)
+        limiter.release(success, time.perf_counter() - start_time)
+        UPSTREAM_ERRORS_TOTAL.labels(provider, e.status_code).inc()
+        raise
+    except BaseException:
+        breaker.record(None)
+        limiter.release(None)
+        raise
+    else:
+        breaker.record(True)
+        limiter.release(True, time.perf_counter() - start_time)
+    finally:
+        in_flight.dec()
+        record_phase("upstream", time.perf_counter() - start_time)
+
+def observe_ttfb(provider: str, seconds: float):
+    UPSTREAM_TTFB.labels(provider).observe(seconds)
+    record_phase("upstream-ttfb", seconds)
+
+def get_provider_protection_stats() -> Dict[str, Dict[str, Any]]:
+    return {
+        provider: {
+            "circuit": circuit_breakers[provider].stats(),
+            "concurrency": concurrency_limiters[provider].stats()
+        }
+        for provider in API_CONFIGS
+    }
+
+# API Client utilities
+async def make_api_request(
+    provider: str,
+    endpoint: str,
+    payload: Dict,
+    timeout: int = 30,
+    files: Optional[Dict] = None
+) -> Dict:
+    """Make API request to AI provider
+    
+    With ``files`` the request is sent as multipart/form-data and ``payload``
+    becomes the form fields.
+    """
+    config = API_CONFIGS.get(provider)
+    if not config or not config["api_key"]:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Provider {provider} not configured or missing API key"
+        )
+    
+    headers = {
+        "Authorization": f"Bearer {config['api_key']}",
+        **config["headers"]
+    }
+    if files:
+        body = {"data": payload, "files": files}
+    else:
+        headers["Content-Type"] = "application/json"
+        body = {"json": payload}
+    
+    client = get_http_client(provider)
+    
+    async with provider_guard(provider):
+        try:
+            upstream_request = client.build_request(
+                "POST", endpoint.lstrip('/'), headers=headers, timeout=timeout, **body
+            )
+            start_time = time.perf_counter()
+            response = await client.send(upstream_request, stream=True)
+            observe_ttfb(provider, time.perf_counter() - start_time)
+            try:
+                await response.aread()
+            finally:
+                await response.aclose()
+            response.raise_for_status()
+            return response.json()
+        except httpx.TimeoutException:
+            raise HTTPException(status_code=408, detail="Request timeout")
+        except httpx.HTTPStatusError as e:
+            error_detail = f"API error: {e.response.status_code}"
+            try:
+                error_data = e.response.json()
+                error_detail += f" - {error_data.get('error', {}).get('message', 'Unknown error')}"
+            except:
+                pass
+            raise HTTPException(status_code=e.response.status_code, detail=error_detail)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Request failed: {str(e)}")
+
+async def stream_api_request(
+    provider: str,
+    endpoint: str,
+    payload: Dict,
+    timeout: int = 30
+) -> AsyncIterator[Dict]:
+    """Stream an OpenAI-compatible SSE response, yielding each parsed chunk"""
+    config = API_CONFIGS.get(provider)
+    if not config or not config["api_key"]:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Provider {provider} not configured or missing API key"
+        )
+    
+    headers = {
+        "Authorization": f"Bearer {config['api_key']}",
+        "Content-Type": "application/json",
+        "Accept": "text/event-stream",
+        **config["headers"]
+    }
+    
+    client = get_http_client(provider)
+    
+    async with provider_guard(provider):
+        try:
+            start_time = time.perf_counter()
+            async with client.stream(
+                "POST", endpoint.lstrip('/'), json=payload, headers=headers, timeout=timeout
+            ) as response:
+                observe_ttfb(provider, time.perf_counter() - start_time)
+                if response.is_error:
+                    await response.aread()
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == "[DONE]":
+                        break
+                    try:
+                        yield orjson.loads(data)
+                    except orjson.JSONDecodeError:
+                        logger.warning(f"Skipping malformed stream chunk from {provider}")
+        except httpx.TimeoutException:
+            raise HTTPException(status_code=408, detail="Request timeout")
+        except httpx.HTTPStatusError as e:
+            error_detail = f"API error: {e.response.status_code}"
+            try:
+                error_data = e.response.json()
+                error_detail += f" - {error_data.get('error', {}).get('message', 'Unknown error')}"
+            except:
+                pass
+            raise HTTPException(status_code=e.response.status_code, detail=error_detail)
+        except httpx.HTTPError as e:
+            raise HTTPException(status_code=500, detail=f"Request failed: {str(e)}")
+
+# Provider adapters
+# Each provider in API_CONFIGS names an adapter class and the capabilities it
+# offers (chat, stream, search, transcribe). With PROVIDER_MODE=mock every
+# provider is served by MockAdapter instead: same names, breakers, limiters and
+# metrics, but simulated latency, errors and token speed with no keys or network.
+PROVIDER_MODE = os.getenv("PROVIDER_MODE", "live")
+MOCK_SEED = os.getenv("MOCK_SEED")
+
+# Mock behavior; per provider via API_CONFIGS[...]["mock"] or env such as GROQ_MOCK_TTFB_MS
+DEFAULT_MOCK_CONFIG = {
+    "ttfb_ms": float(os.getenv("MOCK_TTFB_MS", "300")),
+    "latency_sigma": float(os.getenv("MOCK_LATENCY_SIGMA", "0.5")),
+    "error_rate": float(os.getenv("MOCK_ERROR_RATE", "0.0")),
+    "error_status": int(os.getenv("MOCK_ERROR_STATUS", "503")),
+    "tokens_per_second": float(os.getenv("MOCK_TOKENS_PER_SECOND", "80")),
+    "output_tokens": int(os.getenv("MOCK_OUTPUT_TOKENS", "200")),
+    "stream_interval_ms": float(os.getenv("MOCK_STREAM_INTERVAL_MS", "50"))
+}
+
+MOCK_WORDS = (
+    "the model answers with a short and plausible sentence about the question while "
+    "streaming tokens at a steady pace so that load tests see realistic output sizes"
+).split()
+
+provider_adapter_types: Dict[str, type] = {}
+
+def register_provider_adapter(name: str):
+    """Register an adapter class under the name used in API_CONFIGS[...]["adapter"]"""
+    def decorator(cls):
+        provider_adapter_types[name] = cls
+        return cls
+    return decorator
+
+class ProviderAdapter:
+    """Base provider adapter; unsupported operations fail with 400"""
+    capabilities = frozenset()
+    
+    def __init__(self, provider: str, capabilities: Optional[List[str]] = None):
+        self.provider = provider
+        if capabilities is not None:
+            self.capabilities = frozenset(capabilities)
+    
+    def supports(self, capability: str) -> bool:
+        return capability in self.capabilities
+    
+    def _unsupported(self, capability: str) -> HTTPException:
+        return HTTPException(status_code=400, detail=f"Provider {self.provider} does not support {capability}")
+    
+    async def chat(self, model_id: str, messages: List[Dict], **kwargs) -> Dict:
+        raise self._unsupported("chat")
+    
+    async def stream_chat(self, model_id: str, messages: List[Dict], **kwargs) -> AsyncIterator[Dict]:
+        raise self._unsupported("stream")
+        yield
+    
+    async def search(self, query: str, **kwargs) -> Dict:
+        raise self._unsupported("search")
+    
+    async def transcribe(self, model_id: str, audio: bytes, filename: str, **kwargs) -> Dict:
+        raise self._unsupported("transcribe")
+
+@register_provider_adapter("openai")
+class OpenAICompatibleAdapter(ProviderAdapter):
+    """OpenAI-compatible chat completions, streaming and audio transcription"""
+    capabilities = frozenset({"chat", "stream"})
+    
+    def chat_payload(self, model_id: str, messages: List[Dict], **kwargs) -> Dict:
+        return {
+            "model": model_id,
+            "messages": messages,
+            "temperature": kwargs.get("temperature", 0.7),
+            "max_tokens": kwargs.get("max_tokens", 4000)
+        }
+    
+    async def chat(self, model_id: str, messages: List[Dict], **kwargs) -> Dict:
+        response = await make_api_request(
+            self.provider,
+            "chat/completions",
+            self.chat_payload(model_id, messages, **kwargs),
+            timeout=kwargs.get("timeout", 30)
+        )
+        
+        usage = response.get("usage") or {}
+        return {
+            "content": response["choices"][0]["message"]["content"],
+            "tokens": usage.get("total_tokens", 0),
+            "output_tokens": usage.get("completion_tokens")
+        }
+    
+    async def stream_chat(self, model_id: str, messages: List[Dict], **kwargs) -> AsyncIterator[Dict]:
+        payload = {
+            **self.chat_payload(model_id, messages, **kwargs),
+            "stream": True,
+            "stream_options": {"include_usage": True}
+        }
+        
+        async for chunk in stream_api_request(
+            self.provider,
+            "chat/completions",
+            payload,
+            timeout=kwargs.get("timeout", 30)
+        ):
+            choices = chunk.get("choices") or []
+            delta = choices[0].get("delta", {}) if choices else {}
+            usage = chunk.get("usage") or chunk.get("x_groq", {}).get("usage")
+            yield {
+                "content": delta.get("content") or "",
+                "reasoning": delta.get("reasoning") or "",
+                "tokens": usage.get("total_tokens", 0) if usage else None
+            }
+    
+    async def transcribe(self, model_id: str, audio: bytes, filename: str, **kwargs) -> Dict:
+        if not self.supports("transcribe"):
+            raise self._unsupported("transcribe")
+        payload = {"model": model_id, "response_format": "json", "temperature": "0"}
+        if kwargs.get("language"):
+            payload["language"] = kwargs["language"]
+        if kwargs.get("prompt"):
+            payload["prompt"] = kwargs["prompt"]
+        
+        response = await make_api_request(
+            self.provider,
+            "audio/transcriptions",
+            payload,
+            timeout=kwargs.get("timeout", 30),
+            files={"file": (filename, audio, kwargs.get("content_type") or "application/octet-stream")}
+        )
+        
+        return {"text": response.get("text", "")}
+
+@register_provider_adapter("tavily")
+class TavilyAdapter(ProviderAdapter):
+    """Tavily web search"""
+    capabilities = frozenset({"search"})
+    
+    async def search(self, query: str, **kwargs) -> Dict:
+        payload = {
+            "query": query,
+            "max_results": kwargs.get("max_results", 10),
+            "include_answer": True,
+            "include_raw_content": False
+        }
+        
+        if kwargs.get("include_domains"):
+            payload["include_domains"] = kwargs["include_domains"]
+        if kwargs.get("exclude_domains"):
+            payload["exclude_domains"] = kwargs["exclude_domains"]
+        
+        response = await make_api_request(
+            self.provider,
+            "search",
+            payload,
+            timeout=kwargs.get("timeout", 20)
+        )
+        
+        return {
+            "results": response.get("results", []),
+            "answer": response.get("answer", "")
+        }
+
+@register_provider_adapter("mock")
+class MockAdapter(ProviderAdapter):
+    """Local stand-in for any provider
+    
+    Time to first byte is log-normal around ``ttfb_ms``; output is produced at
+    ``tokens_per_second``; ``error_rate`` of calls fail with ``error_status``.
+    Calls still pass through provider_guard, so breakers, concurrency limits
+    and upstream metrics behave as they would against the real provider.
+    """
+    capabilities = frozenset({"chat", "stream", "search", "transcribe"})
+    
+    def __init__(self, provider: str, capabilities: Optional[List[str]] = None):
+        super().__init__(provider, capabilities)
+        self.config = get_provider_options(provider, "mock", DEFAULT_MOCK_CONFIG)
+        self.random = random.Random(f"{MOCK_SEED}:{provider}") if MOCK_SEED else random.Random()
+    
+    async def _first_byte(self, timeout: float):
+        """Wait out a sampled TTFB, then fail if this call draws an error"""
+        ttfb = self.config["ttfb_ms"] * math.exp(self.config["latency_sigma"] * self.random.gauss(0, 1)) / 1000
+        start_time = time.perf_counter()
+        if ttfb >= timeout:
+            await asyncio.sleep(timeout)
+            raise HTTPException(status_code=408, detail="Request timeout")
+        await asyncio.sleep(ttfb)
+        observe_ttfb(self.provider, time.perf_counter() - start_time)
+        if self.random.random() < self.config["error_rate"]:
+            status = self.config["error_status"]
+            raise HTTPException(status_code=status, detail=f"API error: {status} - Mock provider error")
+    
+    def _output(self, messages: List[Dict], max_tokens: int) -> tuple:
+        output_tokens = min(self.config["output_tokens"], max_tokens)
+        seed = messages[-1]["content"] if messages else ""
+        words = random.Random(seed).choices(MOCK_WORDS, k=output_tokens)
+        prompt_tokens = sum(count_message_tokens(message) for message in messages)
+        return words, prompt_tokens + output_tokens
+    
+    async def chat(self, model_id: str, messages: List[Dict], **kwargs) -> Dict:
+        async with provider_guard(self.provider):
+            await self._first_byte(kwargs.get("timeout", 30))
+            words, tokens = self._output(messages, kwargs.get("max_tokens", 4000))
+            await asyncio.sleep(len(words) / self.config["tokens_per_second"])
+            return {"content": " ".join(words), "tokens": tokens, "output_tokens": len(words)}
+    
+    async def stream_chat(self, model_id: str, messages: List[Dict], **kwargs) -> AsyncIterator[Dict]:
+        async with provider_guard(self.provider):
+            await self._first_byte(kwargs.get("timeout", 30))
+            words, tokens = self._output(messages, kwargs.get("max_tokens", 4000))
+            interval = self.config["stream_interval_ms"] / 1000
+            per_chunk = max(int(self.config["tokens_per_second"] * interval), 1)
+            for i in range(0, len(words), per_chunk):
+                yield {"content": " ".join(words[i:i + per_chunk]) + " ", "reasoning": "", "tokens": None}
+                await asyncio.sleep(per_chunk / self.config["tokens_per_second"])
+            yield {"content": "", "reasoning": "", "tokens": tokens}
+    
+    async def search(self, query: str, **kwargs) -> Dict:
+        async with provider_guard(self.provider):
+            await self._first_byte(kwargs.get("timeout", 20))
+            results = [
+                {
+                    "title": f"Result {i + 1} for {query}",
+                    "url": f"https://example.com/{zlib.crc32(query.encode())}/{i}",
+                    "content": f"{query}: " + " ".join(random.Random(f"{query}:{i}").choices(MOCK_WORDS, k=60)),
+                    "score": round(1.0 - i * 0.05, 2)
+                }
+                for i in range(kwargs.get("max_results", 10))
+            ]
+            return {"results": results, "answer": ""}
+    
+    async def transcribe(self, model_id: str, audio: bytes, filename: str, **kwargs) -> Dict:
+        async with provider_guard(self.provider):
+            await self._first_byte(kwargs.get("timeout", 30))
+            return {"text": f"mock transcript of {len(audio)} bytes"}
+
+def create_provider_adapter(provider: str) -> ProviderAdapter:
+    config = API_CONFIGS[provider]
+    adapter_type = "mock" if PROVIDER_MODE == "mock" else config.get("adapter", "openai")
+    return provider_adapter_types[adapter_type](provider, config.get("capabilities"))
+
+provider_adapters: Dict[str, ProviderAdapter] = {p: create_provider_adapter(p) for p in API_CONFIGS}
+
+def get_provider_adapter(provider: str, capability: str) -> ProviderAdapter:
+    """Look up the adapter for a provider, checking it offers the capability"""
+    adapter = provider_adapters.get(provider)
+    if adapter is None:
+        raise HTTPException(status_code=400, detail=f"Unsupported provider: {provider}")
+    if not adapter.supports(capability):
+        raise adapter._unsupported(capability)
+    return adapter
+
+def provider_supports(provider: str, capability: str) -> bool:
+    adapter = provider_adapters.get(provider)
+    return adapter is not None and adapter.supports(capability)
+
+# Context window management
+# Prompts are capped to each model's AI_MODELS[...]["context_tokens"] minus the
+# completion budget. Token counts come from tiktoken when it is installed and a
+# fast regex estimate otherwise, and are cached per message digest so a long
+# conversation is only tokenized once per new message.
+DEFAULT_CONTEXT_STRATEGY = os.getenv("DEFAULT_CONTEXT_STRATEGY", "sliding_window")
+CONTEXT_KEEP_LAST_N = int(os.getenv("CONTEXT_KEEP_LAST_N", "12"))
+CONTEXT_SAFETY_MARGIN = int(os.getenv("CONTEXT_SAFETY_MARGIN", "256"))
+CONTEXT_SUMMARY_SHARE = float(os.getenv("CONTEXT_SUMMARY_SHARE", "0.15"))
+TOKEN_COUNT_CACHE_SIZE = int(os.getenv("TOKEN_COUNT_CACHE_SIZE", "50000"))
+MESSAGE_TOKEN_OVERHEAD = 4
+
+try:
+    import tiktoken
+    _token_encoding = tiktoken.get_encoding("cl100k_base")
+except Exception:
+    _token_encoding = None
+
+_TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+token_count_cache: "OrderedDict[bytes, int]" = OrderedDict()
+
+def estimate_text_tokens(text: str) -> int:
+    """Count tokens with tiktoken, or estimate them (~4 chars per word piece)"""
+    if _token_encoding is not None:
+        return len(_token_encoding.encode(text, disallowed_special=()))
+    return sum((len(piece) + 3) // 4 for piece in _TOKEN_PATTERN.findall(text))
+
+def message_token_digest(message: Dict) -> bytes:
+    return hashlib.blake2b(
+        f"{message['role']}\x00{message['content']}".encode(), digest_size=12
+    ).digest()
+
+def store_token_count(digest: bytes, count: int):
+    token_count_cache[digest] = count
+    if len(token_count_cache) > TOKEN_COUNT_CACHE_SIZE:
+        token_count_cache.popitem(last=False)
+
+def count_message_tokens(message: Dict) -> int:
+    """Token count for one chat message, cached by content digest"""
+    digest = message_token_digest(message)
+    count = token_count_cache.get(digest)
+    if count is not None:
+        token_count_cache.move_to_end(digest)
+        return count
+    count = estimate_text_tokens(message["content"]) + MESSAGE_TOKEN_OVERHEAD
+    store_token_count(digest, count)
+    return count
+
+async def count_message_tokens_in_thread(messages: List[Dict]):
+    """Fill the token count cache for messages, counting uncached ones off the event loop.
+    
+    Only the counting runs in the thread; the cache is read and written on the
+    loop, so it is never touched from two threads at once.
+    """
+    missing = {}
+    for message in messages:
+        digest = message_token_digest(message)
+        if digest not in token_count_cache:
+            missing[digest] = message["content"]
+    if not missing:
+        return
+    counts = await asyncio.to_thread(lambda: [estimate_text_tokens(content) for content in missing.values()])
+    for digest, count in zip(missing, counts):
+        store_token_count(digest, count + MESSAGE_TOKEN_OVERHEAD)
+
+class ContextOverflowError(HTTPException):
+    """The final message and the system prompt kept with it do not fit a model's context window
+    
+    Fallback loops move on to the next model, whose window may be larger; it
+    reaches the client as a 400 only when no model in the chain fits.
+    """
+    
+    def __init__(self, detail: str):
+        super().__init__(status_code=400, detail=detail)
+
+CONTEXT_STRATEGIES: Dict[str, Any] = {}
+
+def register_context_strategy(name: str):
+    """Register a truncation strategy: fn(messages, counts, budget) -> messages"""
+    def register(fn):
+        CONTEXT_STRATEGIES[name] = fn
+        return fn
+    return register
+
+def _leading_system_count(messages: List[Dict]) -> int:
+    count = 0
+    while count < len(messages) - 1 and messages[count]["role"] == "system":
+        count += 1
+    return count
+
+def _check_last_fits(pinned_tokens: int, counts: List[int], budget: int):
+    """Raise when the final message plus the system messages kept with it exceed the budget"""
+    required = pinned_tokens + counts[-1]
+    if required > budget:
+        raise ContextOverflowError(
+            f"Message too long for the context window ({required} > {budget} tokens with the system prompt)"
+        )
+
+def _fill_newest(messages: List[Dict], counts: List[int], budget: int, start: int) -> int:
+    """Index of the oldest message from which messages[index:] fit in budget (at least the last one)"""
+    used = 0
+    index = len(messages)
+    while index > start and (used + counts[index - 1] <= budget or index == len(messages)):
+        index -= 1
+        used += counts[index]
+    return index
+
+@register_context_strategy("sliding_window")
+def sliding_window_strategy(messages: List[Dict], counts: List[int], budget: int) -> List[Dict]:
+    """Keep the leading system prompt and as many of the newest messages as fit"""
+    system_count = _leading_system_count(messages)
+    system_tokens = sum(counts[:system_count])
+    _check_last_fits(system_tokens, counts, budget)
+    index = _fill_newest(messages, counts, budget - system_tokens, system_count)
+    return messages[:system_count] + messages[index:]
+
+@register_context_strategy("keep_system_last_n")
+def keep_system_last_n_strategy(messages: List[Dict], counts: List[int], budget: int) -> List[Dict]:
+    """Keep every system message plus at most the last CONTEXT_KEEP_LAST_N others, within budget"""
+    system = [(m, c) for m, c in zip(messages, counts) if m["role"] == "system"]
+    others = [(m, c) for m, c in zip(messages, counts) if m["role"] != "system"][-CONTEXT_KEEP_LAST_N:]
+    system_tokens = sum(c for _, c in system)
+    if others:
+        _check_last_fits(system_tokens, [c for _, c in others], budget)
+    index = _fill_newest([m for m, _ in others], [c for _, c in others], budget - system_tokens, 0)
+    return [m for m, _ in system] + [m for m, _ in others[index:]]
+
+@register_context_strategy("summarize_prefix")
+def summarize_prefix_strategy(messages: List[Dict], counts: List[int], budget: int) -> List[Dict]:
+    """Keep the newest messages and replace the dropped prefix with an extractive summary
+    
+    The summary takes the first sentence of each dropped message (newest
+    first) until CONTEXT_SUMMARY_SHARE of the budget is used. It is built
+    locally, so trimming never costs an extra model call.
+    """
+    system_count = _leading_system_count(messages)
+    system_tokens = sum(counts[:system_count])
+    _check_last_fits(system_tokens, counts, budget)
+    summary_budget = int(budget * CONTEXT_SUMMARY_SHARE)
+    index = _fill_newest(messages, counts, budget - system_tokens - summary_budget, system_count)
+    dropped = messages[system_count:index]
+    if not dropped:
+        return messages[:system_count] + messages[index:]
+    # A final message longer than its share leaves the summary only what is left
+    summary_budget = min(summary_budget, budget - system_tokens - sum(counts[index:]))
+    
+    lines = []
+    used = estimate_text_tokens("Summary of the earlier conversation:") + MESSAGE_TOKEN_OVERHEAD
+    for message in reversed(dropped):
+        first_sentence = re.split(r"(?<=[.!?])\s", message["content"].strip(), maxsplit=1)[0][:300]
+        line = f"- {message['role']}: {first_sentence}"
+        cost = estimate_text_tokens(line) + 1
+        if used + cost > summary_budget:
+            break
+        lines.append(line)
+        used += cost
+    
+    summary = []
+    if lines:
+        summary = [{"role": "system", "content": "Summary of the earlier conversation:\n" + "\n".join(reversed(lines))}]
+    return messages[:system_count] + summary + messages[index:]
+
+def fit_context(
+    messages: List[Dict],
+    model_key: str,
+    max_tokens: int,
+    strategy: Optional[str] = None,
+    counts: Optional[List[int]] = None
+) -> List[Dict]:
+    """Trim a prompt to the model's context window using the chosen strategy
+    
+    ``counts`` are per-message token counts when the caller already has them.
+    """
+    model_config = AI_MODELS[model_key]
+    context_tokens = model_config.get("context_tokens")
+    if not context_tokens:
+        return messages
+    
+    budget = context_tokens - max_tokens - CONTEXT_SAFETY_MARGIN
+    if counts is None:
+        counts = [count_message_tokens(message) for message in messages]
+    if sum(counts) <= budget:
+        return messages
+    # Every strategy keeps the leading system prompt along with the final message
+    required = sum(counts[:_leading_system_count(messages)]) + counts[-1]
+    if required > budget:
+        raise ContextOverflowError(
+            f"Message too long for {model_config['name']} context window "
+            f"({required} > {budget} tokens with the system prompt)"
+        )
+    
+    strategy = strategy or model_config.get("context_strategy", DEFAULT_CONTEXT_STRATEGY)
+    trimmed = CONTEXT_STRATEGIES[strategy](messages, counts, budget)
+    CONTEXT_TRUNCATIONS.labels(model_key, strategy).inc()
+    logger.info(f"Trimmed context for {model_key} from {len(messages)} to {len(trimmed)} messages ({strategy})")
+    return trimmed
+
+CONTEXT_TRUNCATIONS = metrics.counter(
+    "ego_context_truncations_total", "Prompts trimmed to fit the context window", ("model", "strategy")
+)
+
+# Provider fallback and hedging
+# When HEDGING_ENABLED, a backup request to the next model in the fallback
+# chain goes out once the primary has been silent for its recent p95 latency
+# (or HEDGE_DEFAULT_DELAY until enough samples exist). First answer wins.
+HEDGING_ENABLED = os.getenv("HEDGING_ENABLED", "false").lower() in ("1", "true", "yes")
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "0.95"))
+HEDGE_DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", "8"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+LATENCY_WINDOW = 200
+
+class LatencyTracker:
+    """Rolling window of successful call latencies per model"""
+    
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self.samples: Dict[str, deque] = {}
+        self.window = window
+    
+    def record(self, model_key: str, seconds: float):
+        samples = self.samples.get(model_key)
+        if samples is None:
+            samples = self.samples[model_key] = deque(maxlen=self.window)
+        samples.append(seconds)
+    
+    def percentile(self, model_key: str, q: float) -> Optional[float]:
+        samples = self.samples.get(model_key)
+        if not samples or len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+latency_tracker = LatencyTracker()
+
+resilience_stats = {
+    "requests": 0,
+    "fallbacks": 0,
+    "hedged_requests": 0,
+    "hedge_wins": 0
+}
+
+def is_retryable_error(error: HTTPException) -> bool:
+    """Errors worth retrying on another model/provider (timeouts, throttling, outages, auth)"""
+    return error.status_code in (401, 403, 408, 429) or error.status_code >= 500
+
+def get_fallback_chain(model_key: str) -> List[str]:
+    chain = [model_key]
+    for fallback in AI_MODELS[model_key].get("fallbacks", []):
+        if fallback in AI_MODELS and fallback not in chain:
+            chain.append(fallback)
+    return chain
+
+def get_hedge_delay(model_key: str) -> float:
+    budget = latency_tracker.percentile(model_key, HEDGE_PERCENTILE)
+    if budget is None:
+        return AI_MODELS[model_key].get("hedge_after", HEDGE_DEFAULT_DELAY)
+    return budget
+
+async def call_chat_model(
+    model_key: str,
+    messages: List[Dict],
+    temperature: float,
+    max_tokens: int,
+    context_strategy: Optional[str] = None,
+    token_counts: Optional[List[int]] = None
+) -> Dict:
+    """Call a single chat model through its provider"""
+    model_config = AI_MODELS[model_key]
+    provider = model_config["provider"]
+    kwargs = {
+        "temperature": temperature,
+        "max_tokens": min(max_tokens, model_config.get("max_tokens", max_tokens)),
+        "timeout": model_config["timeout"]
+    }
+    messages = fit_context(messages, model_key, kwargs["max_tokens"], context_strategy, token_counts)
+    
+    adapter = get_provider_adapter(provider, "chat")
+    start_time = time.monotonic()
+    try:
+        result = await adapter.chat(model_config["model_id"], messages, **kwargs)
+    except HTTPException as e:
+        if is_retryable_error(e):
+            model_router.observe_failure(model_key)
+        raise
+    elapsed = time.monotonic() - start_time
+    latency_tracker.record(model_key, elapsed)
+    model_router.observe_success(
+        model_key, elapsed, result.get("output_tokens") or estimate_text_tokens(result["content"])
+    )
+    UPSTREAM_DURATION.labels(provider, model_key).observe(elapsed)
+    TOKENS_TOTAL.labels(model_key).inc(result.get("tokens", 0))
+    return result
+
+async def call_with_fallbacks(
+    model_key: str,
+    messages: List[Dict],
+    temperature: float,
+    max_tokens: int,
+    context_strategy: Optional[str] = None,
+    token_counts: Optional[List[int]] = None
+) -> tuple:
+    """Call a model, moving down its fallback chain on retryable errors
+    
+    Returns ``(answering_model_key, result)``.
+    """
+    chain = get_fallback_chain(model_key)
+    resilience_stats["requests"] += 1
+    pending: Dict[asyncio.Task, str] = {}
+    next_index = 0
+    hedged = False
+    last_error: Optional[HTTPException] = None
+    
+    def launch():
+        nonlocal next_index
+        key = chain[next_index]
+        next_index += 1
+        task = asyncio.create_task(
+            call_chat_model(key, messages, temperature, max_tokens, context_strategy, token_counts)
+        )
+        pending[task] = key
+    
+    launch()
+    try:
+        while pending:
+            # At most one hedge per request, and only while a single call is outstanding
+            can_hedge = HEDGING_ENABLED and not hedged and len(pending) == 1 and next_index < len(chain)
+            timeout = get_hedge_delay(next(iter(pending.values()))) if can_hedge else None
+            done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            
+            if not done:
+                hedged = True
+                resilience_stats["hedged_requests"] += 1
+                launch()
+                continue
+            
+            for task in done:
+                key = pending.pop(task)
+                try:
+                    result = task.result()
+                except ContextOverflowError as e:
+                    logger.info(f"Prompt does not fit {key}, trying the next model in the chain")
+                    # Only reported when no model in the chain fits
+                    last_error = last_error or e
+                    continue
+                except HTTPException as e:
+                    if not is_retryable_error(e):
+                        raise
+                    logger.warning(f"Model {key} failed ({e.status_code}: {e.detail})")
+                    last_error = e
+                    continue
+                if hedged and key != chain[0]:
+                    resilience_stats["hedge_wins"] += 1
+                return key, result
+            
+            if not pending and next_index < len(chain):
+                resilience_stats["fallbacks"] += 1
+                launch()
+        
+        raise last_error or HTTPException(status_code=502, detail="All providers failed")
+    finally:
+        for task in pending:
+            task.cancel()
+
+def get_resilience_stats() -> Dict[str, Any]:
+    requests = resilience_stats["requests"]
+    return {
+        **resilience_stats,
+        "hedging_enabled": HEDGING_ENABLED,
+        "hedge_rate": resilience_stats["hedged_requests"] / requests if requests else 0.0,
+        "fallback_rate": resilience_stats["fallbacks"] / requests if requests else 0.0,
+        "hedge_delay": {key: get_hedge_delay(key) for key in latency_tracker.samples}
+    }
+
+# Adaptive model routing (model == "auto")
+# The intent of the last user message comes from one compiled regex with a
+# named group per ROUTER_INTENT_RULES entry (word stems, overridable as JSON).
+# Candidates are the models of the right type for the mode, in a category the
+# plan allows, whose provider circuit is not open. Each is scored on expected
+# time to answer - time to first token plus ROUTER_EXPECTED_OUTPUT_TOKENS at
+# its output rate, both EWMAs over recent calls - its recent error rate, its
+# price, and whether AI_MODELS tags it for the intent. ROUTER_EXPLORE_RATE of
+# decisions go to a random candidate so idle models keep fresh estimates.
+# Every decision is written as one JSON line to the "ego.router" logger, and
+# to ROUTER_LOG_PATH when set, for offline analysis.
+DEFAULT_INTENT_RULES = {
+    "code": ["code", "coding", "program", "function", "debug", "bug", "compile", "script", "stack trace"],
+    "creative": ["creative", "story", "stories", "poem", "write", "writing", "lyrics", "fiction"]
+}
+ROUTER_INTENT_RULES: Dict[str, List[str]] = orjson.loads(os.getenv("ROUTER_INTENT_RULES", "null")) or DEFAULT_INTENT_RULES
+ROUTER_DEFAULT_INTENT = "general"
+# Answers when no model is eligible at all (e.g. every provider disabled)
+ROUTER_FALLBACK_MODEL = os.getenv("ROUTER_FALLBACK_MODEL", "gemini-2-5-pro-free")
+ROUTER_EWMA_ALPHA = float(os.getenv("ROUTER_EWMA_ALPHA", "0.2"))
+ROUTER_PRIOR_TTFT = float(os.getenv("ROUTER_PRIOR_TTFT", "1.0"))
+ROUTER_PRIOR_TPS = float(os.getenv("ROUTER_PRIOR_TPS", "40"))
+ROUTER_EXPECTED_OUTPUT_TOKENS = int(os.getenv("ROUTER_EXPECTED_OUTPUT_TOKENS", "300"))
+ROUTER_INTENT_BONUS = float(os.getenv("ROUTER_INTENT_BONUS", "3.0"))  # worth this many seconds
+ROUTER_ERROR_WEIGHT = float(os.getenv("ROUTER_ERROR_WEIGHT", "10.0"))  # seconds per unit of error rate
+ROUTER_COST_WEIGHT = float(os.getenv("ROUTER_COST_WEIGHT", "100.0"))  # seconds per dollar
+ROUTER_EXPLORE_RATE = float(os.getenv("ROUTER_EXPLORE_RATE", "0.05"))
+ROUTER_LOG_PATH = os.getenv("ROUTER_LOG_PATH")
+
+router_logger = logging.getLogger("ego.router")
+if ROUTER_LOG_PATH:
+    _router_log_handler = logging.FileHandler(ROUTER_LOG_PATH)
+    _router_log_handler.setFormatter(logging.Formatter("%(message)s"))
+    router_logger.addHandler(_router_log_handler)
+
+ROUTER_DECISIONS_TOTAL = metrics.counter(
+    "ego_router_decisions_total", "Auto-routing decisions by model, intent and reason", ("model", "intent", "reason")
+)
+
+def compile_intent_pattern(rules: Dict[str, List[str]]) -> "re.Pattern":
+    """One alternation with a named group per intent, so a single scan classifies a text"""
+    groups = []
+    for intent, words in rules.items():
+        if not intent.isidentifier():
+            raise ValueError(f"Intent names must be identifiers: {intent!r}")
+        alternatives = "|".join(re.escape(word) for word in sorted(words, key=len, reverse=True))
+        groups.append(f"(?P<{intent}>{alternatives})")
+    return re.compile(r"\b(?:" + "|".join(groups) + ")", re.IGNORECASE)
+
+class ModelEstimates:
+    """EWMAs of one model's recent calls"""
+    __slots__ = ("ttft", "tps", "output_tokens", "error_rate", "calls", "failures")
+    
+    def __init__(self):
+        self.ttft = ROUTER_PRIOR_TTFT
+        self.tps = ROUTER_PRIOR_TPS
+        self.output_tokens = float(ROUTER_EXPECTED_OUTPUT_TOKENS)
+        self.error_rate = 0.0
+        self.calls = 0
+        self.failures = 0
+
+class ModelRouter:
+    """Pick a model for ``auto`` requests from intent and live per-model estimates"""
+    
+    def __init__(self, rules: Dict[str, List[str]]):
+        self.intents = list(rules)
+        self.intent_pattern = compile_intent_pattern(rules)
+        self.estimates: Dict[str, ModelEstimates] = {key: ModelEstimates() for key in AI_MODELS}
+        self.random = random.Random()
+        self.decisions = 0
+        self.explored = 0
+    
+    def classify(self, text: str) -> str:
+        counts: Dict[str, int] = {}
+        for match in self.intent_pattern.finditer(text):
+            counts[match.lastgroup] = counts.get(match.lastgroup, 0) + 1
+        if not counts:
+            return ROUTER_DEFAULT_INTENT
+        # Most matches wins; ties go to the rule listed first
+        return max(self.intents, key=lambda intent: counts.get(intent, 0))
+    
+    def observe_success(self, model_key: str, seconds: float, output_tokens: int, ttft: Optional[float] = None):
+        """Fold a finished call into the estimates
+        
+        Streams report their time to first token. For whole responses only the
+        total is known, so the current output rate is used to split it.
+        """
+        estimate = self.estimates[model_key]
+        alpha = ROUTER_EWMA_ALPHA
+        if ttft is None:
+            ttft = max(seconds - output_tokens / estimate.tps, 0.0)
+        generation = seconds - ttft
+        if output_tokens > 0 and generation > 0:
+            estimate.tps += alpha * (output_tokens / generation - estimate.tps)
+        estimate.ttft += alpha * (ttft - estimate.ttft)
+        estimate.output_tokens += alpha * (output_tokens - estimate.output_tokens)
+        estimate.error_rate -= alpha * estimate.error_rate
+        estimate.calls += 1
+    
+    def observe_failure(self, model_key: str):
+        estimate = self.estimates[model_key]
+        estimate.error_rate += ROUTER_EWMA_ALPHA * (1.0 - estimate.error_rate)
+        estimate.calls += 1
+        estimate.failures += 1
+    
+    def candidates(self, mode: str, plan: str) -> List[str]:
+        categories = ("free", "premium") if plan == "premium" else ("free",)
+        model_type = "thinking" if mode == "think" else "chat"
+        eligible = [
+            key for key, config in AI_MODELS.items()
+            if config["type"] == model_type and config["category"] in categories
+            and provider_supports(config["provider"], "chat")
+        ]
+        healthy = [key for key in eligible if not circuit_breakers[AI_MODELS[key]["provider"]].is_open()]
+        # With every circuit open, still answer with something; the breaker will reject fast
+        return healthy or eligible
+    
+    def score(self, model_key: str, intent: str, output_tokens: int) -> float:
+        config = AI_MODELS[model_key]
+        estimate = self.estimates[model_key]
+        expected_seconds = estimate.ttft + output_tokens / estimate.tps
+        return (
+            (ROUTER_INTENT_BONUS if intent in config.get("intents", ()) else 0.0)
+            - expected_seconds
+            - ROUTER_ERROR_WEIGHT * estimate.error_rate
+            - ROUTER_COST_WEIGHT * config.get("cost_per_1k_tokens", 0.0) * output_tokens / 1000
+        )
+    
+    def route(self, text: str, mode: str, plan: str, max_tokens: int) -> Dict:
+        """Choose a model and log the decision with the scores behind it"""
+        intent = self.classify(text) if mode != "search" else "search"
+        decision = {"timestamp": time.time(), "mode": mode, "plan": plan, "intent": intent, "scores": {}}
+        candidates = self.candidates(mode, plan) if mode != "search" else []
+        if mode == "search":
+            # Search mode retrieves with Tavily, then answers with a chat model
+            decision.update(model=RAG_GENERATION_MODEL, reason="search_mode")
+        elif not candidates:
+            decision.update(model=ROUTER_FALLBACK_MODEL, reason="no_candidates")
+        else:
+            output_tokens = min(ROUTER_EXPECTED_OUTPUT_TOKENS, max_tokens or ROUTER_EXPECTED_OUTPUT_TOKENS)
+            scores = {key: self.score(key, intent, output_tokens) for key in candidates}
+            decision["scores"] = {key: round(score, 3) for key, score in scores.items()}
+            if len(candidates) > 1 and self.random.random() < ROUTER_EXPLORE_RATE:
+                decision.update(model=self.random.choice(candidates), reason="explore")
+                self.explored += 1
+            else:
+                decision.update(model=max(scores, key=scores.get), reason="best_score")
+        
+        self.decisions += 1
+        ROUTER_DECISIONS_TOTAL.labels(decision["model"], intent, decision["reason"]).inc()
+        router_logger.info(orjson.dumps(decision).decode())
+        return decision
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "decisions": self.decisions,
+            "explored": self.explored,
+            "models": {
+                key: {
+                    "ttft": round(estimate.ttft, 3),
+                    "tokens_per_second": round(estimate.tps, 1),
+                    "output_tokens": round(estimate.output_tokens),
+                    "error_rate": round(estimate.error_rate, 3),
+                    "calls": estimate.calls,
+                    "failures": estimate.failures
+                }
+                for key, estimate in self.estimates.items() if estimate.calls
+            }
+        }
+
+model_router = ModelRouter(ROUTER_INTENT_RULES)
+
+# Search-augmented generation (mode == "search")
+# Retrieval runs several query variants in parallel; generation starts as soon
+# as the first successful batch is back plus a short grace window for the
+# others, which keep running in the background to warm the search cache. A
+# failed variant does not end retrieval while others are still running; it
+# fails only when every variant has failed or RAG_RETRIEVAL_TIMEOUT passes.
+RAG_GENERATION_MODEL = os.getenv("RAG_GENERATION_MODEL", "gemini-2-5-pro-free")
+RAG_QUERY_VARIANTS = int(os.getenv("RAG_QUERY_VARIANTS", "2"))
+RAG_MAX_RESULTS = int(os.getenv("RAG_MAX_RESULTS", "6"))
+RAG_GATHER_WINDOW = float(os.getenv("RAG_GATHER_WINDOW", "0.3"))
+RAG_RETRIEVAL_TIMEOUT = float(os.getenv("RAG_RETRIEVAL_TIMEOUT", "20"))
+RAG_CONTEXT_TOKENS = int(os.getenv("RAG_CONTEXT_TOKENS", "2500"))
+RAG_SNIPPET_TOKENS = int(os.getenv("RAG_SNIPPET_TOKENS", "350"))
+RAG_QUERY_MAX_CHARS = 400
+RAG_STOPWORDS = frozenset(
+    "a an and are about can could did do does for from how i in is it me of on or please "
+    "should tell that the this to was what when where which who why will with would you".split()
+)
+_background_tasks: set = set()
+
+async def search_with_cache(
+    query: str,
+    max_results: int = 10,
+    include_domains: Optional[List[str]] = None,
+    exclude_domains: Optional[List[str]] = None
+) -> tuple:
+    """Tavily search through the cache and single-flight; returns ``(data, source)``"""
+    cache_key = get_cache_key(
+        "search",
+        query=query,
+        max_results=max_results,
+        include_domains=include_domains,
+        exclude_domains=exclude_domains
+    )
+    
+    async def fetch_search() -> Dict:
+        adapter = get_provider_adapter(AI_MODELS["tavily-search"]["provider"], "search")
+        result = await adapter.search(
+            query,
+            max_results=max_results,
+            include_domains=include_domains,
+            exclude_domains=exclude_domains,
+            timeout=20
+        )
+        return {
+            "results": result["results"],
+            "answer": result.get("answer", ""),
+            "query": query,
+            "model": "Tavily Search"
+        }
+    
+    cached_response = await cache_get(cache_key, refresh=fetch_search, ttl=SEARCH_CACHE_TTL)
+    if cached_response:
+        return cached_response, "cache"
+    
+    # Identical concurrent searches share one upstream call
+    return await singleflight.do(cache_key, fetch_search, SEARCH_CACHE_TTL)
+
+def build_query_variants(messages: List[ChatMessage]) -> List[str]:
+    """The user's question, a keyword-only form, and a follow-up form carrying the previous turn"""
+    user_turns = [msg.content for msg in messages if msg.role == "user"]
+    question = " ".join(user_turns[-1].split())[:RAG_QUERY_MAX_CHARS]
+    keywords = [w for w in _WORD_PATTERN.findall(question.lower()) if w not in RAG_STOPWORDS]
+    
+    variants = [question]
+    if keywords:
+        variants.append(" ".join(keywords))
+    if len(user_turns) > 1:
+        previous = [w for w in _WORD_PATTERN.findall(user_turns[-2].lower()) if w not in RAG_STOPWORDS]
+        variants.append(" ".join(previous[:8] + keywords)[:RAG_QUERY_MAX_CHARS])
+    
+    unique = []
+    for variant in variants:
+        if variant and variant not in unique:
+            unique.append(variant)
+    return unique[:max(RAG_QUERY_VARIANTS, 1)]
+
+async def retrieve_search_results(queries: List[str]) -> List[Dict]:
+    """Run query variants concurrently; return once the first succeeds plus a grace window"""
+    tasks = [asyncio.create_task(search_with_cache(query, RAG_MAX_RESULTS)) for query in queries]
+    deadline = asyncio.get_running_loop().time() + RAG_RETRIEVAL_TIMEOUT
+    done = set()
+    pending = set(tasks)
+    while pending and not any(not task.exception() for task in done):
+        remaining = deadline - asyncio.get_running_loop().time()
+        if remaining <= 0:
+            break
+        finished, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+        done |= finished
+    if pending and any(not task.exception() for task in done):
+        more, pending = await asyncio.wait(pending, timeout=RAG_GATHER_WINDOW)
+        done |= more
+    for task in pending:
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+    
+    batches = []
+    errors = []
+    for task in tasks:
+        if task not in done:
+            continue
+        if task.exception():
+            errors.append(task.exception())
+        else:
+            batches.append(task.result()[0])
+    if not batches:
+        if pending or not errors:
+            raise HTTPException(status_code=504, detail="Search timed out")
+        raise errors[0]
+    return batches
+
+def select_search_context(batches: List[Dict], budget: int = RAG_CONTEXT_TOKENS) -> List[Dict]:
+    """Merge, deduplicate and trim search results to a token budget (best scores first)"""
+    seen_urls = set()
+    seen_content = set()
+    merged = []
+    for batch in batches:
+        for result in batch.get("results", []):
+            url = result.get("url", "").split("#")[0].rstrip("/").lower()
+            fingerprint = " ".join(result.get("content", "").lower().split())[:200]
+            if not fingerprint or url in seen_urls or fingerprint in seen_content:
+                continue
+            seen_urls.add(url)
+            seen_content.add(fingerprint)
+            merged.append(result)
+    merged.sort(key=lambda r: r.get("score") or 0, reverse=True)
+    
+    selected = []
+    used = 0
+    for result in merged:
+        words = result["content"].split()
+        snippet = " ".join(words)
+        if estimate_text_tokens(snippet) > RAG_SNIPPET_TOKENS:
+            # Word-piece estimates run ~1.3 tokens per word; trim by words then re-check
+            snippet = " ".join(words[:int(RAG_SNIPPET_TOKENS / 1.3)])
+        cost = estimate_text_tokens(snippet) + estimate_text_tokens(result.get("title", "")) + 8
+        if used + cost > budget:
+            continue
+        used += cost
+        selected.append({"title": result.get("title", ""), "url": result.get("url", ""), "content": snippet})
+    return selected
+
+def build_grounded_messages(messages: List[Dict], sources: List[Dict], answer: str) -> List[Dict]:
+    """Insert the retrieved sources as a system message ahead of the conversation"""
+    lines = [
+        "Answer using the web search results below. Cite sources inline as [n]. "
+        "If the results do not cover the question, say so."
+    ]
+    if answer:
+        lines.append(f"Search summary: {answer}")
+    for i, source in enumerate(sources, 1):
+        lines.append(f"[{i}] {source['title']} ({source['url']})\n{source['content']}")
+    grounding = {"role": "system", "content": "\n\n".join(lines)}
+    
+    system_count = _leading_system_count(messages)
+    return messages[:system_count] + [grounding] + messages[system_count:]
+
+async def prepare_search_context(chat_request: ChatRequest, messages: List[Dict]) -> Dict:
+    """Retrieval and context stages of the search pipeline, with per-stage timings"""
+    timings = {}
+    stage_start = time.perf_counter()
+    queries = build_query_variants(chat_request.messages)
+    retrieval = asyncio.create_task(retrieve_search_results(queries))
+    # Count history tokens in a thread while retrieval runs on the loop
+    await count_message_tokens_in_thread(messages)
+    batches = await retrieval
+    timings["retrieval_ms"] = (time.perf_counter() - stage_start) * 1000
+    
+    stage_start = time.perf_counter()
+    sources = select_search_context(batches)
+    answer = next((b.get("answer") for b in batches if b.get("answer")), "")
+    grounded = build_grounded_messages(messages, sources, answer)
+    timings["context_ms"] = (time.perf_counter() - stage_start) * 1000
+    
+    return {
+        "messages": grounded,
+        "sources": [{"title": s["title"], "url": s["url"]} for s in sources],
+        "queries": queries,
+        "timings": timings
+    }
+
+STREAM_REPLAY_CHUNK_SIZE = 64
+
+# Audio transcription
+# Uploads are spooled to a temp file by the multipart parser (only the first
+# megabyte stays in memory) and hashed in fixed-size reads. Long WAV files are cut into
+# TRANSCRIBE_CHUNK_SECONDS pieces that are transcribed concurrently and joined
+# in order; other formats cannot be split without a decoder and are sent whole.
+# On a cache miss the audio is copied into a spooled file owned by the
+# single-flight call, since the request that started the call closes its own
+# upload when it returns or its client goes away while other requests may
+# still be waiting on the result.
+TRANSCRIBE_MODEL = "whisper-transcription"
+TRANSCRIBE_MAX_BYTES = int(os.getenv("TRANSCRIBE_MAX_BYTES", str(200 * 1024 * 1024)))
+TRANSCRIBE_UPSTREAM_MAX_BYTES = int(os.getenv("TRANSCRIBE_UPSTREAM_MAX_BYTES", str(25 * 1024 * 1024)))
+TRANSCRIBE_CHUNK_SECONDS = int(os.getenv("TRANSCRIBE_CHUNK_SECONDS", "60"))
+TRANSCRIBE_CHUNK_CONCURRENCY = int(os.getenv("TRANSCRIBE_CHUNK_CONCURRENCY", "4"))
+TRANSCRIBE_READ_SIZE = 1024 * 1024
+TRANSCRIBE_CACHE_TTL = int(os.getenv("TRANSCRIBE_CACHE_TTL", str(7 * 24 * 3600)))
+
+async def hash_upload(upload: UploadFile) -> tuple:
+    """Hash an upload in fixed-size reads; returns ``(hex digest, size)``"""
+    digest = hashlib.blake2b(digest_size=CACHE_KEY_DIGEST_SIZE)
+    size = 0
+    await upload.seek(0)
+    while True:
+        block = await upload.read(TRANSCRIBE_READ_SIZE)
+        if not block:
+            break
+        size += len(block)
+        if size > TRANSCRIBE_MAX_BYTES:
+            raise HTTPException(status_code=413, detail=f"Audio exceeds {TRANSCRIBE_MAX_BYTES} bytes")
+        digest.update(block)
+    await upload.seek(0)
+    return digest.hexdigest(), size
+
+def detach_upload(upload: UploadFile) -> UploadFile:
+    """Move an upload's file out of its request so it outlives it, without copying
+    
+    The request keeps an empty file for the framework to close; the caller
+    now owns the returned upload and must close it.
+    """
+    detached = UploadFile(upload.file, size=upload.size, filename=upload.filename, headers=upload.headers)
+    upload.file = io.BytesIO()
+    return detached
+
+def plan_wav_chunks(fileobj) -> Optional[tuple]:
+    """Return ``(params, frames_per_chunk, chunk_count)`` for a WAV file, or None"""
+    fileobj.seek(0)
+    try:
+        with wave.open(fileobj, "rb") as reader:
+            params = reader.getparams()
+    except (wave.Error, EOFError):
+        return None
+    finally:
+        fileobj.seek(0)
+    frames_per_chunk = max(params.framerate * TRANSCRIBE_CHUNK_SECONDS, 1)
+    chunk_count = max((params.nframes + frames_per_chunk - 1) // frames_per_chunk, 1)
+    return params, frames_per_chunk, chunk_count
+
+def read_wav_chunk(fileobj, params, start_frame: int, frame_count: int) -> bytes:
+    """Copy one frame range of a WAV file into a standalone WAV payload"""
+    fileobj.seek(0)
+    with wave.open(fileobj, "rb") as reader:
+        reader.setpos(start_frame)
+        frames = reader.readframes(frame_count)
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as writer:
+        writer.setparams(params)
+        writer.writeframes(frames)
+    return buffer.getvalue()
+
+async def transcribe_upload(upload: UploadFile, size: int, language: Optional[str], prompt: Optional[str]) -> Dict:
+    """Transcribe an upload, splitting long WAV audio into concurrent chunks"""
+    model_config = AI_MODELS[TRANSCRIBE_MODEL]
+    adapter = get_provider_adapter(model_config["provider"], "transcribe")
+    options = {"language": language, "timeout": model_config["timeout"]}
+    fileobj = upload.file
+    plan = await asyncio.to_thread(plan_wav_chunks, fileobj)
+    
+    if plan is None or plan[2] == 1:
+        if size > TRANSCRIBE_UPSTREAM_MAX_BYTES:
+            raise HTTPException(
+                status_code=413,
+                detail=f"Only WAV audio can be split; other formats are limited to {TRANSCRIBE_UPSTREAM_MAX_BYTES} bytes"
+            )
+        audio = await upload.read()
+        result = await adapter.transcribe(
+            model_config["model_id"], audio, upload.filename or "audio",
+            prompt=prompt, content_type=upload.content_type, **options
+        )
+        return {"text": result["text"].strip(), "chunks": 1}
+    
+    params, frames_per_chunk, chunk_count = plan
+    # The spooled file has one read position, so chunk reads take turns while
+    # uploads run concurrently; at most TRANSCRIBE_CHUNK_CONCURRENCY chunks are
+    # held in memory at once
+    read_lock = asyncio.Lock()
+    semaphore = asyncio.Semaphore(TRANSCRIBE_CHUNK_CONCURRENCY)
+    
+    async def transcribe_chunk(index: int) -> str:
+        async with semaphore:
+            async with read_lock:
+                audio = await asyncio.to_thread(
+                    read_wav_chunk, fileobj, params, index * frames_per_chunk, frames_per_chunk
+                )
+            # Only the first chunk gets the caller's prompt; later chunks are
+            # primed with nothing rather than wait for the previous transcript
+            result = await adapter.transcribe(
+                model_config["model_id"], audio, f"chunk-{index}.wav",
+                prompt=prompt if index == 0 else None, content_type="audio/wav", **options
+            )
+            return result["text"].strip()
+    
+    texts = await asyncio.gather(*(transcribe_chunk(i) for i in range(chunk_count)))
+    return {"text": " ".join(text for text in texts if text), "chunks": chunk_count}
+
+CHAT_MODEL_TYPES = ("chat", "thinking")
+
+def resolve_model_key(chat_request: ChatOptions) -> str:
+    """Resolve the requested model, running auto-selection if needed"""
+    model_key = chat_request.model
+    if model_key == "auto":
+        model_key = chat_request.route["model"]
+    
+    if model_key not in AI_MODELS:
+        raise HTTPException(status_code=400, detail=f"Invalid model: {model_key}")
+    if AI_MODELS[model_key]["type"] == "search":
+        # Search is a retrieval stage, not a generator. In search mode the RAG
+        # model answers over its results; anywhere else it cannot answer at all
+        if chat_request.mode != "search":
+            raise HTTPException(
+                status_code=400,
+                detail=f"{model_key} is a search model; use mode \"search\" or pick a chat model"
+            )
+        model_key = RAG_GENERATION_MODEL
+    elif AI_MODELS[model_key]["type"] not in CHAT_MODEL_TYPES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"{model_key} is a {AI_MODELS[model_key]['type']} model and cannot answer chat requests"
+        )
+    return model_key
+
+def get_chat_cache_key(model_key: str, chat_request: ChatRequest) -> str:
+    """Build the response cache key for a chat request"""
+    return get_cache_key(
+        "chat",
+        model=model_key,
+        history=chat_request.prefix_digest.hex(),
+        message=chat_request.message_dicts[-1],
+        temperature=chat_request.temperature,
+        behavior=chat_request.behavior,
+        mode=chat_request.mode,
+        context_strategy=chat_request.context_strategy
+    )
+
+def get_semantic_scope(model_key: str, chat_request: ChatRequest) -> int:
+    """Exact-match scope for semantic lookups: everything except the final user turn, plus its key tokens"""
+    canonical = orjson.dumps({
+        "key_tokens": semantic_key_tokens(chat_request.messages[-1].content),
+        "model": model_key,
+        "behavior": chat_request.behavior,
+        "temperature": chat_request.temperature,
+        "mode": chat_request.mode,
+        "context_strategy": chat_request.context_strategy,
+        "history": chat_request.prefix_digest.hex()
+    }, option=orjson.OPT_SORT_KEYS)
+    scope = int.from_bytes(hashlib.blake2b(canonical, digest_size=8).digest(), "little", signed=True)
+    return scope or 1  # 0 marks an empty slot
+
+async def semantic_cache_get(model_key: str, chat_request: ChatRequest) -> Optional[Dict]:
+    """Look up a cached answer for a near-duplicate of the final user turn"""
+    if not semantic_cache.enabled or chat_request.messages[-1].role != "user":
+        return None
+    with timed_phase("semantic"):
+        vector = embed_text(chat_request.messages[-1].content)
+        match = semantic_cache.lookup(get_semantic_scope(model_key, chat_request), vector)
+    SEMANTIC_LOOKUPS_TOTAL.labels("hit" if match else "miss").inc()
+    if match is None:
+        return None
+    cache_key, similarity = match
+    logger.info(f"Semantic cache match (similarity {similarity:.3f})")
+    return await cache_get(cache_key)
+
+async def semantic_cache_add(model_key: str, chat_request: ChatRequest, cache_key: str):
+    """Index a freshly generated answer for future near-duplicate prompts"""
+    if not semantic_cache.enabled or chat_request.messages[-1].role != "user":
+        return
+    try:
+        vector = embed_text(chat_request.messages[-1].content)
+        # The write waits on the cross-worker file lock, so keep it off the loop
+        await asyncio.to_thread(semantic_cache.add, get_semantic_scope(model_key, chat_request), vector, cache_key)
+    except Exception as e:
+        logger.error(f"Semantic cache add error: {e}")
+
+SEMANTIC_LOOKUPS_TOTAL = metrics.counter("ego_semantic_cache_lookups_total", "Semantic cache lookups by result", ("result",))
+
+def build_chat_messages(chat_request: ChatRequest) -> List[Dict]:
+    """Build the upstream message list, prepending the behavior system prompt"""
+    if chat_request.behavior:
+        return [{"role": "system", "content": chat_request.behavior}, *chat_request.message_dicts]
+    return list(chat_request.message_dicts)
+
+def build_chat_token_counts(chat_request: ChatRequest) -> Optional[List[int]]:
+    """Token counts aligned with build_chat_messages, or None when the request has none yet"""
+    counts = chat_request.known_token_counts
+    if counts is None or not chat_request.behavior:
+        return counts
+    return [count_message_tokens({"role": "system", "content": chat_request.behavior}), *counts]
+
+def format_sse(event: str, data: Dict) -> str:
+    """Format a single Server-Sent Event"""
+    return f"event: {event}\ndata: {orjson.dumps(data).decode()}\n\n"
+
+def make_chat_fetch(
+    chat_request: ChatRequest,
+    model_key: str,
+    cache_key: str,
+    usage: Optional[Dict] = None
+) -> Callable[[], Awaitable[Dict]]:
+    """The upstream call behind a chat cache entry
+    
+    ``usage`` collects the tokens used and, in search mode, the stage timings.
+    The same function refreshes the entry when it goes stale.
+    """
+    usage = {} if usage is None else usage
+    
+    async def fetch_completion() -> Dict:
+        extra = {}
+        prompt = build_chat_messages(chat_request)
+        token_counts = build_chat_token_counts(chat_request)
+        if chat_request.mode == "search":
+            search_context = await prepare_search_context(chat_request, prompt)
+            prompt = search_context["messages"]
+            token_counts = None
+            usage.setdefault("timings", {}).update(search_context["timings"])
+            extra["sources"] = search_context["sources"]
+        
+        generation_start = time.perf_counter()
+        used_key, result = await call_with_fallbacks(
+            model_key,
+            prompt,
+            chat_request.temperature,
+            chat_request.max_tokens,
+            chat_request.context_strategy,
+            token_counts
+        )
+        if chat_request.mode == "search":
+            usage["timings"]["generation_ms"] = (time.perf_counter() - generation_start) * 1000
+        used_config = AI_MODELS[used_key]
+        usage["tokens"] = result.get("tokens", 0)
+        await semantic_cache_add(model_key, chat_request, cache_key)
+        return {
+            "content": result["content"],
+            "model": used_config["name"],
+            "provider": used_config["provider"],
+            "category": used_config["category"],
+            **extra
+        }
+    
+    return fetch_completion
+
+async def generate_chat_response(
+    chat_request: ChatRequest,
+    model_key: str,
+    cache_key: str,
+    exact_cache_checked: bool = False
+) -> tuple:
+    """Serve a chat request from cache or upstream
+    
+    Returns ``(response_data, tokens_used, source)``; source is ``cache``,
+    ``upstream``, ``coalesced`` or ``remote``. Pass ``exact_cache_checked``
+    when the caller already missed on ``cache_key``.
+    """
+    usage = {"tokens": 0}
+    fetch_completion = make_chat_fetch(chat_request, model_key, cache_key, usage)
+    cached_response = (
+        (None if exact_cache_checked else await cache_get(cache_key, refresh=fetch_completion, ttl=CHAT_CACHE_TTL))
+        or await semantic_cache_get(model_key, chat_request)
+    )
+    if cached_response:
+        return cached_response, None, "cache"
+    
+    # Identical concurrent requests share one upstream call; the result is cached by the leader
+    response_data, source = await singleflight.do(cache_key, fetch_completion, CHAT_CACHE_TTL)
+    if "timings" in usage:
+        # Stage timings describe this request only, so they are not cached
+        response_data = {**response_data, "timings": usage["timings"]}
+    return response_data, usage["tokens"], source
+
+# Service lifecycle
+# A worker is "starting" until its cache, client pools and semantic index are
+# warm, "ready" while it should receive traffic and "draining" once SIGTERM
+# arrives. On SIGTERM /ready fails straight away but the worker keeps serving
+# for SHUTDOWN_READY_GRACE seconds so load balancers stop routing to it before
+# the listener closes. uvicorn then waits up to SHUTDOWN_DRAIN_TIMEOUT for
+# in-flight requests and streams, and only after that does the lifespan close
+# the pools.
+SERVE_MODE = os.getenv("SERVE_MODE", "development").lower()
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", "8000"))
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "0"))  # 0 = one worker per available core
+KEEP_ALIVE_TIMEOUT = int(os.getenv("KEEP_ALIVE_TIMEOUT", "5"))
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "true").lower() in ("1", "true", "yes")
+WARMUP_CONNECTIONS = int(os.getenv("WARMUP_CONNECTIONS", "2"))
+WARMUP_TIMEOUT = float(os.getenv("WARMUP_TIMEOUT", "5"))
+SHUTDOWN_READY_GRACE = float(os.getenv("SHUTDOWN_READY_GRACE", "5"))
+SHUTDOWN_DRAIN_TIMEOUT = int(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "30"))
+
+STARTUP_DURATION = metrics.gauge("ego_startup_seconds", "Slowest worker startup time by phase", ("phase",), aggregate="max")
+SERVICE_READY = metrics.gauge("ego_service_ready", "1 while every live worker accepts traffic, 0 while any is starting or draining", aggregate="min")
+
+class ServiceState:
+    """Lifecycle of this worker as seen by /ready, /live and the drain handler"""
+
+    def __init__(self):
+        self.status = "starting"
+        self.started_at = time.time()
+        self.ready_at: Optional[float] = None
+        self.draining_since: Optional[float] = None
+        self.startup_phases: Dict[str, float] = {}
+        self._stop_handle: Optional[asyncio.TimerHandle] = None
+        self._stopping = False
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.startup_phases[name] = time.perf_counter() - start
+
+    def mark_ready(self):
+        self.startup_phases["total"] = time.perf_counter() - MODULE_LOAD_START
+        for phase, seconds in self.startup_phases.items():
+            STARTUP_DURATION.labels(phase).set(seconds)
+        self.status = "ready"
+        self.ready_at = time.time()
+        SERVICE_READY.labels().set(1)
+        phases = ", ".join(f"{phase} {seconds:.3f}s" for phase, seconds in self.startup_phases.items())
+        logger.info(f"Worker {os.getpid()} ready ({phases})")
+
+    def install_drain_handler(self):
+        """Take over SIGTERM so readiness fails before the listener closes"""
+        if SHUTDOWN_READY_GRACE <= 0 or threading.current_thread() is not threading.main_thread():
+            return
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, self.begin_drain)
+        except NotImplementedError:
+            pass  # Windows event loops have no signal handlers
+
+    def begin_drain(self):
+        if self.status == "draining":
+            # A second SIGTERM skips the rest of the grace period
+            self._stop_serving()
+            return
+        self.status = "draining"
+        self.draining_since = time.time()
+        SERVICE_READY.labels().set(0)
+        logger.info(f"SIGTERM received, failing readiness for {SHUTDOWN_READY_GRACE}s before draining")
+        self._stop_handle = asyncio.get_running_loop().call_later(SHUTDOWN_READY_GRACE, self._stop_serving)
+
+    def _stop_serving(self):
+        # Hand over to uvicorn's own graceful shutdown: SIGINT makes it stop
+        # accepting, wait for open connections and then run the lifespan exit
+        if self._stopping:
+            return
+        self._stopping = True
+        if self._stop_handle:
+            self._stop_handle.cancel()
+        os.kill(os.getpid(), signal.SIGINT)
+
+    def snapshot(self) -> Dict[str, Any]:
+        now = time.time()
+        return {
+            "status": self.status,
+            "pid": os.getpid(),
+            "uptime_seconds": round(now - self.started_at, 3),
+            "startup_seconds": {phase: round(seconds, 4) for phase, seconds in self.startup_phases.items()},
+            "draining_seconds": round(now - self.draining_since, 3) if self.draining_since else None,
+            "in_flight_requests": int(REQUESTS_IN_FLIGHT.labels().value)
+        }
+
+service_state = ServiceState()
+
+async def warm_http_clients():
+    """Open WARMUP_CONNECTIONS connections per provider so first requests skip TCP and TLS setup"""
+    if PROVIDER_MODE == "mock" or WARMUP_CONNECTIONS <= 0:
+        return
+
+    async def touch(provider: str):
+        # Any response leaves a live connection in the pool; the status is irrelevant
+        try:
+            await get_http_client(provider).head("/", timeout=WARMUP_TIMEOUT)
+        except httpx.HTTPError as e:
+            logger.warning(f"Warmup connection to {provider} failed: {e!r}")
+
+    await asyncio.gather(*(touch(p) for p in API_CONFIGS for _ in range(WARMUP_CONNECTIONS)))
+    open_connections = {p: s["open_connections"] for p, s in get_pool_stats().items()}
+    logger.info(f"Warm connections per provider: {open_connections}")
+
+def get_worker_count() -> int:
+    """WEB_CONCURRENCY, or the number of cores this process may run on"""
+    if WEB_CONCURRENCY > 0:
+        return WEB_CONCURRENCY
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
 
-async def call_groq(model_id: str, messages: List[Dict], **kwargs) -> Dict:
-    """Call Groq API"""
-    payload = {
-        "model": model_id,
-        "messages": messages,
-        "temperature": kwargs.get("temperature", 0.7),
-        "max_tokens": kwargs.get("max_tokens", 4000)
-    }
-    
-    response = await make_api_request(
-        "groq",
-        "chat/completions", 
-        payload,
-        timeout=kwargs.get("timeout", 30)
-    )
-    
-    return {
-        "content": response["choices"][0]["message"]["content"],
-        "tokens": response.get("usage", {}).get("total_tokens", 0)
-    }
+def serve():
+    """Run the dev reloader, or the multi-worker server when SERVE_MODE=production"""
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    if SERVE_MODE != "production":
+        uvicorn.run("main:app", host=HOST, port=PORT, reload=True, app_dir=app_dir, log_level="info")
+        return
 
-async def call_tavily_search(query: str, **kwargs) -> Dict:
-    """Call Tavily Search API"""
-    payload = {
-        "query": query,
-        "max_results": kwargs.get("max_results", 10),
-        "include_answer": True,
-        "include_raw_content": False
-    }
-    
-    if kwargs.get("include_domains"):
-        payload["include_domains"] = kwargs["include_domains"]
-    if kwargs.get("exclude_domains"):
-        payload["exclude_domains"] = kwargs["exclude_domains"]
-    
-    response = await make_api_request(
-        "tavily",
-        "search",
-        payload,
-        timeout=kwargs.get("timeout", 20)
+    workers = get_worker_count()
+    loop = "uvloop" if find_spec("uvloop") else "asyncio"
+    http = "httptools" if find_spec("httptools") else "h11"
+    if workers > 1 and not METRICS_DIR:
+        logger.warning("Running several workers without METRICS_DIR; /metrics only shows the worker that answers")
+    logger.info(f"Starting {workers} worker(s) on {HOST}:{PORT} with {loop} and {http}")
+    uvicorn.run(
+        "main:app",
+        host=HOST,
+        port=PORT,
+        app_dir=app_dir,
+        workers=workers,
+        loop=loop,
+        http=http,
+        timeout_keep_alive=KEEP_ALIVE_TIMEOUT,
+        timeout_graceful_shutdown=SHUTDOWN_DRAIN_TIMEOUT,
+        access_log=False,
+        log_level="info"
     )
-    
-    return {
-        "results": response.get("results", []),
-        "answer": response.get("answer", "")
-    }
-
-def auto_select_model(query: str, mode: str) -> str:
-    """Auto-select the best model based on query and mode"""
-    query_lower = query.lower()
-    
-    if mode == "search":
-        return "tavily-search"
-    
-    if mode == "think":
-        return "deepseek-r1-free"
-    
-    # Keyword-based selection
-    if any(word in query_lower for word in ["code", "program", "function", "debug"]):
-        return "llama-4-scout-free"
-    
-    if any(word in query_lower for word in ["creative", "story", "poem", "write"]):
-        return "qwen-3-235b-free"
-    
-    return "gemini-2-5-pro-free"
 
 # FastAPI app setup
 @asynccontextmanager
@@ -375,27 +3882,54 @@ async def lifespan(app: FastAPI):
         if not config["api_key"]:
             missing_keys.append(provider.upper())
     
-    if missing_keys:
+    if PROVIDER_MODE == "mock":
+        logger.warning("PROVIDER_MODE=mock: all providers are simulated locally")
+    elif missing_keys:
         logger.warning(f"Missing API keys for: {', '.join(missing_keys)}")
     else:
         logger.info("All API keys configured")
     
+    service_state.startup_phases["load"] = time.perf_counter() - MODULE_LOAD_START
+    with service_state.phase("connect"):
+        await asyncio.gather(cache.connect(), open_http_clients())
+        if SEMANTIC_CACHE_ENABLED:
+            semantic_cache.open()
+    if WARMUP_ENABLED:
+        with service_state.phase("warmup"):
+            await asyncio.gather(warm_http_clients(), asyncio.to_thread(semantic_cache.warm))
+    metrics_task = asyncio.create_task(flush_metrics_loop()) if METRICS_DIR else None
+    if PROFILING_ENABLED:
+        profiler.start()
+        logger.info(f"Profiling enabled (slow threshold {PROFILE_SLOW_THRESHOLD}s)")
+    cache_warmer.start()
+    service_state.install_drain_handler()
+    service_state.mark_ready()
+    
     yield
     
+    # By now the server has stopped accepting and drained open connections
     logger.info("Shutting down EGO AI Service...")
+    service_state.status = "stopped"
+    SERVICE_READY.labels().set(0)
+    await cache_warmer.stop()
+    if PROFILING_ENABLED:
+        await profiler.stop()
+    if metrics_task:
+        metrics_task.cancel()
+        metrics.flush()
+    await close_http_clients()
+    await cache.close()
+    semantic_cache.close()
 
 app = FastAPI(
     title="EGO AI Service",
     description="Advanced AI Assistant Backend API",
     version="1.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 # Middleware
-app.state.limiter = limiter
-app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
-app.add_middleware(SlowAPIMiddleware)
-
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:5173", "http://localhost:3000", "https://localhost:5173"],
@@ -407,30 +3941,288 @@ app.add_middleware(
 # Middleware for request tracking
 @app.middleware("http")
 async def add_request_id(request: Request, call_next):
-    request_id = str(uuid.uuid4())
+    # Clients may pick the id themselves, so they can cancel a /chat call they are still waiting on
+    request_id = request.headers.get("x-request-id")
+    if request_id is None or not _REQUEST_ID_PATTERN.match(request_id) or request_id in active_requests:
+        request_id = str(uuid.uuid4())
     request.state.request_id = request_id
     request.state.start_time = time.time()
+    profile = None
+    if PROFILING_ENABLED:
+        profile, profile_token = profiler.begin(request_id)
     
-    response = await call_next(request)
+    REQUESTS_IN_FLIGHT.labels().inc()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+    finally:
+        REQUESTS_IN_FLIGHT.labels().dec()
+        processing_time = time.time() - request.state.start_time
+        record_request_metrics(request, status_code, processing_time)
+        if profile is not None:
+            # Streaming responses are measured up to their headers
+            server_timing = profiler.finish(profile, profile_token, request, status_code)
     
-    processing_time = time.time() - request.state.start_time
     response.headers["X-Request-ID"] = request_id
     response.headers["X-Processing-Time"] = str(processing_time)
+    if service_state.status == "draining":
+        # Keep-alive clients reconnect, and land on a worker that is staying up
+        response.headers["Connection"] = "close"
+    if profile is not None:
+        response.headers["Server-Timing"] = server_timing
+    rate_limit = getattr(request.state, "rate_limit", None)
+    if rate_limit:
+        response.headers["X-RateLimit-Limit"] = str(rate_limit["limit"])
+        response.headers["X-RateLimit-Remaining"] = str(rate_limit["remaining"])
+        response.headers["X-RateLimit-Reset"] = str(rate_limit["reset"])
     
     return response
 
+def record_request_metrics(request: Request, status_code: int, processing_time: float):
+    route = request.scope.get("route")
+    route_path = route.path if route is not None else "unmatched"
+    model_key = getattr(request.state, "model_key", "")
+    provider = AI_MODELS[model_key]["provider"] if model_key in AI_MODELS else ""
+    
+    REQUESTS_TOTAL.labels(route_path, request.method, status_code).inc()
+    REQUEST_DURATION.labels(route_path, model_key, provider).observe(processing_time)
+    if status_code >= 400:
+        HTTP_ERRORS_TOTAL.labels(route_path, status_code).inc()
+
+# Request cancellation
+# /chat and conversation turns run their upstream work in a task registered
+# under the request id, and cancel it when the client disconnects (the
+# endpoint waits for http.disconnect alongside it) or on
+# POST /chat/{request_id}/cancel. Streams are already cancelled by Starlette on
+# disconnect; an explicit cancel interrupts the upstream read and ends the
+# stream with a "cancelled" event. Cancelling releases the provider slot and,
+# through the single-flight, stops the upstream call unless another request
+# is waiting on the same answer. A cancel must carry the request's cancel
+# token in X-Cancel-Token: /chat callers choose it and send it with the request
+# (as they do the X-Request-ID), streams get one in their "start" event.
+# Without a token a request can still be cancelled by disconnecting. Workers
+# register the token digest of their cancellable requests in Redis, so a
+# worker receiving a cancel for a request it does not hold can check the
+# token; it then leaves a flag for CANCEL_FLAG_TTL seconds, and workers poll
+# for their own every CANCEL_POLL_INTERVAL seconds (0 turns the polling and
+# cross-worker cancels off).
+CANCEL_POLL_INTERVAL = float(os.getenv("CANCEL_POLL_INTERVAL", "1.0"))
+CANCEL_FLAG_TTL = 60
+CANCEL_OWNER_TTL = 3600
+_REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9-]{8,64}$")
+_CANCEL_TOKEN_PATTERN = re.compile(r"^[A-Za-z0-9_-]{16,128}$")
+
+CANCELLED_REQUESTS_TOTAL = metrics.counter(
+    "ego_cancelled_requests_total", "Chat requests cancelled before they finished by kind and reason", ("kind", "reason")
+)
+TOKENS_SAVED_TOTAL = metrics.counter(
+    "ego_tokens_saved_total", "Estimated output tokens not generated because requests were cancelled", ("model",)
+)
+
+class ActiveRequest:
+    """A chat request whose upstream work can still be cancelled"""
+    __slots__ = ("task", "kind", "model_key", "max_tokens", "cancel_token", "cancel_reason", "interruptible")
+    
+    def __init__(self, task: asyncio.Task, kind: str, model_key: str, max_tokens: int, cancel_token: Optional[str]):
+        self.task = task
+        self.kind = kind
+        self.cancel_token = cancel_token
+        self.model_key = model_key
+        self.max_tokens = max_tokens
+        self.cancel_reason: Optional[str] = None
+        # Streams may only be interrupted while waiting on upstream, not while sending to the client
+        self.interruptible = True
+    
+    def cancel(self, reason: str):
+        if self.cancel_reason is None:
+            self.cancel_reason = reason
+            if self.interruptible:
+                self.task.cancel()
+
+active_requests: Dict[str, ActiveRequest] = {}
+cancellation_stats = {"cancelled": 0, "tokens_saved": 0}
+
+def get_cancel_flag_key(request_id: str) -> str:
+    return f"cancel:{request_id}"
+
+def get_cancel_owner_key(request_id: str) -> str:
+    return f"cancel-owner:{request_id}"
+
+def get_cancel_token(request: Request) -> Optional[str]:
+    """The cancel token the client sent with its request, if it is well-formed"""
+    token = request.headers.get("x-cancel-token")
+    return token if token and _CANCEL_TOKEN_PATTERN.match(token) else None
+
+def cancel_token_digest(token: str) -> bytes:
+    return hashlib.blake2b(token.encode(), digest_size=16).digest()
+
+def cancel_token_matches(expected: Optional[str], token: str) -> bool:
+    return expected is not None and hmac.compare_digest(expected.encode(), token.encode())
+
+def cross_worker_cancels() -> bool:
+    return CANCEL_POLL_INTERVAL > 0 and cache.available
+
+async def register_cancellable(request_id: str, entry: ActiveRequest):
+    """Record who may cancel this request, for cancels that reach another worker"""
+    if entry.cancel_token is None or not cross_worker_cancels():
+        return
+    await cache.set(get_cancel_owner_key(request_id), cancel_token_digest(entry.cancel_token), CANCEL_OWNER_TTL, l1=False)
+
+async def unregister_cancellable(request_id: str, entry: ActiveRequest):
+    if entry.cancel_token is None or not cross_worker_cancels():
+        return
+    try:
+        await cache.delete(get_cancel_owner_key(request_id))
+    except Exception as e:
+        logger.warning(f"Cancel registration cleanup failed: {e}")
+
+def record_cancellation(entry: ActiveRequest, reason: str, output_tokens: int = 0):
+    """Count a cancelled request and the output it would probably still have generated"""
+    expected = min(model_router.estimates[entry.model_key].output_tokens, entry.max_tokens)
+    saved = max(int(expected) - output_tokens, 0)
+    cancellation_stats["cancelled"] += 1
+    cancellation_stats["tokens_saved"] += saved
+    CANCELLED_REQUESTS_TOTAL.labels(entry.kind, reason).inc()
+    TOKENS_SAVED_TOTAL.labels(entry.model_key).inc(saved)
+    logger.info(f"Cancelled {entry.kind} request ({reason}), ~{saved} output tokens saved")
+
+async def wait_for_disconnect(request: Request) -> str:
+    """Return once the client has gone away (the body has already been read)"""
+    while True:
+        message = await request.receive()
+        if message["type"] == "http.disconnect":
+            return "disconnect"
+
+async def watch_cancel_flag(request_id: str, entry: ActiveRequest):
+    """Cancel the entry when another worker received the cancel request for it"""
+    key = get_cancel_flag_key(request_id)
+    while True:
+        await asyncio.sleep(CANCEL_POLL_INTERVAL)
+        if cache.available and await cache.get(key, l1=False):
+            entry.cancel("explicit")
+            return
+
+def start_cancel_flag_watch(request_id: str, entry: ActiveRequest) -> Optional[asyncio.Task]:
+    if entry.cancel_token is None or not cross_worker_cancels():
+        return None
+    return asyncio.create_task(watch_cancel_flag(request_id, entry))
+
+async def run_cancellable(request: Request, chat_request: ChatRequest, model_key: str, work: Awaitable):
+    """Await a request's upstream work, cancelling it on disconnect or an explicit cancel
+    
+    Raises a 499 when the work was cancelled before it finished.
+    """
+    request_id = request.state.request_id
+    task = asyncio.ensure_future(work)
+    entry = ActiveRequest(task, "chat", model_key, chat_request.max_tokens, get_cancel_token(request))
+    active_requests[request_id] = entry
+    watchers = [asyncio.create_task(wait_for_disconnect(request))]
+    flag_watch = start_cancel_flag_watch(request_id, entry)
+    if flag_watch:
+        watchers.append(flag_watch)
+    try:
+        await register_cancellable(request_id, entry)
+        done, _ = await asyncio.wait([task, *watchers], return_when=asyncio.FIRST_COMPLETED)
+        if task not in done:
+            for watcher in done:
+                if watcher.exception() is None and watcher.result() == "disconnect":
+                    entry.cancel("disconnect")
+        return await task
+    except asyncio.CancelledError:
+        if entry.cancel_reason is None:
+            # The endpoint itself was cancelled, which also means the client is gone
+            entry.cancel("disconnect")
+            record_cancellation(entry, "disconnect")
+            raise
+        record_cancellation(entry, entry.cancel_reason)
+        raise HTTPException(status_code=499, detail="Request cancelled")
+    finally:
+        for watcher in watchers:
+            watcher.cancel()
+        if not task.done():
+            task.cancel()
+        if active_requests.get(request_id) is entry:
+            del active_requests[request_id]
+        await unregister_cancellable(request_id, entry)
+
+async def cancellable_stream(
+    request_id: str,
+    model_key: str,
+    max_tokens: int,
+    cancel_token: str,
+    events: AsyncIterator[str],
+    output: List[str]
+) -> AsyncIterator[str]:
+    """Forward a stream's events, ending it with a ``cancelled`` event on an explicit cancel
+    
+    ``output`` is the content streamed so far, for the tokens-saved estimate.
+    """
+    entry = ActiveRequest(asyncio.current_task(), "stream", model_key, max_tokens, cancel_token)
+    active_requests[request_id] = entry
+    flag_watch = start_cancel_flag_watch(request_id, entry)
+    completed = False
+    try:
+        await register_cancellable(request_id, entry)
+        async for event in events:
+            entry.interruptible = False
+            yield event
+            entry.interruptible = True
+            if entry.cancel_reason is not None:
+                break
+        else:
+            completed = True
+    except asyncio.CancelledError:
+        if entry.cancel_reason is None:
+            raise
+        asyncio.current_task().uncancel()
+    finally:
+        if flag_watch:
+            flag_watch.cancel()
+        if active_requests.get(request_id) is entry:
+            del active_requests[request_id]
+        await unregister_cancellable(request_id, entry)
+        if not completed:
+            await events.aclose()
+            record_cancellation(entry, entry.cancel_reason or "disconnect", estimate_text_tokens("".join(output)))
+    
+    if not completed:
+        yield format_sse("cancelled", {"request_id": request_id, "reason": entry.cancel_reason})
+
 # API Endpoints
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
+    open_circuits = [p for p, breaker in circuit_breakers.items() if breaker.state == "open"]
     return {
-        "status": "healthy",
+        "status": "degraded" if open_circuits else "healthy",
         "service": "EGO AI Service",
         "timestamp": datetime.utcnow().isoformat(),
         "models_available": len(AI_MODELS),
-        "cache_available": CACHE_AVAILABLE
+        "cache_available": cache.available,
+        "providers": {
+            provider: {
+                "circuit": circuit_breakers[provider].state,
+                "concurrency_limit": int(concurrency_limiters[provider].limit),
+                "in_flight": concurrency_limiters[provider].in_flight
+            }
+            for provider in API_CONFIGS
+        }
     }
 
+@app.get("/live")
+async def liveness_check():
+    """Liveness probe: the worker's event loop is answering"""
+    return {"status": "alive", "pid": os.getpid(), "uptime_seconds": round(time.time() - service_state.started_at, 3)}
+
+@app.get("/ready")
+async def readiness_check():
+    """Readiness probe: 503 while the worker is warming up or draining"""
+    state = service_state.snapshot()
+    if service_state.status != "ready":
+        return ORJSONResponse(state, status_code=503, headers={"Retry-After": "1"})
+    return state
+
 @app.get("/models")
 async def get_models():
     """Get available AI models"""
@@ -452,99 +4244,645 @@ async def chat_completion(
     
     try:
         # Auto-select model if needed
-        model_key = chat_request.model
-        if model_key == "auto":
-            model_key = auto_select_model(
-                chat_request.messages[-1].content,
-                chat_request.mode
-            )
-        
-        if model_key not in AI_MODELS:
-            raise HTTPException(status_code=400, detail=f"Invalid model: {model_key}")
-        
+        model_key = resolve_model_key(chat_request)
         model_config = AI_MODELS[model_key]
+        request.state.model_key = model_key
+        admit_request(request, chat_request)
         
-        # Check cache
-        cache_key = get_cache_key(
-            "chat",
-            model=model_key,
-            messages=[msg.dict() for msg in chat_request.messages],
-            temperature=chat_request.temperature,
-            behavior=chat_request.behavior
+        # Exact cache hits go back as the stored bytes, never parsed
+        cache_key = get_chat_cache_key(model_key, chat_request)
+        cached_body = await cache_get_raw(
+            cache_key, refresh=make_chat_fetch(chat_request, model_key, cache_key), ttl=CHAT_CACHE_TTL
         )
-        
-        cached_response = cache_get(cache_key)
-        if cached_response:
+        if cached_body is not None:
             logger.info(f"Cache hit for request {request_id}")
-            return APIResponse(
+            return encode_api_response(
+                cached_body,
                 success=True,
-                data=cached_response,
+                error=None,
                 request_id=request_id,
                 timestamp=datetime.utcnow().isoformat(),
                 processing_time=time.time() - start_time,
-                model_used=model_config["name"]
+                model_used=model_config["name"],
+                tokens_used=None
             )
         
-        # Prepare messages
-        messages = [{"role": msg.role, "content": msg.content} for msg in chat_request.messages]
+        # Then the semantic cache and the provider (coalescing identical in-flight requests),
+        # abandoned if the client goes away first
+        response_data, tokens_used, source = await run_cancellable(
+            request, chat_request, model_key,
+            generate_chat_response(chat_request, model_key, cache_key, exact_cache_checked=True)
+        )
+        if source == "cache":
+            logger.info(f"Semantic cache hit for request {request_id}")
+        elif source != "upstream":
+            logger.info(f"Coalesced request {request_id} ({source})")
+        
+        return encode_api_response(
+            orjson.dumps(response_data),
+            success=True,
+            error=None,
+            request_id=request_id,
+            timestamp=datetime.utcnow().isoformat(),
+            processing_time=time.time() - start_time,
+            model_used=response_data.get("model", model_config["name"]),
+            tokens_used=tokens_used
+        )
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Chat completion error: {e}")
+        return encode_api_response(
+            success=False,
+            data=None,
+            error=str(e),
+            request_id=request_id,
+            timestamp=datetime.utcnow().isoformat(),
+            processing_time=time.time() - start_time,
+            model_used=None,
+            tokens_used=None
+        )
+
+@app.post("/chat/stream")
+@limiter.limit("30/minute")
+async def chat_completion_stream(
+    request: Request,
+    chat_request: ChatRequest
+):
+    """Stream an AI chat completion as Server-Sent Events
+    
+    Emits a ``start`` event, ``delta`` events carrying content as it arrives
+    (``reasoning`` events for thinking models), then a ``done`` event with
+    token usage and timing. Cache hits are replayed through the same events.
+    """
+    model_key = resolve_model_key(chat_request)
+    request.state.model_key = model_key
+    admit_request(request, chat_request)
+    return await start_chat_stream(request, chat_request, model_key)
+
+async def start_chat_stream(
+    request: Request,
+    chat_request: ChatRequest,
+    model_key: str,
+    on_complete: Optional[Callable[[Dict], Awaitable[Dict]]] = None
+) -> StreamingResponse:
+    """Look up the cache and return the SSE response for a chat request
+    
+    ``on_complete`` is awaited with the final response data before the
+    ``done`` event, and whatever it returns is added to that event.
+    """
+    start_time = time.time()
+    request_id = request.state.request_id
+    model_config = AI_MODELS[model_key]
+    provider = model_config["provider"]
+    if not provider_supports(provider, "stream"):
+        raise HTTPException(status_code=400, detail=f"Streaming not supported for provider: {provider}")
+    
+    cache_key = get_chat_cache_key(model_key, chat_request)
+    cached_response = (
+        await cache_get(cache_key, refresh=make_chat_fetch(chat_request, model_key, cache_key), ttl=CHAT_CACHE_TTL)
+        or await semantic_cache_get(model_key, chat_request)
+    )
+    content_parts: List[str] = []
+    cancel_token = get_cancel_token(request) or secrets.token_urlsafe(24)
+    
+    async def event_stream() -> AsyncIterator[str]:
+        yield format_sse("start", {
+            "request_id": request_id,
+            "cancel_token": cancel_token,
+            "model": model_config["name"],
+            "provider": provider,
+            "cached": cached_response is not None
+        })
         
-        # Add system prompt if behavior is specified
-        if chat_request.behavior:
-            messages.insert(0, {"role": "system", "content": chat_request.behavior})
+        if cached_response:
+            logger.info(f"Cache hit for streamed request {request_id}")
+            content = cached_response["content"]
+            for i in range(0, len(content), STREAM_REPLAY_CHUNK_SIZE):
+                yield format_sse("delta", {"content": content[i:i + STREAM_REPLAY_CHUNK_SIZE]})
+            try:
+                extra = await on_complete(cached_response) if on_complete else {}
+            except HTTPException as e:
+                yield format_sse("error", {"request_id": request_id, "status_code": e.status_code, "error": e.detail})
+                return
+            yield format_sse("done", {
+                "request_id": request_id,
+                "model_used": cached_response.get("model", model_config["name"]),
+                "tokens_used": None,
+                "cached": True,
+                "time_to_first_token": 0.0,
+                "processing_time": time.time() - start_time,
+                **extra
+            })
+            return
         
-        # Call appropriate provider
-        provider = model_config["provider"]
-        model_id = model_config["model_id"]
+        messages = build_chat_messages(chat_request)
+        token_counts = build_chat_token_counts(chat_request)
+        tokens = None
+        first_token_time = None
+        used_key = model_key
+        sources = None
         
-        kwargs = {
-            "temperature": chat_request.temperature,
-            "max_tokens": min(chat_request.max_tokens, model_config["max_tokens"]),
-            "timeout": model_config["timeout"]
-        }
+        if chat_request.mode == "search":
+            try:
+                search_context = await prepare_search_context(chat_request, messages)
+            except HTTPException as e:
+                yield format_sse("error", {"request_id": request_id, "status_code": e.status_code, "error": e.detail})
+                return
+            messages = search_context["messages"]
+            token_counts = None
+            sources = search_context["sources"]
+            yield format_sse("sources", {"sources": sources, "timings": search_context["timings"]})
         
-        if provider == "openrouter":
-            result = await call_openrouter(model_id, messages, **kwargs)
-        elif provider == "a4f":
-            result = await call_a4f(model_id, messages, **kwargs)
-        elif provider == "groq":
-            result = await call_groq(model_id, messages, **kwargs)
+        # Fall back to the next model only while nothing has been sent to the client
+        overflow: Optional[ContextOverflowError] = None
+        failed = False
+        for used_key in get_fallback_chain(model_key):
+            used_config = AI_MODELS[used_key]
+            if not provider_supports(used_config["provider"], "stream"):
+                continue
+            kwargs = {
+                "temperature": chat_request.temperature,
+                "max_tokens": min(chat_request.max_tokens, used_config.get("max_tokens", chat_request.max_tokens)),
+                "timeout": used_config["timeout"]
+            }
+            attempt_start = time.time()
+            try:
+                context = fit_context(
+                    messages, used_key, kwargs["max_tokens"], chat_request.context_strategy, token_counts
+                )
+                adapter = get_provider_adapter(used_config["provider"], "stream")
+                async for chunk in adapter.stream_chat(used_config["model_id"], context, **kwargs):
+                    if chunk["tokens"] is not None:
+                        tokens = chunk["tokens"]
+                    if chunk["reasoning"]:
+                        if first_token_time is None:
+                            first_token_time = time.time()
+                        yield format_sse("reasoning", {"content": chunk["reasoning"]})
+                    if chunk["content"]:
+                        if first_token_time is None:
+                            first_token_time = time.time()
+                        content_parts.append(chunk["content"])
+                        yield format_sse("delta", {"content": chunk["content"]})
+                model_router.observe_success(
+                    used_key, time.time() - attempt_start, estimate_text_tokens("".join(content_parts)),
+                    ttft=first_token_time - attempt_start if first_token_time else None
+                )
+                break
+            except ContextOverflowError as e:
+                logger.info(f"Prompt does not fit {used_key}, trying the next model in the chain")
+                overflow = overflow or e
+                continue
+            except HTTPException as e:
+                if is_retryable_error(e):
+                    model_router.observe_failure(used_key)
+                if first_token_time is None and is_retryable_error(e):
+                    logger.warning(f"Stream from {used_key} failed ({e.status_code}), trying fallback")
+                    failed = True
+                    continue
+                yield format_sse("error", {"request_id": request_id, "status_code": e.status_code, "error": e.detail})
+                return
+            except Exception as e:
+                logger.error(f"Chat stream error: {e}")
+                yield format_sse("error", {"request_id": request_id, "status_code": 500, "error": str(e)})
+                return
         else:
-            raise HTTPException(status_code=400, detail=f"Unsupported provider: {provider}")
+            if overflow is not None and not failed:
+                yield format_sse("error", {"request_id": request_id, "status_code": 400, "error": overflow.detail})
+            else:
+                yield format_sse("error", {"request_id": request_id, "status_code": 502, "error": "All providers failed"})
+            return
         
+        used_config = AI_MODELS[used_key]
         response_data = {
-            "content": result["content"],
-            "model": model_config["name"],
-            "provider": provider,
-            "category": model_config["category"]
+            "content": "".join(content_parts),
+            "model": used_config["name"],
+            "provider": used_config["provider"],
+            "category": used_config["category"]
         }
+        if sources is not None:
+            response_data["sources"] = sources
+        TOKENS_TOTAL.labels(used_key).inc(tokens or 0)
+        extra = {}
+        if response_data["content"]:
+            await cache_set(cache_key, response_data, CHAT_CACHE_TTL)
+            await semantic_cache_add(model_key, chat_request, cache_key)
+            if on_complete:
+                try:
+                    extra = await on_complete(response_data)
+                except HTTPException as e:
+                    yield format_sse("error", {"request_id": request_id, "status_code": e.status_code, "error": e.detail})
+                    return
         
-        # Cache the response
-        background_tasks.add_task(cache_set, cache_key, response_data, 3600)
+        yield format_sse("done", {
+            "request_id": request_id,
+            "model_used": used_config["name"],
+            "tokens_used": tokens or 0,
+            "cached": False,
+            "time_to_first_token": (first_token_time or time.time()) - start_time,
+            "processing_time": time.time() - start_time,
+            **extra
+        })
+    
+    return StreamingResponse(
+        cancellable_stream(request_id, model_key, chat_request.max_tokens, cancel_token, event_stream(), content_parts),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.post("/chat/{request_id}/cancel")
+@limiter.limit("60/minute")
+async def cancel_chat(request: Request, request_id: str):
+    """Cancel an in-flight chat request or stream by its X-Request-ID and X-Cancel-Token"""
+    if not _REQUEST_ID_PATTERN.match(request_id):
+        raise HTTPException(status_code=400, detail="Invalid request id")
+    token = get_cancel_token(request)
+    if token is None:
+        raise HTTPException(status_code=400, detail="Missing or invalid X-Cancel-Token")
+    # Unknown ids and wrong tokens get the same answer, so ids cannot be probed
+    not_found = HTTPException(status_code=404, detail="Request not found or already finished")
+    entry = active_requests.get(request_id)
+    if entry is not None:
+        if not cancel_token_matches(entry.cancel_token, token):
+            raise not_found
+        entry.cancel("explicit")
+        return {"success": True, "data": {"request_id": request_id, "status": "cancelled"}}
+    if not cross_worker_cancels():
+        raise not_found
+    # It may be running on another worker, which registered its token digest
+    # and picks the flag up on its next poll
+    owner = await cache.get(get_cancel_owner_key(request_id), l1=False)
+    if not owner or not hmac.compare_digest(owner, cancel_token_digest(token)):
+        raise not_found
+    await cache.set(get_cancel_flag_key(request_id), b"1", CANCEL_FLAG_TTL, l1=False)
+    return ORJSONResponse(
+        {"success": True, "data": {"request_id": request_id, "status": "requested"}}, status_code=202
+    )
+
+# Batch chat: items are budgeted against their own per-item limit, and each
+# provider gets a fixed number of concurrent batch calls so offline jobs
+# cannot take over capacity needed by interactive traffic.
+BATCH_RATE_LIMIT = os.getenv("BATCH_RATE_LIMIT", "300/minute")
+BATCH_DEFAULT_CONCURRENCY = int(os.getenv("BATCH_DEFAULT_CONCURRENCY", "4"))
+batch_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+def get_batch_semaphore(provider: str) -> asyncio.Semaphore:
+    semaphore = batch_semaphores.get(provider)
+    if semaphore is None:
+        limit = API_CONFIGS.get(provider, {}).get("batch_concurrency", BATCH_DEFAULT_CONCURRENCY)
+        semaphore = batch_semaphores[provider] = asyncio.Semaphore(limit)
+    return semaphore
+
+def parse_batch_item(item: Any) -> tuple:
+    """Validate one raw batch item; returns ``(chat_request, model_key)``"""
+    try:
+        chat_request = ChatRequest.model_validate(item)
+    except ValidationError as e:
+        detail = "; ".join(
+            f"{'.'.join(str(part) for part in error['loc']) or 'item'}: {error['msg']}" for error in e.errors()
+        )
+        raise HTTPException(status_code=422, detail=detail)
+    return chat_request, resolve_model_key(chat_request)
+
+async def run_batch_item(chat_request: ChatRequest, model_key: str, cache_key: str) -> Dict:
+    """Run one deduplicated batch item; cache hits skip the provider semaphore"""
+    start_time = time.time()
+    try:
+        cached_response = await cache_get(
+            cache_key, refresh=make_chat_fetch(chat_request, model_key, cache_key), ttl=CHAT_CACHE_TTL
+        )
+        if cached_response:
+            response_data, tokens_used, source = cached_response, None, "cache"
+        else:
+            async with get_batch_semaphore(AI_MODELS[model_key]["provider"]):
+                response_data, tokens_used, source = await generate_chat_response(
+                    chat_request, model_key, cache_key, exact_cache_checked=True
+                )
+        return {
+            "success": True,
+            "data": response_data,
+            "model_used": response_data.get("model"),
+            "tokens_used": tokens_used,
+            "source": source,
+            "processing_time": time.time() - start_time
+        }
+    except HTTPException as e:
+        return {"success": False, "error": e.detail, "status_code": e.status_code, "processing_time": time.time() - start_time}
+    except Exception as e:
+        logger.error(f"Batch item error: {e}")
+        return {"success": False, "error": str(e), "status_code": 500, "processing_time": time.time() - start_time}
+
+@app.post("/chat/batch")
+@limiter.limit(BATCH_RATE_LIMIT)
+async def chat_completion_batch(request: Request, batch_request: BatchChatRequest):
+    """Run many chat requests with deduplication and bounded per-provider fan-out
+    
+    Results come back in input order, or as NDJSON lines (one per item, in
+    completion order, each carrying its ``index``) when ``stream`` is set.
+    """
+    start_time = time.time()
+    request_id = request.state.request_id
+    items = batch_request.requests
+    
+    # Group identical requests so each unique one runs once
+    groups: Dict[str, List[int]] = {}
+    unique: Dict[str, tuple] = {}
+    results: List[Optional[Dict]] = [None] * len(items)
+    for index, (chat_request, model_key, error) in enumerate(batch_request.parsed_items()):
+        if error is not None:
+            results[index] = {"index": index, "success": False, "error": error.detail, "status_code": error.status_code}
+            continue
+        cache_key = get_chat_cache_key(model_key, chat_request)
+        groups.setdefault(cache_key, []).append(index)
+        unique.setdefault(cache_key, (chat_request, model_key))
+    
+    async def run_group(cache_key: str) -> tuple:
+        chat_request, model_key = unique[cache_key]
+        # Batch items queue behind interactive traffic for provider slots
+        admit_request(request, chat_request, priority="background")
+        return cache_key, await run_batch_item(chat_request, model_key, cache_key)
+    
+    tasks = [asyncio.create_task(run_group(cache_key)) for cache_key in unique]
+    logger.info(f"Batch {request_id}: {len(items)} items, {len(unique)} unique")
+    
+    def summary() -> Dict:
+        return {
+            "request_id": request_id,
+            "items": len(items),
+            "unique_items": len(unique),
+            "succeeded": len([r for r in results if r and r["success"]]),
+            "processing_time": time.time() - start_time
+        }
+    
+    if batch_request.stream:
+        async def ndjson_stream() -> AsyncIterator[bytes]:
+            try:
+                for index, result in enumerate(results):
+                    if result is not None:
+                        yield orjson.dumps(result) + b"\n"
+                for next_done in asyncio.as_completed(tasks):
+                    cache_key, result = await next_done
+                    for position, index in enumerate(groups[cache_key]):
+                        results[index] = {"index": index, **result, "deduplicated": position > 0}
+                        yield orjson.dumps(results[index]) + b"\n"
+                yield orjson.dumps({"done": True, **summary()}) + b"\n"
+            finally:
+                for task in tasks:
+                    task.cancel()
         
-        processing_time = time.time() - start_time
+        return StreamingResponse(ndjson_stream(), media_type="application/x-ndjson")
+    
+    for cache_key, result in await asyncio.gather(*tasks):
+        for position, index in enumerate(groups[cache_key]):
+            results[index] = {"index": index, **result, "deduplicated": position > 0}
+    
+    return {"success": True, "results": results, **summary()}
+
+# Conversation sessions
+# Clients send a conversation_id plus only the new user message. The history
+# lives in the cache store together with its chained digest and per-message
+# token counts, so a turn hashes and counts only what is new. Sessions expire
+# CONVERSATION_TTL seconds after their last turn and lose their oldest
+# messages once past CONVERSATION_MAX_MESSAGES or CONVERSATION_MAX_TOKENS;
+# trimming goes down to CONVERSATION_TRIM_RATIO of the bound so the digest is
+# rebuilt now and then rather than on every turn. The random id is the only
+# credential. Reads skip the L1 tier since consecutive turns may be served by
+# different workers. Every save bumps the conversation's version and is a
+# compare-and-set against the version the turn loaded, so of two concurrent
+# turns only the first to finish is stored; the other gets 409 and the client
+# resyncs instead of one turn silently overwriting the other.
+CONVERSATION_TTL = int(os.getenv("CONVERSATION_TTL", str(24 * 3600)))
+CONVERSATION_MAX_MESSAGES = int(os.getenv("CONVERSATION_MAX_MESSAGES", "200"))
+CONVERSATION_MAX_TOKENS = int(os.getenv("CONVERSATION_MAX_TOKENS", "100000"))
+CONVERSATION_TRIM_RATIO = 0.75
+_CONVERSATION_ID_PATTERN = re.compile(r"[0-9a-f]{32}")
+
+CONVERSATION_TURNS_TOTAL = metrics.counter(
+    "ego_conversation_turns_total", "Conversation turns by outcome", ("result",)
+)
+
+def get_conversation_key(conversation_id: str) -> str:
+    return f"conversation:v1:{conversation_id}"
+
+def new_conversation() -> Dict:
+    now = time.time()
+    return {
+        "id": uuid.uuid4().hex,
+        "messages": [],
+        "tokens": [],
+        "digest": "",
+        "total_tokens": 0,
+        "dropped": 0,
+        "version": 0,
+        "created_at": now,
+        "updated_at": now
+    }
+
+def append_conversation_message(conversation: Dict, message: Dict, tokens: Optional[int] = None):
+    """Add a message, extending the digest and token total instead of recomputing them"""
+    tokens = count_message_tokens(message) if tokens is None else tokens
+    conversation["messages"].append(message)
+    conversation["tokens"].append(tokens)
+    conversation["total_tokens"] += tokens
+    conversation["digest"] = chain_message_digest(bytes.fromhex(conversation["digest"]), message).hex()
+
+def trim_conversation(conversation: Dict):
+    """Drop the oldest messages once the conversation is past its bounds"""
+    messages = conversation["messages"]
+    tokens = conversation["tokens"]
+    if len(messages) <= CONVERSATION_MAX_MESSAGES and conversation["total_tokens"] <= CONVERSATION_MAX_TOKENS:
+        return
+    
+    max_messages = int(CONVERSATION_MAX_MESSAGES * CONVERSATION_TRIM_RATIO)
+    max_tokens = int(CONVERSATION_MAX_TOKENS * CONVERSATION_TRIM_RATIO)
+    total = conversation["total_tokens"]
+    drop = 0
+    while drop < len(messages) - 1 and (len(messages) - drop > max_messages or total > max_tokens):
+        total -= tokens[drop]
+        drop += 1
+    # Start the kept history on a user turn
+    while drop < len(messages) - 1 and messages[drop]["role"] == "assistant":
+        total -= tokens[drop]
+        drop += 1
+    
+    del messages[:drop]
+    del tokens[:drop]
+    digest = b""
+    for message in messages:
+        digest = chain_message_digest(digest, message)
+    conversation["digest"] = digest.hex()
+    conversation["total_tokens"] = total
+    conversation["dropped"] += drop
+
+async def load_conversation(conversation_id: str) -> Optional[Dict]:
+    if not _CONVERSATION_ID_PATTERN.fullmatch(conversation_id):
+        return None
+    value = await cache.get(get_conversation_key(conversation_id), l1=False)
+    return decode_cache_value(value) if value else None
+
+async def save_conversation(conversation: Dict):
+    """Store the conversation unless another turn saved it since it was loaded (409)"""
+    expected = conversation.get("version", 0)
+    
+    def unchanged(current: Optional[bytes]) -> bool:
+        if current is None:
+            return expected == 0
+        return decode_cache_value(current).get("version", 0) == expected
+    
+    conversation["version"] = expected + 1
+    conversation["updated_at"] = time.time()
+    saved = await cache.compare_and_set(
+        get_conversation_key(conversation["id"]), unchanged, encode_cache_value(conversation), CONVERSATION_TTL
+    )
+    if not saved:
+        CONVERSATION_TURNS_TOTAL.labels("conflict").inc()
+        raise HTTPException(status_code=409, detail="Conversation was changed by another turn; reload it and retry")
+
+def conversation_summary(conversation: Dict) -> Dict:
+    return {
+        "conversation_id": conversation["id"],
+        "length": len(conversation["messages"]),
+        "total_tokens": conversation["total_tokens"],
+        "dropped_messages": conversation["dropped"],
+        "digest": conversation["digest"],
+        "version": conversation.get("version", 0),
+        "expires_in": CONVERSATION_TTL
+    }
+
+def build_conversation_chat_request(conversation: Dict, turn: ConversationTurnRequest) -> ChatRequest:
+    """A ChatRequest over the stored history plus the new message, reusing its digest and token counts"""
+    message = {"role": "user", "content": turn.message.content}
+    message_dicts = [*conversation["messages"], message]
+    # Everything here was validated when it was first received
+    chat_request = ChatRequest.model_construct(
+        messages=[ChatMessage.model_construct(**m) for m in message_dicts],
+        **turn.model_dump(include=set(ChatOptions.model_fields))
+    )
+    chat_request.__dict__.update(
+        message_dicts=message_dicts,
+        prefix_digest=bytes.fromhex(conversation["digest"]),
+        known_token_counts=[*conversation["tokens"], count_message_tokens(message)]
+    )
+    if "route" in turn.__dict__:
+        # The rate limiter already routed this turn; keep its decision
+        chat_request.__dict__["route"] = turn.route
+    return chat_request
+
+async def begin_conversation_turn(conversation_id: str, turn: ConversationTurnRequest) -> tuple:
+    """Load a conversation and build the request for its next turn"""
+    conversation = await load_conversation(conversation_id)
+    if conversation is None:
+        CONVERSATION_TURNS_TOTAL.labels("expired").inc()
+        raise HTTPException(status_code=404, detail="Conversation not found or expired")
+    length = len(conversation["messages"])
+    if turn.history_length is not None and turn.history_length != length:
+        # Another turn landed first (or the client lost track); let it resync
+        CONVERSATION_TURNS_TOTAL.labels("conflict").inc()
+        raise HTTPException(status_code=409, detail=f"Conversation has {length} messages, not {turn.history_length}")
+    return conversation, build_conversation_chat_request(conversation, turn)
+
+async def finish_conversation_turn(conversation: Dict, chat_request: ChatRequest, response_data: Dict) -> Dict:
+    """Store the user message and the reply; returns the conversation summary"""
+    append_conversation_message(conversation, chat_request.message_dicts[-1], chat_request.known_token_counts[-1])
+    append_conversation_message(conversation, {"role": "assistant", "content": response_data["content"]})
+    trim_conversation(conversation)
+    await save_conversation(conversation)
+    CONVERSATION_TURNS_TOTAL.labels("ok").inc()
+    return conversation_summary(conversation)
+
+@app.post("/conversations")
+@limiter.limit("30/minute")
+async def create_conversation(request: Request, create_request: ConversationCreateRequest):
+    """Start a conversation session, optionally seeded with earlier history"""
+    conversation = new_conversation()
+    for message in create_request.messages:
+        append_conversation_message(conversation, {"role": message.role, "content": message.content})
+    trim_conversation(conversation)
+    await save_conversation(conversation)
+    return {"success": True, "data": conversation_summary(conversation)}
+
+@app.get("/conversations/{conversation_id}")
+@limiter.limit("60/minute")
+async def get_conversation(request: Request, conversation_id: str, include_messages: bool = False):
+    """Describe a conversation session, with its stored history if asked"""
+    conversation = await load_conversation(conversation_id)
+    if conversation is None:
+        raise HTTPException(status_code=404, detail="Conversation not found or expired")
+    data = conversation_summary(conversation)
+    if include_messages:
+        data["messages"] = conversation["messages"]
+    return {"success": True, "data": data}
+
+@app.delete("/conversations/{conversation_id}")
+async def delete_conversation(conversation_id: str):
+    """Forget a conversation session"""
+    if _CONVERSATION_ID_PATTERN.fullmatch(conversation_id):
+        await cache.delete(get_conversation_key(conversation_id))
+    return {"success": True}
+
+@app.post("/conversations/{conversation_id}/chat", response_model=APIResponse)
+@limiter.limit("30/minute", scope="chat_completion")
+async def conversation_chat(request: Request, conversation_id: str, turn: ConversationTurnRequest):
+    """Answer the next user message of a conversation from its stored history"""
+    start_time = time.time()
+    request_id = request.state.request_id
+    conversation, chat_request = await begin_conversation_turn(conversation_id, turn)
+    
+    try:
+        model_key = resolve_model_key(chat_request)
+        request.state.model_key = model_key
+        admit_request(request, chat_request)
+        cache_key = get_chat_cache_key(model_key, chat_request)
+        response_data, tokens_used, source = await run_cancellable(
+            request, chat_request, model_key, generate_chat_response(chat_request, model_key, cache_key)
+        )
+        summary = await finish_conversation_turn(conversation, chat_request, response_data)
         
-        return APIResponse(
+        return encode_api_response(
+            orjson.dumps({**response_data, "conversation": summary}),
             success=True,
-            data=response_data,
+            error=None,
             request_id=request_id,
             timestamp=datetime.utcnow().isoformat(),
-            processing_time=processing_time,
-            model_used=model_config["name"],
-            tokens_used=result.get("tokens", 0)
+            processing_time=time.time() - start_time,
+            model_used=response_data.get("model", AI_MODELS[model_key]["name"]),
+            tokens_used=tokens_used
         )
-        
+    
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Chat completion error: {e}")
-        return APIResponse(
+        logger.error(f"Conversation chat error: {e}")
+        return encode_api_response(
             success=False,
+            data=None,
             error=str(e),
             request_id=request_id,
             timestamp=datetime.utcnow().isoformat(),
-            processing_time=time.time() - start_time
+            processing_time=time.time() - start_time,
+            model_used=None,
+            tokens_used=None
         )
 
+@app.post("/conversations/{conversation_id}/chat/stream")
+@limiter.limit("30/minute", scope="chat_completion_stream")
+async def conversation_chat_stream(request: Request, conversation_id: str, turn: ConversationTurnRequest):
+    """Stream the answer to the next user message of a conversation
+    
+    Same events as /chat/stream; the ``done`` event also carries the
+    conversation summary once the turn has been stored.
+    """
+    conversation, chat_request = await begin_conversation_turn(conversation_id, turn)
+    model_key = resolve_model_key(chat_request)
+    request.state.model_key = model_key
+    admit_request(request, chat_request)
+    
+    async def store_turn(response_data: Dict) -> Dict:
+        return {"conversation": await finish_conversation_turn(conversation, chat_request, response_data)}
+    
+    return await start_chat_stream(request, chat_request, model_key, store_turn)
+
 @app.post("/search", response_model=APIResponse)
 @limiter.limit("20/minute")
 async def web_search(
@@ -555,47 +4893,18 @@ async def web_search(
     """Perform web search using Tavily"""
     start_time = time.time()
     request_id = request.state.request_id
+    request.state.model_key = "tavily-search"
+    admit_request(request)
     
     try:
-        # Check cache
-        cache_key = get_cache_key(
-            "search",
-            query=search_request.query,
+        response_data, source = await search_with_cache(
+            search_request.query,
             max_results=search_request.max_results,
             include_domains=search_request.include_domains,
             exclude_domains=search_request.exclude_domains
         )
-        
-        cached_response = cache_get(cache_key)
-        if cached_response:
+        if source == "cache":
             logger.info(f"Search cache hit for request {request_id}")
-            return APIResponse(
-                success=True,
-                data=cached_response,
-                request_id=request_id,
-                timestamp=datetime.utcnow().isoformat(),
-                processing_time=time.time() - start_time,
-                model_used="Tavily Search"
-            )
-        
-        # Perform search
-        result = await call_tavily_search(
-            search_request.query,
-            max_results=search_request.max_results,
-            include_domains=search_request.include_domains,
-            exclude_domains=search_request.exclude_domains,
-            timeout=20
-        )
-        
-        response_data = {
-            "results": result["results"],
-            "answer": result.get("answer", ""),
-            "query": search_request.query,
-            "model": "Tavily Search"
-        }
-        
-        # Cache the response
-        background_tasks.add_task(cache_set, cache_key, response_data, 1800)  # 30 min cache
         
         processing_time = time.time() - start_time
         
@@ -620,6 +4929,71 @@ async def web_search(
             processing_time=time.time() - start_time
         )
 
+@app.post("/transcribe", response_model=APIResponse)
+@limiter.limit("10/minute")
+async def transcribe_audio(
+    request: Request,
+    file: UploadFile = File(...),
+    language: Optional[str] = Form(None),
+    prompt: Optional[str] = Form(None)
+):
+    """Transcribe uploaded audio with Whisper; results are cached by audio content"""
+    start_time = time.time()
+    request_id = request.state.request_id
+    request.state.model_key = TRANSCRIBE_MODEL
+    model_config = AI_MODELS[TRANSCRIBE_MODEL]
+    admit_request(request)
+    
+    try:
+        audio_digest, size = await hash_upload(file)
+        if size == 0:
+            raise HTTPException(status_code=400, detail="Empty audio upload")
+        cache_key = get_cache_key(
+            "transcribe", audio=audio_digest, model=model_config["model_id"], language=language, prompt=prompt
+        )
+        
+        response_data = await cache_get(cache_key)
+        if response_data:
+            logger.info(f"Transcription cache hit for request {request_id}")
+        else:
+            # Re-uploads of the same audio share one transcription. Only the
+            # request that starts it hands its audio over, to a flight that
+            # may outlive the request; one joining a running flight keeps its
+            # own and closes it with the request. No await between the check
+            # and ``do``, so the check cannot go stale.
+            audio = None if singleflight.in_flight(cache_key) else detach_upload(file)
+            
+            async def fetch_transcription() -> Dict:
+                result = await transcribe_upload(audio, size, language, prompt)
+                return {**result, "bytes": size, "model": model_config["name"]}
+            
+            response_data, source = await singleflight.do(
+                cache_key, fetch_transcription, TRANSCRIBE_CACHE_TTL, on_done=audio.file.close if audio else None
+            )
+        
+        return APIResponse(
+            success=True,
+            data=response_data,
+            request_id=request_id,
+            timestamp=datetime.utcnow().isoformat(),
+            processing_time=time.time() - start_time,
+            model_used=model_config["name"]
+        )
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Transcription error: {e}")
+        return APIResponse(
+            success=False,
+            error=str(e),
+            request_id=request_id,
+            timestamp=datetime.utcnow().isoformat(),
+            processing_time=time.time() - start_time
+        )
+    finally:
+        await file.close()
+
 @app.get("/stats")
 @limiter.limit("10/minute")
 async def get_stats(request: Request):
@@ -630,8 +5004,18 @@ async def get_stats(request: Request):
             "free_models": len([m for m in AI_MODELS.values() if m["category"] == "free"]),
             "premium_models": len([m for m in AI_MODELS.values() if m["category"] == "premium"]),
             "providers": list(API_CONFIGS.keys()),
-            "cache_enabled": CACHE_AVAILABLE,
-            "uptime": "Service running",
+            "cache_enabled": cache.available,
+            "cache": cache.stats(),
+            "coalescing": singleflight.stats(),
+            "cache_warming": cache_warmer.stats(),
+            "semantic_cache": semantic_cache.stats(),
+            "resilience": get_resilience_stats(),
+            "routing": model_router.stats(),
+            "cancellation": {"active": len(active_requests), **cancellation_stats},
+            "provider_protection": get_provider_protection_stats(),
+            "connection_pools": get_pool_stats(),
+            "rate_limiting": limiter.stats(),
+            "lifecycle": service_state.snapshot(),
             "timestamp": datetime.utcnow().isoformat()
         }
         
@@ -640,23 +5024,92 @@ async def get_stats(request: Request):
         logger.error(f"Stats error: {e}")
         raise HTTPException(status_code=500, detail="Failed to get stats")
 
+def collect_service_metrics():
+    """Refresh gauges that mirror live component state"""
+    for provider, breaker in circuit_breakers.items():
+        CIRCUIT_OPEN.labels(provider).set(1 if breaker.state == "open" else 0)
+        CONCURRENCY_LIMIT.labels(provider).set(int(concurrency_limiters[provider].limit))
+        UPSTREAM_QUEUED.labels(provider).set(concurrency_limiters[provider].queued)
+        for priority, depth in concurrency_limiters[provider].queued_by_class.items():
+            ADMISSION_QUEUE_DEPTH.labels(provider, priority).set(depth)
+    for provider, pool in get_pool_stats().items():
+        POOL_CONNECTIONS.labels(provider, "open").set(pool["open_connections"])
+        POOL_CONNECTIONS.labels(provider, "idle").set(pool["idle_connections"])
+        POOL_CONNECTIONS.labels(provider, "waiting").set(pool["waiting_requests"])
+    
+    resilience = get_resilience_stats()
+    HEDGED_REQUESTS.labels().set(resilience["hedged_requests"])
+    FALLBACKS.labels().set(resilience["fallbacks"])
+    coalescing = singleflight.stats()
+    COALESCED_REQUESTS.labels("local").set(coalescing["coalesced_local"])
+    COALESCED_REQUESTS.labels("remote").set(coalescing["coalesced_remote"])
+
+CIRCUIT_OPEN = metrics.gauge("ego_circuit_open", "Whether the provider circuit breaker is open on any worker", ("provider",), aggregate="max")
+CONCURRENCY_LIMIT = metrics.gauge("ego_concurrency_limit", "Largest per-worker adaptive concurrency limit", ("provider",), aggregate="max")
+UPSTREAM_QUEUED = metrics.gauge("ego_upstream_queued", "Calls waiting for provider concurrency", ("provider",))
+ADMISSION_QUEUE_DEPTH = metrics.gauge("ego_admission_queue_depth", "Calls waiting for provider concurrency by class", ("provider", "class"))
+POOL_CONNECTIONS = metrics.gauge("ego_pool_connections", "HTTP pool connections by state", ("provider", "state"))
+# Mirrors of cumulative in-process counters; exposed as counters so workers sum correctly
+HEDGED_REQUESTS = metrics.counter("ego_hedged_requests_total", "Chat requests that sent a hedge request")
+FALLBACKS = metrics.counter("ego_fallbacks_total", "Chat requests that fell back to another model")
+COALESCED_REQUESTS = metrics.counter("ego_coalesced_requests_total", "Requests served by another request's upstream call", ("scope",))
+metrics.register_collector(collect_service_metrics)
+
+def cache_hit_ratio(totals: Dict[str, Dict[tuple, float]]) -> Optional[float]:
+    """Hit ratio from the lookup counters summed over all workers"""
+    lookups = totals.get("ego_cache_lookups_total")
+    if not lookups:
+        return None
+    hits = sum(value for (namespace, result), value in lookups.items() if result == "hit")
+    total = sum(lookups.values())
+    return hits / total if total else 0.0
+
+metrics.register_derived("ego_cache_hit_ratio", "Response cache hit ratio across all workers", cache_hit_ratio)
+
+async def flush_metrics_loop():
+    """Periodically publish this worker's metrics for multi-worker aggregation"""
+    while True:
+        await asyncio.sleep(METRICS_FLUSH_INTERVAL)
+        try:
+            metrics.flush()
+        except OSError as e:
+            logger.error(f"Metrics flush error: {e}")
+
+def require_admin(request: Request):
+    """Admin endpoints need ADMIN_TOKEN in the X-Admin-Token header; without ADMIN_TOKEN they are off"""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled (ADMIN_TOKEN not set)")
+    if not hmac.compare_digest(request.headers.get("x-admin-token", ""), ADMIN_TOKEN):
+        raise HTTPException(status_code=401, detail="Invalid admin token")
+
+@app.get("/admin/slow-requests", dependencies=[Depends(require_admin)])
+async def get_slow_requests(limit: int = 20):
+    """Slowest recent requests with phase timings and loop stack samples, plus loop lag"""
+    return {"success": True, "data": profiler.report(max(1, min(limit, SLOW_REQUEST_LOG_SIZE)))}
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus metrics for all workers"""
+    return PlainTextResponse(await metrics.render(), media_type="text/plain; version=0.0.4")
+
 # Error handlers
 @app.exception_handler(HTTPException)
 async def http_exception_handler(request: Request, exc: HTTPException):
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=exc.status_code,
         content={
             "success": False,
             "error": exc.detail,
             "request_id": getattr(request.state, "request_id", "unknown"),
             "timestamp": datetime.utcnow().isoformat()
-        }
+        },
+        headers=exc.headers
     )
 
 @app.exception_handler(Exception)
 async def general_exception_handler(request: Request, exc: Exception):
     logger.error(f"Unhandled exception: {exc}")
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=500,
         content={
             "success": False,
@@ -667,10 +5120,4 @@ async def general_exception_handler(request: Request, exc: Exception):
     )
 
 if __name__ == "__main__":
-    uvicorn.run(
-        "main:app",
-        host="0.0.0.0",
-        port=8000,
-        reload=True,
-        log_level="info"
-    )
\ No newline at end of file
+    serve()
\ No newline at end of file
@@ -0,0 +1,71 @@
+"""Shared test setup: simulated providers and an in-process Redis
+
+Settings are read when ``main`` is imported, so the environment is fixed
+here first. Each test gets its own fakeredis server and a client that runs
+the application lifespan around it.
+
+Install requirements-dev.txt, then run ``python -m pytest tests`` from
+backend/ai_service.
+"""
+import os
+import sys
+from collections import OrderedDict
+
+os.environ.update({
+    "PROVIDER_MODE": "mock",
+    "MOCK_SEED": "7",
+    "MOCK_TTFB_MS": "1",
+    "MOCK_LATENCY_SIGMA": "0",
+    "MOCK_ERROR_RATE": "0",
+    "MOCK_TOKENS_PER_SECOND": "100000",
+    "MOCK_OUTPUT_TOKENS": "20",
+    "MOCK_STREAM_INTERVAL_MS": "1",
+    "WARMUP_ENABLED": "false",
+    "CACHE_WARMER_ENABLED": "false",
+    "SEMANTIC_CACHE_ENABLED": "false",
+    "SHUTDOWN_READY_GRACE": "0",
+})
+os.environ.pop("METRICS_DIR", None)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fakeredis  # noqa: E402
+import httpx  # noqa: E402
+import pytest  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+import main  # noqa: E402
+
+@pytest.fixture
+def redis_server(monkeypatch):
+    """A fresh fakeredis server standing in for REDIS_URL, with empty in-process fallbacks"""
+    server = fakeredis.FakeServer()
+    
+    class FakeRedisCache(main.RedisCache):
+        def __init__(self, url):
+            self.client = fakeredis.FakeAsyncRedis(server=server)
+            self.token_bucket = self.client.register_script(main.TOKEN_BUCKET_SCRIPT)
+    
+    monkeypatch.setattr(main, "RedisCache", FakeRedisCache)
+    monkeypatch.setattr(main.cache, "fallback", main.MemoryCache())
+    if main.cache.l1 is not None:
+        monkeypatch.setattr(main.cache, "l1", main.MemoryCache(main.L1_CACHE_MAX_ENTRIES, main.L1_CACHE_MAX_BYTES))
+    monkeypatch.setattr(main.limiter, "local", OrderedDict())
+    return server
+
+@pytest.fixture
+def client(redis_server):
+    with TestClient(main.app) as test_client:
+        yield test_client
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+@pytest.fixture
+async def async_client(redis_server):
+    """A client for tests that send concurrent requests; mark them ``pytest.mark.anyio``"""
+    async with main.app.router.lifespan_context(main.app):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as test_client:
+            yield test_client
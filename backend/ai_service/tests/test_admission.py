@@ -0,0 +1,83 @@
+"""Weighted fair queuing in front of provider calls"""
+import asyncio
+
+import pytest
+
+import main
+
+def make_limiter(max_queue: int = 10) -> main.AdaptiveConcurrencyLimiter:
+    return main.AdaptiveConcurrencyLimiter(
+        "test", initial_limit=1, min_limit=1, max_limit=1, backoff=0.5, max_queue=max_queue, queue_timeout=5
+    )
+
+async def enqueue(limiter: main.AdaptiveConcurrencyLimiter, admission: main.Admission, granted: list) -> asyncio.Task:
+    """Queue a call for ``admission``; its flow is appended to ``granted`` once it gets a slot"""
+    async def call():
+        main.current_admission.set(admission)
+        await limiter.acquire()
+        granted.append(admission.flow)
+    
+    task = asyncio.create_task(call())
+    await asyncio.sleep(0)
+    return task
+
+async def drain(limiter: main.AdaptiveConcurrencyLimiter, tasks: list):
+    for _ in tasks:
+        limiter.release(True)
+        await asyncio.sleep(0)
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+@pytest.mark.anyio
+async def test_flows_take_turns():
+    limiter = make_limiter()
+    await limiter.acquire()
+    granted = []
+    tasks = [await enqueue(limiter, main.Admission("free", "alice"), granted) for _ in range(3)]
+    tasks.append(await enqueue(limiter, main.Admission("free", "bob"), granted))
+    assert limiter.queued == 4
+    
+    await drain(limiter, tasks)
+    
+    # bob arrived last but only waits behind alice's first call
+    assert granted == ["alice", "bob", "alice", "alice"]
+
+@pytest.mark.anyio
+async def test_weight_orders_classes():
+    limiter = make_limiter()
+    await limiter.acquire()
+    granted = []
+    tasks = [
+        await enqueue(limiter, main.Admission("background", "batch"), granted),
+        await enqueue(limiter, main.Admission("free", "alice"), granted),
+        await enqueue(limiter, main.Admission("premium", "carol"), granted),
+    ]
+    
+    await drain(limiter, tasks)
+    
+    assert granted == ["carol", "alice", "batch"]
+
+@pytest.mark.anyio
+async def test_full_queue_evicts_the_call_served_last():
+    limiter = make_limiter(max_queue=2)
+    await limiter.acquire()
+    granted = []
+    first = await enqueue(limiter, main.Admission("background", "batch"), granted)
+    second = await enqueue(limiter, main.Admission("background", "batch"), granted)
+    
+    # A free call would be served before the second batch call, so it takes its place
+    free = await enqueue(limiter, main.Admission("free", "alice"), granted)
+    with pytest.raises(main.HTTPException) as error:
+        await second
+    assert error.value.status_code == 503
+    assert limiter.queued == 2
+    
+    # Another batch call would be served last of all, so it is turned away instead
+    main.current_admission.set(main.Admission("background", "batch"))
+    with pytest.raises(main.HTTPException) as error:
+        await limiter.acquire()
+    assert error.value.status_code == 503
+    assert "Retry-After" in error.value.headers
+    
+    await drain(limiter, [first, free])
+    assert granted == ["alice", "batch"]
+    assert limiter.shed == 2
@@ -0,0 +1,42 @@
+"""/chat/batch: per-item validation and deduplication"""
+import main
+
+def chat_item(content: str, **options) -> dict:
+    return {"messages": [{"role": "user", "content": content}], "model": "llama-4-scout-free", **options}
+
+def test_malformed_item_fails_alone(client):
+    response = client.post("/chat/batch", json={"requests": [
+        chat_item("batch validation: first"),
+        {"messages": [], "model": "llama-4-scout-free"},
+        chat_item("batch validation: third", temperature=9),
+        "not a request",
+        chat_item("batch validation: fifth"),
+    ]})
+    
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [result["success"] for result in results] == [True, False, False, False, True]
+    for result in results[1:4]:
+        assert result["status_code"] == 422
+    assert "temperature" in results[2]["error"]
+    assert response.json()["succeeded"] == 2
+
+def test_identical_items_run_once(client):
+    calls_before = main.singleflight.upstream_calls
+    items = [chat_item(f"batch dedup: {i % 2}") for i in range(5)]
+    
+    response = client.post("/chat/batch", json={"requests": items})
+    
+    body = response.json()
+    assert response.status_code == 200
+    assert (body["items"], body["unique_items"], body["succeeded"]) == (5, 2, 5)
+    assert main.singleflight.upstream_calls - calls_before == 2
+    results = body["results"]
+    assert [result["deduplicated"] for result in results] == [False, False, True, True, True]
+    assert results[2]["data"] == results[0]["data"]
+    assert results[3]["data"] == results[1]["data"]
+    
+    # A repeat is served from the cache without another upstream call
+    response = client.post("/chat/batch", json={"requests": items[:2]})
+    assert [result["source"] for result in response.json()["results"]] == ["cache", "cache"]
+    assert main.singleflight.upstream_calls - calls_before == 2
@@ -0,0 +1,51 @@
+"""Cancelling in-flight chat requests"""
+import asyncio
+
+import pytest
+
+import main
+
+REQUEST_ID = "cancel-test-0000-4000-8000-000000000001"
+CANCEL_TOKEN = "cancel-token-0123456789abcdef"
+
+async def start_slow_chat(async_client, monkeypatch) -> asyncio.Task:
+    """Send a chat request that stays in flight until cancelled"""
+    adapter = main.provider_adapters[main.AI_MODELS["llama-4-scout-free"]["provider"]]
+    monkeypatch.setitem(adapter.config, "ttfb_ms", 5000)
+    task = asyncio.create_task(async_client.post(
+        "/chat",
+        json={"messages": [{"role": "user", "content": "a slow question"}], "model": "llama-4-scout-free"},
+        headers={"X-Request-ID": REQUEST_ID, "X-Cancel-Token": CANCEL_TOKEN}
+    ))
+    for _ in range(100):
+        if REQUEST_ID in main.active_requests:
+            return task
+        await asyncio.sleep(0.01)
+    raise AssertionError("request never became active")
+
+@pytest.mark.anyio
+async def test_cancel_needs_the_request_token(async_client, monkeypatch):
+    task = await start_slow_chat(async_client, monkeypatch)
+    
+    response = await async_client.post(f"/chat/{REQUEST_ID}/cancel")
+    assert response.status_code == 400
+    response = await async_client.post(
+        f"/chat/{REQUEST_ID}/cancel", headers={"X-Cancel-Token": "wrong-token-0123456789abcdef"}
+    )
+    assert response.status_code == 404
+    assert REQUEST_ID in main.active_requests
+    
+    response = await async_client.post(f"/chat/{REQUEST_ID}/cancel", headers={"X-Cancel-Token": CANCEL_TOKEN})
+    assert response.status_code == 200
+    assert response.json()["data"]["status"] == "cancelled"
+    
+    original = await asyncio.wait_for(task, 5)
+    assert original.status_code == 499
+    assert REQUEST_ID not in main.active_requests
+
+@pytest.mark.anyio
+async def test_unknown_request_looks_like_a_wrong_token(async_client):
+    response = await async_client.post(
+        "/chat/no-such-request-0001/cancel", headers={"X-Cancel-Token": CANCEL_TOKEN}
+    )
+    assert response.status_code == 404
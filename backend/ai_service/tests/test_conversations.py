@@ -0,0 +1,43 @@
+"""Conversation sessions: versioned saves"""
+import asyncio
+
+import pytest
+
+@pytest.mark.anyio
+async def test_concurrent_turns_conflict(async_client):
+    response = await async_client.post("/conversations", json={"messages": []})
+    conversation_id = response.json()["data"]["conversation_id"]
+    
+    turns = [
+        async_client.post(
+            f"/conversations/{conversation_id}/chat",
+            json={"message": {"role": "user", "content": f"concurrent turn {i}"}, "model": "llama-4-scout-free"}
+        )
+        for i in range(2)
+    ]
+    responses = await asyncio.gather(*turns)
+    
+    # Both turns loaded the same version; only the first save is kept
+    assert sorted(r.status_code for r in responses) == [200, 409]
+    conflict = next(r for r in responses if r.status_code == 409)
+    assert "reload" in conflict.json()["error"]
+    
+    conversation = (await async_client.get(f"/conversations/{conversation_id}")).json()["data"]
+    assert conversation["length"] == 2
+    assert conversation["version"] == 2
+
+@pytest.mark.anyio
+async def test_sequential_turns_do_not_conflict(async_client):
+    response = await async_client.post("/conversations", json={"messages": []})
+    conversation_id = response.json()["data"]["conversation_id"]
+    
+    for i in range(2):
+        response = await async_client.post(
+            f"/conversations/{conversation_id}/chat",
+            json={"message": {"role": "user", "content": f"sequential turn {i}"}, "model": "llama-4-scout-free"}
+        )
+        assert response.status_code == 200
+    
+    conversation = (await async_client.get(f"/conversations/{conversation_id}")).json()["data"]
+    assert conversation["length"] == 4
+    assert conversation["version"] == 3
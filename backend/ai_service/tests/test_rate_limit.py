@@ -0,0 +1,36 @@
+"""Token-bucket rate limiting"""
+import asyncio
+
+import pytest
+from starlette.requests import Request
+
+import main
+
+def make_request(host: str = "10.0.0.1") -> Request:
+    return Request({"type": "http", "method": "POST", "path": "/chat", "headers": [], "client": (host, 40000)})
+
+async def take(scope: str, user_id=None, host: str = "10.0.0.1") -> int:
+    try:
+        await main.limiter.check(make_request(host), scope, 2, 1, user_id=user_id)
+    except main.HTTPException as e:
+        assert e.status_code == 429
+        assert int(e.headers["Retry-After"]) >= 1
+        return 429
+    return 200
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("backend", ["redis", "local"])
+async def test_bucket_refills(async_client, monkeypatch, backend):
+    if backend == "local":
+        monkeypatch.setattr(main.cache, "available", False)
+    assert [await take(f"refill-{backend}") for _ in range(3)] == [200, 200, 429]
+    
+    # 2 per second: one token is back after half a second
+    await asyncio.sleep(0.6)
+    assert [await take(f"refill-{backend}") for _ in range(2)] == [200, 429]
+
+@pytest.mark.anyio
+async def test_new_user_id_does_not_reset_the_address_budget(async_client):
+    assert [await take("rotate", user_id=f"user-{i}") for i in range(3)] == [200, 200, 429]
+    # Another address with the same user ids still has its own budget
+    assert await take("rotate", user_id="user-9", host="10.0.0.2") == 200
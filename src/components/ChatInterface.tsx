@@ -48,12 +48,9 @@ const ChatInterface: React.FC = () => {
         mode
       });
 
-      let actualModel = selectedModel;
-      
-      // Auto-select model if needed
-      if (selectedModel === 'auto') {
-        actualModel = await aiService.getAutoSelectedModel(userMessage, mode);
-      }
+      // 'auto' is resolved by the server, which routes among the models this plan allows
+      const actualModel = selectedModel;
+      const plan: 'free' | 'premium' = isActiveSubscription ? 'premium' : 'free';
 
       // Check if user can use premium models
       const modelConfig = await import('../utils/aiModels').then(m => m.getModelById(actualModel));
@@ -89,11 +86,15 @@ const ChatInterface: React.FC = () => {
         
         messages.push({ role: 'user', content: userMessage });
 
-        const chatResponse = await aiService.chatCompletion(actualModel, messages, {
+        const chatOptions = {
           temperature,
           systemPrompt: behavior,
-          mode
-        });
+          mode,
+          plan
+        };
+        const chatResponse = currentSession
+          ? await aiService.chatCompletionInSession(currentSession.id, actualModel, messages, chatOptions)
+          : await aiService.chatCompletion(actualModel, messages, chatOptions);
         
         if (!chatResponse.success || !chatResponse.data) {
           throw new Error(chatResponse.error || 'Failed to get AI response');
@@ -19,6 +19,42 @@ interface ChatResponse {
   tokens_used?: number;
 }
 
+interface ConversationSummary {
+  conversation_id: string;
+  length: number;
+  total_tokens: number;
+  dropped_messages: number;
+  digest: string;
+  expires_in: number;
+}
+
+interface ConversationChatResponse extends ChatResponse {
+  data?: ChatResponse['data'] & { conversation: ConversationSummary };
+}
+
+interface ConversationState {
+  id: string;
+  // Client messages the server has seen, and how many it kept after trimming
+  syncedMessages: number;
+  serverLength: number;
+}
+
+interface ChatStreamDone {
+  request_id: string;
+  model_used: string;
+  tokens_used: number | null;
+  cached: boolean;
+  time_to_first_token: number;
+  processing_time: number;
+}
+
+interface ChatStreamHandlers {
+  // request_id and cancel_token are what cancelRequest needs to stop the stream
+  onStart?: (start: { request_id: string; cancel_token: string }) => void;
+  onDelta: (content: string) => void;
+  onReasoning?: (content: string) => void;
+}
+
 interface SearchResponse {
   success: boolean;
   data?: {
@@ -40,6 +76,7 @@ interface SearchResponse {
 
 class AIService {
   private baseUrl = 'http://localhost:8000';
+  private conversations = new Map<string, ConversationState>();
 
   private async makeRequest<T>(endpoint: string, options: RequestInit = {}): Promise<T> {
     try {
@@ -54,7 +91,9 @@ class AIService {
       const data = await response.json();
 
       if (!response.ok) {
-        throw new Error(data.error || `HTTP ${response.status}: ${response.statusText}`);
+        const error = new Error(data.error || `HTTP ${response.status}: ${response.statusText}`) as Error & { status?: number };
+        error.status = response.status;
+        throw error;
       }
 
       return data;
@@ -75,13 +114,22 @@ class AIService {
       systemPrompt?: string;
       mode?: string;
       userId?: string;
+      plan?: 'free' | 'premium';
+      requestId?: string;
+      cancelToken?: string;
+      signal?: AbortSignal;
     } = {}
   ): Promise<ChatResponse> {
-    const { temperature = 0.7, maxTokens = 4000, systemPrompt, mode = 'normal', userId } = options;
+    const { temperature = 0.7, maxTokens = 4000, systemPrompt, mode = 'normal', userId, plan = 'free', requestId, cancelToken, signal } = options;
+    const headers: Record<string, string> = {};
+    if (requestId) headers['X-Request-ID'] = requestId;
+    if (cancelToken) headers['X-Cancel-Token'] = cancelToken;
 
     try {
       const response = await this.makeRequest<ChatResponse>('/chat', {
         method: 'POST',
+        headers,
+        signal,
         body: JSON.stringify({
           messages,
           model: modelId,
@@ -90,6 +138,7 @@ class AIService {
           behavior: systemPrompt || '',
           mode,
           user_id: userId,
+          plan,
         }),
       });
 
@@ -104,6 +153,172 @@ class AIService {
     }
   }
 
+  // Chat within a server-side conversation: only the new user message is
+  // uploaded while the server holds the rest of the history. A new
+  // conversation, seeded with the earlier messages, is started on the first
+  // turn, when the history changed locally, or when the server lost it.
+  async chatCompletionInSession(
+    sessionId: string,
+    modelId: string,
+    messages: ChatMessage[],
+    options: {
+      temperature?: number;
+      maxTokens?: number;
+      systemPrompt?: string;
+      mode?: string;
+      userId?: string;
+      plan?: 'free' | 'premium';
+    } = {}
+  ): Promise<ChatResponse> {
+    const history = messages.slice(0, -1);
+    const message = messages[messages.length - 1];
+
+    let state = this.conversations.get(sessionId);
+    if (!state || state.syncedMessages !== history.length) {
+      state = await this.createConversation(history);
+    }
+
+    let response: ConversationChatResponse;
+    try {
+      response = await this.conversationTurn(state, message, modelId, options);
+    } catch (error) {
+      const status = (error as { status?: number }).status;
+      if (status !== 404 && status !== 409) {
+        console.error('AI Service Error:', error);
+        throw error;
+      }
+      state = await this.createConversation(history);
+      response = await this.conversationTurn(state, message, modelId, options);
+    }
+
+    if (!response.success || !response.data) {
+      this.conversations.delete(sessionId);
+      throw new Error(response.error || 'Chat completion failed');
+    }
+
+    this.conversations.set(sessionId, {
+      id: state.id,
+      syncedMessages: messages.length + 1,
+      serverLength: response.data.conversation.length,
+    });
+    return response;
+  }
+
+  private async createConversation(messages: ChatMessage[]): Promise<ConversationState> {
+    const response = await this.makeRequest<{ success: boolean; data: ConversationSummary }>('/conversations', {
+      method: 'POST',
+      body: JSON.stringify({ messages }),
+    });
+    return {
+      id: response.data.conversation_id,
+      syncedMessages: messages.length,
+      serverLength: response.data.length,
+    };
+  }
+
+  private conversationTurn(
+    state: ConversationState,
+    message: ChatMessage,
+    modelId: string,
+    options: {
+      temperature?: number;
+      maxTokens?: number;
+      systemPrompt?: string;
+      mode?: string;
+      userId?: string;
+      plan?: 'free' | 'premium';
+    }
+  ): Promise<ConversationChatResponse> {
+    const { temperature = 0.7, maxTokens = 4000, systemPrompt, mode = 'normal', userId, plan = 'free' } = options;
+
+    return this.makeRequest<ConversationChatResponse>(`/conversations/${state.id}/chat`, {
+      method: 'POST',
+      body: JSON.stringify({
+        message,
+        history_length: state.serverLength,
+        model: modelId,
+        temperature,
+        max_tokens: maxTokens,
+        behavior: systemPrompt || '',
+        mode,
+        user_id: userId,
+        plan,
+      }),
+    });
+  }
+
+  async chatCompletionStream(
+    modelId: string,
+    messages: ChatMessage[],
+    handlers: ChatStreamHandlers,
+    options: {
+      temperature?: number;
+      maxTokens?: number;
+      systemPrompt?: string;
+      mode?: string;
+      userId?: string;
+      plan?: 'free' | 'premium';
+      signal?: AbortSignal;
+    } = {}
+  ): Promise<ChatStreamDone> {
+    const { temperature = 0.7, maxTokens = 4000, systemPrompt, mode = 'normal', userId, plan = 'free', signal } = options;
+
+    const response = await fetch(`${this.baseUrl}/chat/stream`, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({
+        messages,
+        model: modelId,
+        temperature,
+        max_tokens: maxTokens,
+        behavior: systemPrompt || '',
+        mode,
+        user_id: userId,
+        plan,
+      }),
+      signal,
+    });
+
+    if (!response.ok || !response.body) {
+      const data = await response.json().catch(() => ({}));
+      throw new Error(data.error || `HTTP ${response.status}: ${response.statusText}`);
+    }
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+
+    while (true) {
+      const { done, value } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+
+      let boundary = buffer.indexOf('\n\n');
+      while (boundary !== -1) {
+        const rawEvent = buffer.slice(0, boundary);
+        buffer = buffer.slice(boundary + 2);
+        boundary = buffer.indexOf('\n\n');
+
+        let event = 'message';
+        let data = '';
+        for (const line of rawEvent.split('\n')) {
+          if (line.startsWith('event:')) event = line.slice(6).trim();
+          else if (line.startsWith('data:')) data += line.slice(5).trim();
+        }
+        if (!data) continue;
+        const payload = JSON.parse(data);
+
+        if (event === 'start') handlers.onStart?.(payload);
+        else if (event === 'delta') handlers.onDelta(payload.content);
+        else if (event === 'reasoning') handlers.onReasoning?.(payload.content);
+        else if (event === 'error') throw new Error(payload.error || 'Chat stream failed');
+        else if (event === 'done') return payload as ChatStreamDone;
+      }
+    }
+
+    throw new Error('Chat stream ended unexpectedly');
+  }
+
   async searchWeb(
     query: string,
     options: {
@@ -136,30 +351,14 @@ class AIService {
     }
   }
 
-  async getAutoSelectedModel(
-    query: string,
-    mode: 'normal' | 'think' | 'search'
-  ): Promise<string> {
-    // Auto selection logic
-    const queryLower = query.toLowerCase();
-    
-    if (mode === 'search') {
-      return 'tavily-search';
-    }
-    
-    if (mode === 'think') {
-      return 'deepseek-r1-free';
-    }
-    
-    if (queryLower.includes('code') || queryLower.includes('program') || queryLower.includes('function')) {
-      return 'llama-4-scout-free';
-    }
-    
-    if (queryLower.includes('creative') || queryLower.includes('story') || queryLower.includes('poem')) {
-      return 'qwen-3-235b-free';
-    }
-    
-    return 'gemini-2-5-pro-free';
+  // Stop a chat request that is still running. requestId and cancelToken are
+  // the X-Request-ID and X-Cancel-Token it was sent with, or the request_id and
+  // cancel_token from a stream's start event.
+  async cancelRequest(requestId: string, cancelToken: string): Promise<void> {
+    await this.makeRequest(`/chat/${encodeURIComponent(requestId)}/cancel`, {
+      method: 'POST',
+      headers: { 'X-Cancel-Token': cancelToken },
+    });
   }
 
   async getModels(): Promise<any> {